@@ -0,0 +1,11 @@
+"""
+Gunicorn server hooks.
+
+Command line options live in entrypoint.sh; this file only adds hooks.
+"""
+
+
+def post_worker_init(worker):
+    """Warm up the pooled extraction HTTP client once the worker has loaded Django."""
+    from core.extraction import warm_up_http_client
+    warm_up_http_client()
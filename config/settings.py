@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import json
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 
@@ -137,12 +138,14 @@ TEMPLATES = [
                 "django.contrib.messages.context_processors.messages",
                 "django.template.context_processors.csrf",
                 "core.context_processors.version_context",
+                "core.context_processors.extraction_context",
             ],
         },
     },
 ]
 
 WSGI_APPLICATION = "config.wsgi.application"
+ASGI_APPLICATION = "config.asgi.application"
 
 
 # Database
@@ -192,8 +195,111 @@ MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "data"
 
 # File upload settings
-FILE_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100MB
+# Uploads above FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to FILE_UPLOAD_TEMP_DIR instead of RAM.
+# The temp dir lives under data/ so a finished upload is renamed into data/0_uploaded, not copied.
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE', str(2621440)))  # 2.5MB
+FILE_UPLOAD_TEMP_DIR = os.getenv('FILE_UPLOAD_TEMP_DIR', str(BASE_DIR / 'data' / 'tmp'))
+Path(FILE_UPLOAD_TEMP_DIR).mkdir(parents=True, exist_ok=True)
 DATA_UPLOAD_MAX_MEMORY_SIZE = 104857600  # 100MB
+# Receipt images are stored once by content hash, in two levels of shard directories
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', str(BASE_DIR / 'data' / 'images'))
+# Downscaled variants of receipt images for the browser (serve_image ?size=thumb|screen), with an LRU size bound
+IMAGE_DERIVATIVE_DIR = os.getenv('IMAGE_DERIVATIVE_DIR', str(BASE_DIR / 'data' / 'derivatives'))
+IMAGE_DERIVATIVE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_DERIVATIVE_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))  # 500MB
+IMAGE_THUMBNAIL_SIZE = int(os.getenv('IMAGE_THUMBNAIL_SIZE', '320'))  # Pixels, longest side
+IMAGE_SCREEN_SIZE = int(os.getenv('IMAGE_SCREEN_SIZE', '1600'))  # Pixels, longest side
+IMAGE_DERIVATIVE_JPEG_QUALITY = int(os.getenv('IMAGE_DERIVATIVE_JPEG_QUALITY', '80'))
+# Receipt photos downscaled for the extraction API, keyed by content hash, with the same LRU size bound
+PREPROCESSED_CACHE_DIR = os.getenv('PREPROCESSED_CACHE_DIR', str(BASE_DIR / 'data' / '2_preprocessed'))
+PREPROCESSED_CACHE_MAX_BYTES = int(os.getenv('PREPROCESSED_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))  # 500MB
+IMAGE_CACHE_MAX_AGE = int(os.getenv('IMAGE_CACHE_MAX_AGE', str(365 * 24 * 3600)))  # Seconds browsers keep versioned image URLs
+
+# Let the reverse proxy send image bytes so worker threads are freed right after the access check:
+# '' sends them from Django, 'x-accel-redirect' for nginx (see config/nginx.conf), 'x-sendfile' for Apache mod_xsendfile or lighttpd
+IMAGE_SENDFILE_BACKEND = os.getenv('IMAGE_SENDFILE_BACKEND', '').lower()
+IMAGE_ACCEL_REDIRECT_PREFIX = os.getenv('IMAGE_ACCEL_REDIRECT_PREFIX', '/protected/')  # nginx internal locations: <prefix>images/, derivatives/, unzipped/
+
+# Lazy ingestion: keep images inside the uploaded ZIP and read them from there on demand,
+# so files are viewable as soon as the central directory is registered
+INGESTION_LAZY_IMAGES = os.getenv('INGESTION_LAZY_IMAGES', 'False').lower() == 'true'
+ARCHIVE_STORE_DIR = os.getenv('ARCHIVE_STORE_DIR', str(BASE_DIR / 'data' / 'archives'))
+# Uploaded ZIPs are extracted and registered by background jobs, so the upload request returns at once
+INGESTION_MAX_WORKERS = int(os.getenv('INGESTION_MAX_WORKERS', '2'))
+# Resumable uploads: the page sends ZIPs in checksummed chunks and resumes from the last verified offset
+CHUNKED_UPLOAD_CHUNK_SIZE = int(os.getenv('CHUNKED_UPLOAD_CHUNK_SIZE', str(4 * 1024 * 1024)))  # 4MB
+CHUNKED_UPLOAD_MAX_SIZE = int(os.getenv('CHUNKED_UPLOAD_MAX_SIZE', str(1024 * 1024 * 1024)))  # 1GB
+CHUNKED_UPLOAD_EXPIRY_HOURS = int(os.getenv('CHUNKED_UPLOAD_EXPIRY_HOURS', '24'))  # Unfinished uploads are dropped after this
+
+# Receipt extraction settings
+# Backend that answers extraction requests. Use 'core.extraction.StandInBackend' together with
+# `python manage.py run_standin_extractor` to load test or run CI without calling OpenAI.
+EXTRACTION_BACKEND = os.getenv('EXTRACTION_BACKEND', 'core.extraction.OpenAIBackend')
+EXTRACTION_API_URL = os.getenv('EXTRACTION_API_URL', '')  # Empty uses the backend's default endpoint
+
+# Ask the model for schema-checked JSON (structured outputs) instead of a free-text Python list
+EXTRACTION_STRUCTURED_OUTPUT = os.getenv('EXTRACTION_STRUCTURED_OUTPUT', 'True').lower() == 'true'
+
+# Stream item rows into the review table as the model produces them (server-sent events)
+EXTRACTION_STREAMING = os.getenv('EXTRACTION_STREAMING', 'False').lower() == 'true'
+
+# USD per million (input, output) tokens, used to cost every extraction call.
+# Override with a JSON object, e.g. EXTRACTION_MODEL_PRICING='{"gpt-4o": [2.5, 10.0]}'
+EXTRACTION_MODEL_PRICING = json.loads(os.getenv('EXTRACTION_MODEL_PRICING', '{"gpt-4o": [2.5, 10.0], "gpt-4o-mini": [0.15, 0.6], "gpt-4.1": [2.0, 8.0], "gpt-4.1-mini": [0.4, 1.6]}'))
+
+# Upper bound on concurrent background extractions per worker process ("extract all")
+EXTRACTION_MAX_WORKERS = int(os.getenv('EXTRACTION_MAX_WORKERS', '4'))
+
+# Longest a worker process may hold a file's extraction lease before others take over (crashed workers)
+EXTRACTION_LEASE_SECONDS = int(os.getenv('EXTRACTION_LEASE_SECONDS', '120'))
+
+# Receipts per model call for "extract all" (1 sends every receipt on its own)
+EXTRACTION_BATCH_SIZE = int(os.getenv('EXTRACTION_BATCH_SIZE', '1'))
+
+# Speculative prefetch: extract the next N queued files while the current one is reviewed (0 disables)
+EXTRACTION_PREFETCH_DEPTH = int(os.getenv('EXTRACTION_PREFETCH_DEPTH', '0'))
+EXTRACTION_PREFETCH_COST_CAP = float(os.getenv('EXTRACTION_PREFETCH_COST_CAP', '1.00'))  # USD per session
+
+# Outbound rate limiting shared by all worker processes on this host (file locks under data/ratelimit)
+# Calls queue for up to EXTRACTION_RATE_LIMIT_MAX_WAIT seconds instead of failing on the provider's 429s
+EXTRACTION_RATE_LIMIT_ENABLED = os.getenv('EXTRACTION_RATE_LIMIT_ENABLED', 'True').lower() == 'true'
+EXTRACTION_RATE_LIMIT_DIR = os.getenv('EXTRACTION_RATE_LIMIT_DIR', str(BASE_DIR / 'data' / 'ratelimit'))
+EXTRACTION_RATE_LIMIT_RPM = int(os.getenv('EXTRACTION_RATE_LIMIT_RPM', '500'))  # Requests per minute (0 = unlimited)
+EXTRACTION_RATE_LIMIT_TPM = int(os.getenv('EXTRACTION_RATE_LIMIT_TPM', '30000'))  # Estimated tokens per minute (0 = unlimited)
+EXTRACTION_MAX_IN_FLIGHT = int(os.getenv('EXTRACTION_MAX_IN_FLIGHT', '8'))  # Concurrent calls across workers (0 = unlimited)
+EXTRACTION_RATE_LIMIT_MAX_WAIT = float(os.getenv('EXTRACTION_RATE_LIMIT_MAX_WAIT', '20'))  # Seconds
+
+# Resilient extraction calls: one deadline per call covering queueing, retries and backoff,
+# jittered retries on 429/5xx/timeouts, and a circuit breaker shared by all workers (state in EXTRACTION_RATE_LIMIT_DIR)
+EXTRACTION_DEADLINE_SECONDS = float(os.getenv('EXTRACTION_DEADLINE_SECONDS', '45'))  # Below gunicorn's 60s worker timeout
+EXTRACTION_MAX_RETRIES = int(os.getenv('EXTRACTION_MAX_RETRIES', '2'))
+EXTRACTION_RETRY_BASE_DELAY = float(os.getenv('EXTRACTION_RETRY_BASE_DELAY', '0.5'))  # Seconds, doubled per retry
+EXTRACTION_RETRY_MAX_DELAY = float(os.getenv('EXTRACTION_RETRY_MAX_DELAY', '8'))  # Seconds
+EXTRACTION_CIRCUIT_ENABLED = os.getenv('EXTRACTION_CIRCUIT_ENABLED', 'True').lower() == 'true'
+EXTRACTION_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('EXTRACTION_CIRCUIT_FAILURE_THRESHOLD', '5'))  # Consecutive failed attempts
+EXTRACTION_CIRCUIT_RESET_SECONDS = float(os.getenv('EXTRACTION_CIRCUIT_RESET_SECONDS', '30'))  # Fail fast this long before probing
+
+# Pooled keep-alive HTTP client for extraction calls
+# Every request thread and background worker may hold a connection at the same time
+GUNICORN_THREADS = int(os.getenv('GUNICORN_THREADS', '2'))
+EXTRACTION_HTTP_POOL_SIZE = int(os.getenv('EXTRACTION_HTTP_POOL_SIZE', str(GUNICORN_THREADS + EXTRACTION_MAX_WORKERS)))
+EXTRACTION_CONNECT_TIMEOUT = float(os.getenv('EXTRACTION_CONNECT_TIMEOUT', '5'))
+EXTRACTION_READ_TIMEOUT = float(os.getenv('EXTRACTION_READ_TIMEOUT', '50'))  # Per attempt, capped by EXTRACTION_DEADLINE_SECONDS
+EXTRACTION_HTTP_WARMUP = os.getenv('EXTRACTION_HTTP_WARMUP', 'True').lower() == 'true'
+
+# Deployment mode: 'wsgi' (gunicorn gthread workers) or 'asgi' (gunicorn with uvicorn workers)
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi').lower()
+# Serve the extraction views as async views so slow model calls don't hold a worker thread
+ASYNC_EXTRACTION_VIEWS = os.getenv('ASYNC_EXTRACTION_VIEWS', str(SERVER_MODE == 'asgi')).lower() == 'true'
+
+# Downscale and re-encode receipt photos before sending them to the vision model
+EXTRACTION_IMAGE_PREPROCESS = os.getenv('EXTRACTION_IMAGE_PREPROCESS', 'True').lower() == 'true'
+EXTRACTION_IMAGE_MAX_SIDE = int(os.getenv('EXTRACTION_IMAGE_MAX_SIDE', '2048'))  # Pixels, longest side
+EXTRACTION_IMAGE_JPEG_QUALITY = int(os.getenv('EXTRACTION_IMAGE_JPEG_QUALITY', '85'))
+
+# Content-hash keyed cache of extraction results (re-uploaded receipts cost nothing)
+EXTRACTION_CACHE_ENABLED = os.getenv('EXTRACTION_CACHE_ENABLED', 'True').lower() == 'true'
+EXTRACTION_CACHE_MAX_AGE_DAYS = int(os.getenv('EXTRACTION_CACHE_MAX_AGE_DAYS', '180'))
+EXTRACTION_CACHE_MAX_BYTES = int(os.getenv('EXTRACTION_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))  # 50MB
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
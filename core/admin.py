@@ -1,5 +1,9 @@
+from datetime import timedelta
 from django.contrib import admin
-from .models import ReceiptSession, ExtractedFile, ReceiptItem, SortedItem, SessionAggregation
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+from .models import ReceiptSession, ExtractedFile, ReceiptItem, SortedItem, SessionAggregation, ExtractionCacheEntry, IngestionJob, ChunkedUpload
 
 @admin.register(ReceiptSession)
 class ReceiptSessionAdmin(admin.ModelAdmin):
@@ -8,11 +12,75 @@ class ReceiptSessionAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'receipt_zip_filename']
     readonly_fields = ['created_at', 'updated_at']
 
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list, or None when it is empty."""
+    if not sorted_values:
+        return None
+    rank = max(1, round(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize_extractions(rows):
+    """Summarize (seconds, cost, prompt_tokens, completion_tokens, upload_bytes, retries) rows for the report."""
+    seconds = sorted(row[0] for row in rows if row[0] is not None)
+    costs = sorted(float(row[1]) for row in rows)
+    count = len(rows)
+    return {
+        'count': count,
+        'p50_seconds': percentile(seconds, 0.5),
+        'p95_seconds': percentile(seconds, 0.95),
+        'p50_cost': percentile(costs, 0.5),
+        'p95_cost': percentile(costs, 0.95),
+        'total_cost': sum(costs),
+        'avg_prompt_tokens': sum(row[2] or 0 for row in rows) / count if count else 0,
+        'avg_completion_tokens': sum(row[3] or 0 for row in rows) / count if count else 0,
+        'avg_upload_kb': sum(row[4] or 0 for row in rows) / count / 1024 if count else 0,
+        'retries': sum(row[5] for row in rows),
+    }
+
 @admin.register(ExtractedFile)
 class ExtractedFileAdmin(admin.ModelAdmin):
-    list_display = ['filename', 'session', 'is_processed', 'is_skipped', 'extraction_cost', 'extracted_at']
-    list_filter = ['is_processed', 'is_skipped', 'extracted_at']
+    list_display = ['filename', 'session', 'is_processed', 'is_skipped', 'extraction_cost', 'extraction_seconds', 'extraction_model', 'extraction_cache_hit', 'extracted_at']
+    list_filter = ['is_processed', 'is_skipped', 'extraction_model', 'extraction_cache_hit', 'extracted_at']
     search_fields = ['filename', 'session__user__username']
+    readonly_fields = ['extraction_seconds', 'upload_bytes', 'prompt_tokens', 'completion_tokens', 'extraction_model', 'extraction_retries', 'extraction_cache_hit']
+    
+    # Sessions listed individually in the extraction report
+    report_session_limit = 20
+    # The report covers this many days of extractions, newest first up to the row limit
+    report_days = 30
+    report_row_limit = 10000
+    
+    def get_urls(self):
+        return [
+            path('report/', self.admin_site.admin_view(self.report_view), name='core_extractedfile_report'),
+        ] + super().get_urls()
+    
+    def report_view(self, request):
+        """Latency and cost percentiles per receipt, overall, per model and per recent session."""
+        fields = ['extraction_seconds', 'extraction_cost', 'prompt_tokens', 'completion_tokens', 'upload_bytes', 'extraction_retries']
+        # Only extraction runs record their wall time; files confirmed by hand also get extracted_at
+        since = timezone.now() - timedelta(days=self.report_days)
+        extracted = ExtractedFile.objects.filter(extraction_seconds__isnull=False, extracted_at__gte=since).order_by('-extracted_at')
+        rows = list(extracted.values_list('session_id', 'extraction_model', 'extraction_cache_hit', *fields)[:self.report_row_limit])
+        
+        by_model = {}
+        by_session = {}
+        for row in rows:
+            by_model.setdefault('cache hit' if row[2] else row[1], []).append(row[3:])
+            by_session.setdefault(row[0], []).append(row[3:])
+        recent_sessions = ReceiptSession.objects.filter(id__in=by_session).select_related('user').order_by('-created_at')[:self.report_session_limit]
+        
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Extraction report',
+            'report_days': self.report_days,
+            'truncated': len(rows) == self.report_row_limit,
+            'overall': summarize_extractions([row[3:] for row in rows]),
+            'models': [(model, summarize_extractions(model_rows)) for model, model_rows in sorted(by_model.items())],
+            'sessions': [(session, summarize_extractions(by_session[session.id])) for session in recent_sessions],
+        }
+        return TemplateResponse(request, 'admin/core/extractedfile/report.html', context)
 
 @admin.register(ReceiptItem)
 class ReceiptItemAdmin(admin.ModelAdmin):
@@ -31,3 +99,21 @@ class SessionAggregationAdmin(admin.ModelAdmin):
     list_display = ['session', 'grand_total', 'transfer_amount', 'transfer_direction', 'calculated_at']
     readonly_fields = ['calculated_at']
     search_fields = ['session__user__username']
+
+@admin.register(ExtractionCacheEntry)
+class ExtractionCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ['image_sha256', 'prompt_version', 'hit_count', 'size_bytes', 'created_at', 'last_used_at']
+    readonly_fields = ['created_at', 'last_used_at']
+    search_fields = ['image_sha256']
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'filename', 'offset', 'size', 'is_complete', 'updated_at']
+    list_filter = ['is_complete', 'created_at']
+    readonly_fields = ['created_at', 'updated_at']
+
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'session', 'zip_filename', 'status', 'members_extracted', 'members_total', 'files_registered', 'created_at', 'finished_at']
+    list_filter = ['status', 'created_at']
+    readonly_fields = ['created_at', 'finished_at']
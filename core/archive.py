@@ -0,0 +1,148 @@
+from pathlib import Path, PurePosixPath
+from types import SimpleNamespace
+import io
+import logging
+import os
+import struct
+import zipfile
+import zlib
+from django.conf import settings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Read receipt images straight out of a stored ZIP, without extracting them first.
+# Ingestion records where each member's local file header sits; reading then takes a
+# positioned read (pread) of the header to find the data, and streams the stored or
+# deflated bytes from there. Nothing is seeked on a shared file object, so many threads
+# can read members of the same archive at once.
+
+LOCAL_HEADER_FORMAT = '<4s5HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+# Member compression methods that can be read lazily; others are copied at ingestion
+READABLE_COMPRESSION = {zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED}
+
+# Compressed bytes read from the archive at a time
+READ_SIZE = 64 * 1024
+
+def get_archive_root():
+    archive_root = Path(settings.ARCHIVE_STORE_DIR)
+    archive_root.mkdir(parents=True, exist_ok=True)
+    return archive_root
+
+class ArchiveMember:
+    """A receipt image inside a stored ZIP; offers the parts of the Path API the views and extraction use."""
+
+    def __init__(self, archive_path, member_name, offset, compressed_size, size, compression, crc):
+        self.archive_path = Path(archive_path)
+        self.member_name = member_name
+        self.offset = offset
+        self.compressed_size = compressed_size
+        self.size = size
+        self.compression = compression
+        self.crc = crc
+
+    @classmethod
+    def for_file(cls, extracted_file):
+        return cls(
+            get_archive_root() / extracted_file.archive_path,
+            extracted_file.relative_path,
+            extracted_file.archive_offset,
+            extracted_file.archive_compressed_size,
+            extracted_file.archive_size,
+            extracted_file.archive_compression,
+            extracted_file.archive_crc,
+        )
+
+    @property
+    def name(self):
+        return PurePosixPath(self.member_name).name
+
+    @property
+    def suffix(self):
+        return PurePosixPath(self.member_name).suffix
+
+    def exists(self):
+        return self.archive_path.exists()
+
+    def is_file(self):
+        return self.exists()
+
+    def stat(self):
+        """Size of the image and modification time of its archive."""
+        return SimpleNamespace(st_size=self.size, st_mtime=self.archive_path.stat().st_mtime)
+
+    def open(self, mode='rb'):
+        if mode != 'rb':
+            raise ValueError("Archive members can only be opened for binary reading")
+        return io.BufferedReader(MemberReader(self), buffer_size=READ_SIZE)
+
+    def read_bytes(self):
+        with self.open() as member_file:
+            return member_file.read()
+
+    def __str__(self):
+        return f"{self.archive_path}!{self.member_name}"
+
+    def __repr__(self):
+        return f"ArchiveMember({str(self)!r})"
+
+class MemberReader(io.RawIOBase):
+    """Raw stream over one member's data, decompressed on the fly and checked against its CRC."""
+
+    def __init__(self, member):
+        self.member = member
+        self._fd = os.open(member.archive_path, os.O_RDONLY)
+        try:
+            header = os.pread(self._fd, LOCAL_HEADER_SIZE, member.offset)
+            if len(header) != LOCAL_HEADER_SIZE or header[:4] != LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipFile(f"No local file header for {member}")
+            # Name and extra field lengths are the last two fields; the local extra field may differ from the central one
+            name_length, extra_length = struct.unpack(LOCAL_HEADER_FORMAT, header)[-2:]
+        except BaseException:
+            os.close(self._fd)
+            raise
+        self._position = member.offset + LOCAL_HEADER_SIZE + name_length + extra_length
+        self._remaining = member.compressed_size
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member.compression == zipfile.ZIP_DEFLATED else None
+        self._pending = b''
+        self._crc = 0
+        self._produced = 0
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while not self._pending and self._remaining:
+            raw = os.pread(self._fd, min(READ_SIZE, self._remaining), self._position)
+            if not raw:
+                raise zipfile.BadZipFile(f"Archive ends inside {self.member}")
+            self._position += len(raw)
+            self._remaining -= len(raw)
+            if self._decompressor is None:
+                self._pending = raw
+            else:
+                self._pending = self._decompressor.decompress(raw)
+                if not self._remaining:
+                    self._pending += self._decompressor.flush()
+            self._crc = zlib.crc32(self._pending, self._crc)
+            self._produced += len(self._pending)
+            if self._produced > self.member.size:
+                raise zipfile.BadZipFile(f"{self.member} is larger than its recorded size")
+
+        if not self._pending and not self._remaining and self._crc != self.member.crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {self.member}")
+
+    def readinto(self, buffer):
+        self._fill()
+        count = min(len(buffer), len(self._pending))
+        buffer[:count] = self._pending[:count]
+        self._pending = self._pending[count:]
+        return count
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
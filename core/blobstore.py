@@ -0,0 +1,76 @@
+from pathlib import Path
+import hashlib
+import logging
+import mimetypes
+import os
+import tempfile
+from django.conf import settings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Content-addressed store for receipt images.
+# Each distinct image is written once, to IMAGE_STORE_DIR/<aa>/<bb>/<sha256>, where aa and bb
+# are the first two byte pairs of its hash. Sessions and users that upload the same photo share
+# the file, and the two shard levels keep every directory small even with millions of images.
+
+# Bytes copied at a time while streaming an image into the store
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Leading bytes of the image formats receipts arrive in
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+]
+
+def get_store_root():
+    store_root = Path(settings.IMAGE_STORE_DIR)
+    store_root.mkdir(parents=True, exist_ok=True)
+    return store_root
+
+def get_blob_path(sha256):
+    """Return the on-disk path of the image with the given content hash."""
+    return Path(settings.IMAGE_STORE_DIR) / sha256[:2] / sha256[2:4] / sha256
+
+def get_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+def sniff_content_type(image_bytes, filename=''):
+    """Return the MIME type of an image from its leading bytes, falling back to its filename."""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if image_bytes.startswith(signature):
+            return content_type
+    return mimetypes.guess_type(filename)[0] or 'image/jpeg'
+
+def store_stream(source):
+    """Copy a readable binary stream into the store; returns (sha256, size_bytes).
+
+    The bytes are hashed while they are written to a temporary file in the store,
+    which is then renamed to its content address. If the image is already stored
+    the copy is dropped, so storing is idempotent and safe across workers.
+    """
+    digest = hashlib.sha256()
+    size_bytes = 0
+    fd, temp_path = tempfile.mkstemp(dir=get_store_root(), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as destination:
+            while True:
+                block = source.read(COPY_BUFFER_SIZE)
+                if not block:
+                    break
+                digest.update(block)
+                destination.write(block)
+                size_bytes += len(block)
+
+        sha256 = digest.hexdigest()
+        blob_path = get_blob_path(sha256)
+        if blob_path.exists():
+            Path(temp_path).unlink()
+            logger.debug(f"Image {sha256[:12]} already stored")
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(temp_path, blob_path)
+        return sha256, size_bytes
+    except BaseException:
+        Path(temp_path).unlink(missing_ok=True)
+        raise
@@ -5,4 +5,10 @@ def version_context(request):
     """Add APPLICATION_VERSION to template context."""
     return {
         'APPLICATION_VERSION': os.getenv('APPLICATION_VERSION')
-    } 
\ No newline at end of file
+    } 
+
+def extraction_context(request):
+    """Add extraction feature flags to template context."""
+    return {
+        'STREAMING_EXTRACTION': settings.EXTRACTION_STREAMING
+    }
@@ -0,0 +1,136 @@
+from pathlib import Path
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+from . import metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Downscaled copies of receipt images for the browser.
+# Each variant is rendered once per image and kept under IMAGE_DERIVATIVE_DIR, named by a key
+# derived from the source path, size and modification time, so a changed source gets new
+# derivatives. The directory is bounded by IMAGE_DERIVATIVE_CACHE_MAX_BYTES: a file's mtime is
+# bumped when it is served, and the least recently used files are removed first. The same
+# bookkeeping bounds the cache of images prepared for the extraction API (PREPROCESSED_CACHE_DIR).
+
+# Seconds between mtime bumps of a served derivative (keeps hot hits free of writes)
+TOUCH_INTERVAL = 60
+
+# Shrink the cache to this share of its limit when evicting, so eviction runs rarely
+EVICTION_TARGET = 0.9
+
+# Approximate size of each cache directory, tracked per process after one scan
+_cache_bytes = {}
+_cache_lock = threading.Lock()
+
+def get_variants():
+    """Return {variant name: longest side in pixels}."""
+    return {
+        'thumb': settings.IMAGE_THUMBNAIL_SIZE,
+        'screen': settings.IMAGE_SCREEN_SIZE,
+    }
+
+def get_source_key(image_path):
+    """Key identifying the current content of an image (a Path or an ArchiveMember)."""
+    stat = image_path.stat()
+    return hashlib.sha256(f"{image_path}:{stat.st_size}:{stat.st_mtime}".encode()).hexdigest()
+
+def get_variant_tag(variant):
+    """Name of a variant's current rendering settings, so changing them gives new files and ETags."""
+    return f"{variant}_{get_variants()[variant]}_q{settings.IMAGE_DERIVATIVE_JPEG_QUALITY}"
+
+def get_derivative_path(source_key, variant):
+    return Path(settings.IMAGE_DERIVATIVE_DIR) / source_key[:2] / f"{source_key}_{get_variant_tag(variant)}.jpg"
+
+def get_derivative(image_path, variant):
+    """Return the path of a variant of an image, rendering it on first use; None if it cannot be rendered."""
+    derivative_path = get_derivative_path(get_source_key(image_path), variant)
+    try:
+        stat = derivative_path.stat()
+    except FileNotFoundError:
+        return render_derivative(image_path, variant, derivative_path)
+
+    metrics.increment('image_derivative_hits')
+    if not touch(derivative_path, stat):
+        # Evicted by another worker just now
+        return render_derivative(image_path, variant, derivative_path)
+    return derivative_path
+
+def touch(cache_path, stat):
+    """Mark a cached file as recently used; returns False if it has been evicted."""
+    if time.time() - stat.st_mtime > TOUCH_INTERVAL:
+        try:
+            os.utime(cache_path)
+        except FileNotFoundError:
+            return False
+    return True
+
+def render_derivative(image_path, variant, derivative_path):
+    max_side = get_variants()[variant]
+    try:
+        with image_path.open('rb') as image_file, Image.open(image_file) as image:
+            # Apply the phone's rotation flag before dropping EXIF data
+            image = ImageOps.exif_transpose(image)
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=settings.IMAGE_DERIVATIVE_JPEG_QUALITY, optimize=True, progressive=True)
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Could not render {variant} variant of {image_path}: {str(e)}")
+        return None
+
+    derivative_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = derivative_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    temp_path.write_bytes(buffer.getvalue())
+    os.replace(temp_path, derivative_path)
+    metrics.increment('image_derivative_renders')
+    logger.debug(f"Rendered {variant} variant of {image_path}: {buffer.tell()} bytes")
+
+    add_to_cache(buffer.tell())
+    return derivative_path
+
+def add_to_cache(size_bytes, cache_dir=None, max_bytes=None):
+    """Account for a new cache file and evict least recently used ones once the cache is over its limit.
+
+    cache_dir and max_bytes default to the derivative cache.
+    """
+    cache_dir = Path(cache_dir or settings.IMAGE_DERIVATIVE_DIR)
+    max_bytes = settings.IMAGE_DERIVATIVE_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    with _cache_lock:
+        if cache_dir not in _cache_bytes:
+            _cache_bytes[cache_dir] = sum(entry.stat().st_size for entry in cache_dir.rglob('*.jpg'))
+        else:
+            _cache_bytes[cache_dir] += size_bytes
+        if _cache_bytes[cache_dir] > max_bytes:
+            _cache_bytes[cache_dir] = evict_cache_files(cache_dir, max_bytes)
+
+def evict_cache_files(cache_dir, max_bytes):
+    """Remove the least recently used files of a cache until it is below its target size; returns the size kept."""
+    entries = []
+    for entry in Path(cache_dir).rglob('*.jpg'):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry))
+
+    total_bytes = sum(size for _, size, _ in entries)
+    target_bytes = max_bytes * EVICTION_TARGET
+    removed = 0
+    for _, size, entry in sorted(entries, key=lambda item: item[0]):
+        if total_bytes <= target_bytes:
+            break
+        entry.unlink(missing_ok=True)
+        total_bytes -= size
+        removed += 1
+
+    metrics.increment('image_cache_evictions', removed)
+    logger.info(f"Evicted {removed} files from {cache_dir}, {total_bytes} bytes kept")
+    return total_bytes
@@ -0,0 +1,1370 @@
+from pathlib import Path
+from datetime import timedelta
+from concurrent.futures import Future, ThreadPoolExecutor
+from decimal import Decimal
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+import re
+import ast
+import logging
+import threading
+import time
+import traceback
+import weakref
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from PIL import Image, ImageOps, UnidentifiedImageError
+from . import blobstore, derivatives, metrics, ratelimit, resilience
+from .archive import ArchiveMember
+from .models import ReceiptSession, ExtractedFile, ExtractionCacheEntry
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+EXTRACTION_MODEL = "gpt-4o"
+
+EXTRACTION_PROMPT = (
+    "Analyze this image of a receipt. Extract the items and their prices. "
+    "Ensure to account for discounts, which are often indicated by a minus sign "
+    "in front of the price or as a separate line item. Subtract any discounts from "
+    "the corresponding item's price. Return the result as a Python list of dictionaries, "
+    "where each dictionary has 'item' and 'price' keys. The 'price' should be a float. "
+    "Do not include any explanatory text, just the Python code for the list of dictionaries, "
+    "without the markdown formatting of the code."
+)
+
+# Prompt and schema for structured-output mode (settings.EXTRACTION_STRUCTURED_OUTPUT),
+# where the API is asked for JSON that must match the schema
+STRUCTURED_EXTRACTION_PROMPT = (
+    "Analyze this image of a receipt. Extract the items and their prices. "
+    "Ensure to account for discounts, which are often indicated by a minus sign "
+    "in front of the price or as a separate line item. Subtract any discounts from "
+    "the corresponding item's price. Return one entry per item with its final price as a number."
+)
+
+EXTRACTION_RESPONSE_SCHEMA = {
+    "name": "receipt_items",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "item": {"type": "string"},
+                        "price": {"type": "number"}
+                    },
+                    "required": ["item", "price"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["items"],
+        "additionalProperties": False
+    }
+}
+
+# Batch mode (settings.EXTRACTION_BATCH_SIZE > 1): several receipts in one call, answered per receipt
+BATCH_EXTRACTION_PROMPT = (
+    "The following images are {count} separate receipts, each preceded by its label "
+    "(Receipt 1 to Receipt {count}). For every receipt, extract the items and their prices. "
+    "Ensure to account for discounts, which are often indicated by a minus sign "
+    "in front of the price or as a separate line item. Subtract any discounts from "
+    "the corresponding item's price. Return a JSON object with a 'receipts' list containing, "
+    "for every receipt, its 'receipt' number and its 'items', a list of objects with 'item' and "
+    "'price' keys where 'price' is a number. Do not include any explanatory text and no markdown formatting."
+)
+
+BATCH_RESPONSE_SCHEMA = {
+    "name": "receipt_batch",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "receipts": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "receipt": {"type": "integer"},
+                        "items": EXTRACTION_RESPONSE_SCHEMA["schema"]["properties"]["items"]
+                    },
+                    "required": ["receipt", "items"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["receipts"],
+        "additionalProperties": False
+    }
+}
+
+# Output token budget per receipt in a batch, and the model's output limit
+BATCH_MAX_TOKENS_PER_RECEIPT = 4000
+MAX_OUTPUT_TOKENS = 16384
+
+# Markdown code fences the model sometimes wraps its answer in
+CODE_FENCE_PATTERN = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+# Single flat {...} objects, used to salvage items from an answer that does not parse as a whole
+ITEM_OBJECT_PATTERN = re.compile(r"\{[^{}]*\}")
+
+# Rough token costs used to charge the shared tokens-per-minute budget before a call.
+# A high-detail image is billed at most 85 + 170 per 512px tile (6 tiles after the API's own scaling),
+# and receipts rarely produce more than a few hundred output tokens.
+ESTIMATED_IMAGE_TOKENS = 1105
+ESTIMATED_OUTPUT_TOKENS = 500
+
+# Shared worker pool for background extractions (created lazily per process)
+_executor = None
+_executor_lock = threading.Lock()
+
+# Keep-alive HTTP session for extraction traffic (created lazily per process)
+_http_session = None
+_http_session_lock = threading.Lock()
+
+# Async HTTP clients for ASGI deployments, one per event loop
+_async_http_clients = weakref.WeakKeyDictionary()
+
+# Configured extraction backend instance (created lazily per process)
+_backend = None
+_backend_lock = threading.Lock()
+
+# IDs of files that currently have a background extraction queued or running, so they are not queued twice
+_pending_file_ids = set()
+_pending_lock = threading.Lock()
+
+# Extractions running in this process, keyed by (session_id, file_id); duplicate callers share the Future
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Seconds between checks while another worker process holds a file's extraction lease
+LEASE_POLL_INTERVAL = 0.25
+
+def get_image_path(session, extracted_file):
+    """Return the on-disk path of a receipt image, or an ArchiveMember for one still inside its ZIP."""
+    if extracted_file.blob_id:
+        return blobstore.get_blob_path(extracted_file.blob_id)
+    if extracted_file.archive_path:
+        return ArchiveMember.for_file(extracted_file)
+    # Files ingested before the image store live in a directory named like their ZIP
+    extract_dir_name = Path(session.receipt_zip_filename).stem
+    return Path(settings.BASE_DIR) / 'data' / '1_unzipped' / extract_dir_name / extracted_file.relative_path
+
+class ExtractionBackend:
+    """Sends an OpenAI-style chat completions payload and returns the decoded JSON response.
+    
+    Subclasses set the default endpoint and whether an API key is needed;
+    settings.EXTRACTION_API_URL overrides the endpoint for any backend.
+    """
+    name = 'base'
+    default_url = None
+    requires_api_key = True
+    
+    def __init__(self):
+        self.url = settings.EXTRACTION_API_URL or self.default_url
+    
+    def get_headers(self, api_key):
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+        return headers
+    
+    def get_retry_delay(self, response, error, attempt, deadline):
+        """Record an attempt's outcome; return the seconds to wait before retrying, or None to stop.
+        
+        429s and 5xx answers, timeouts and connection errors are retried with jittered
+        backoff while retries and the call's deadline allow. Only 5xx answers and transport
+        errors count toward the circuit breaker; a 429 means the provider is healthy but busy.
+        """
+        if error is None and not resilience.is_retryable_status(response.status_code):
+            resilience.record_success()
+            return None
+        
+        if error is None and response.status_code == 429:
+            reason = "HTTP 429"
+            # Rate limited anyway (e.g. another host shares the key); hold every worker back and queue again
+            retry_after = get_retry_after(response)
+            ratelimit.pause(retry_after)
+            delay = max(retry_after, resilience.get_backoff_delay(attempt))
+        else:
+            reason = str(error) if error is not None else f"HTTP {response.status_code}"
+            resilience.record_failure(reason)
+            delay = resilience.get_backoff_delay(attempt)
+        
+        if attempt >= settings.EXTRACTION_MAX_RETRIES or not deadline.allows(delay):
+            return None
+        metrics.increment('extraction_retries')
+        logger.warning(f"Retrying {self.name} extraction call in {delay:.1f}s after {reason}")
+        return delay
+    
+    def raise_for_failure(self, response, error):
+        """Raise for a call that did not succeed; provider trouble surfaces as ExtractionUnavailable."""
+        if error is not None:
+            logger.error(f"{self.name} API request failed: {error}")
+            raise resilience.ExtractionUnavailable("The extraction service is not responding. Please try again in a minute.") from error
+        
+        logger.error(f"API error response: {response.text}")
+        if resilience.is_retryable_status(response.status_code):
+            raise resilience.ExtractionUnavailable(f"The extraction service is busy (HTTP {response.status_code}). Please try again in a minute.")
+        raise Exception(f"{self.name} API error: {response.status_code} - {response.text}")
+    
+    def complete(self, payload, api_key, telemetry=None):
+        estimated_tokens = estimate_request_tokens(payload)
+        deadline = resilience.Deadline()
+        attempt = 0
+        try:
+            while True:
+                resilience.before_attempt(deadline)
+                response, error = None, None
+                with ratelimit.limited(estimated_tokens, max_wait=deadline.remaining()):
+                    logger.info(f"Making API request to {self.name} backend for image extraction")
+                    try:
+                        response = get_http_session().post(self.url, headers=self.get_headers(api_key), json=payload, timeout=get_http_timeout(deadline))
+                        logger.debug(f"API response status: {response.status_code}")
+                    except (requests.ConnectionError, requests.Timeout) as e:
+                        error = e
+                delay = self.get_retry_delay(response, error, attempt, deadline)
+                if delay is None:
+                    break
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            resilience.release_probe(deadline)
+        record_retries(telemetry, attempt)
+        
+        if error is not None or response.status_code != 200:
+            self.raise_for_failure(response, error)
+        
+        return response.json()
+    
+    async def acomplete(self, payload, api_key, telemetry=None):
+        estimated_tokens = estimate_request_tokens(payload)
+        deadline = resilience.Deadline()
+        attempt = 0
+        try:
+            while True:
+                # The breaker state is shared through a flock'd file, so keep it off the event loop
+                await asyncio.to_thread(resilience.before_attempt, deadline)
+                response, error = None, None
+                async with ratelimit.alimited(estimated_tokens, max_wait=deadline.remaining()):
+                    logger.info(f"Making async API request to {self.name} backend for image extraction")
+                    connect_timeout, read_timeout = get_http_timeout(deadline)
+                    try:
+                        response = await get_async_http_client().post(
+                            self.url, headers=self.get_headers(api_key), json=payload,
+                            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+                        )
+                        logger.debug(f"API response status: {response.status_code}")
+                    except httpx.TransportError as e:
+                        error = e
+                delay = await asyncio.to_thread(self.get_retry_delay, response, error, attempt, deadline)
+                if delay is None:
+                    break
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            await asyncio.to_thread(resilience.release_probe, deadline)
+        record_retries(telemetry, attempt)
+        
+        if error is not None or response.status_code != 200:
+            self.raise_for_failure(response, error)
+        
+        return response.json()
+
+    def stream(self, payload, api_key, telemetry=None):
+        """Yield the decoded chunks of a streamed (server-sent events) completion.
+        
+        Only the request is retried; once chunks have been yielded a failure ends the stream.
+        """
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        estimated_tokens = estimate_request_tokens(payload)
+        deadline = resilience.Deadline()
+        attempt = 0
+        try:
+            while True:
+                resilience.before_attempt(deadline)
+                response, error = None, None
+                with ratelimit.limited(estimated_tokens, max_wait=deadline.remaining()):
+                    logger.info(f"Making streaming API request to {self.name} backend for image extraction")
+                    try:
+                        response = get_http_session().post(self.url, headers=self.get_headers(api_key), json=payload, timeout=get_http_timeout(deadline), stream=True)
+                        logger.debug(f"API response status: {response.status_code}")
+                    except (requests.ConnectionError, requests.Timeout) as e:
+                        error = e
+                    if error is None and response.status_code == 200:
+                        resilience.record_success()
+                        record_retries(telemetry, attempt)
+                        try:
+                            for chunk in iter_stream_chunks(response):
+                                deadline.check()
+                                yield chunk
+                        except (requests.ConnectionError, requests.Timeout) as e:
+                            resilience.record_failure(str(e))
+                            self.raise_for_failure(None, e)
+                        finally:
+                            response.close()
+                        return
+                delay = self.get_retry_delay(response, error, attempt, deadline)
+                if delay is None:
+                    break
+                if response is not None:
+                    # Hand the unread error answer's connection back to the pool before waiting
+                    response.close()
+                time.sleep(delay)
+                attempt += 1
+        finally:
+            resilience.release_probe(deadline)
+        record_retries(telemetry, attempt)
+        
+        try:
+            self.raise_for_failure(response, error)
+        finally:
+            if response is not None:
+                response.close()
+
+class OpenAIBackend(ExtractionBackend):
+    """The OpenAI chat completions API."""
+    name = 'OpenAI'
+    default_url = "https://api.openai.com/v1/chat/completions"
+
+class StandInBackend(ExtractionBackend):
+    """Local stand-in server for load tests and CI (see the run_standin_extractor command)."""
+    name = 'Stand-in'
+    default_url = "http://127.0.0.1:8765/v1/chat/completions"
+    requires_api_key = False
+
+def estimate_request_tokens(payload):
+    """Estimate the tokens a chat completions payload will use, for the shared rate limiter."""
+    text_chars = 0
+    image_count = 0
+    for message in payload['messages']:
+        for part in message['content']:
+            if part['type'] == 'text':
+                text_chars += len(part['text'])
+            elif part['type'] == 'image_url':
+                image_count += 1
+    # About four characters per token for English text
+    return text_chars // 4 + image_count * ESTIMATED_IMAGE_TOKENS + min(payload.get('max_tokens', ESTIMATED_OUTPUT_TOKENS), ESTIMATED_OUTPUT_TOKENS)
+
+def iter_stream_chunks(response):
+    """Decode the "data: {...}" lines of a server-sent events response until [DONE]."""
+    response.encoding = 'utf-8'
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            return
+        yield json.loads(data)
+
+def new_telemetry():
+    """Return an empty per-extraction telemetry record, filled in along the extraction path."""
+    return {
+        'seconds': None,
+        'upload_bytes': 0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'model': '',
+        'retries': 0,
+        'cache_hit': False,
+    }
+
+def record_retries(telemetry, retries):
+    if telemetry is not None:
+        telemetry['retries'] = retries
+
+def record_usage(telemetry, response_json):
+    """Copy the token usage and the answering model from an API response into a telemetry record."""
+    if telemetry is None:
+        return
+    usage = response_json.get('usage') or {}
+    telemetry['prompt_tokens'] = usage.get('prompt_tokens', 0)
+    telemetry['completion_tokens'] = usage.get('completion_tokens', 0)
+    telemetry['model'] = response_json.get('model') or EXTRACTION_MODEL
+
+def get_retry_after(response):
+    """Return the provider's Retry-After delay in seconds, defaulting to one second."""
+    try:
+        return max(float(response.headers.get('Retry-After', '1')), 0.0)
+    except ValueError:
+        return 1.0
+
+def get_extraction_backend():
+    """Return the backend selected by settings.EXTRACTION_BACKEND."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = import_string(settings.EXTRACTION_BACKEND)()
+            logger.info(f"Using {_backend.name} extraction backend at {_backend.url}")
+        return _backend
+
+def get_http_session():
+    """Return the process-wide pooled session so extraction calls reuse TLS connections."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=settings.EXTRACTION_HTTP_POOL_SIZE,
+                pool_block=False
+            )
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+            logger.debug(f"Created extraction HTTP session with pool size {settings.EXTRACTION_HTTP_POOL_SIZE}")
+        return _http_session
+
+def get_async_http_client():
+    """Return the pooled async client for the running event loop.
+    
+    httpx clients are bound to the loop they first run on, so each loop
+    (normally one per ASGI worker process) gets its own client.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.EXTRACTION_READ_TIMEOUT, connect=settings.EXTRACTION_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_keepalive_connections=settings.EXTRACTION_HTTP_POOL_SIZE)
+        )
+        _async_http_clients[loop] = client
+        logger.debug(f"Created async extraction HTTP client with pool size {settings.EXTRACTION_HTTP_POOL_SIZE}")
+    return client
+
+def get_http_timeout(deadline=None):
+    """Return the (connect, read) timeout tuple for extraction calls, capped by the call's deadline."""
+    connect_timeout, read_timeout = settings.EXTRACTION_CONNECT_TIMEOUT, settings.EXTRACTION_READ_TIMEOUT
+    if deadline is not None:
+        remaining = max(deadline.remaining(), 0.1)
+        connect_timeout, read_timeout = min(connect_timeout, remaining), min(read_timeout, remaining)
+    return (connect_timeout, read_timeout)
+
+def warm_up_http_client():
+    """Open a connection to the extraction API in the background so the first receipt skips DNS/TLS setup."""
+    if not settings.EXTRACTION_HTTP_WARMUP:
+        return
+    
+    parts = urlsplit(get_extraction_backend().url)
+    warmup_url = f"{parts.scheme}://{parts.netloc}/"
+    
+    def _warm_up():
+        try:
+            get_http_session().head(warmup_url, timeout=get_http_timeout())
+            logger.info(f"Warmed up extraction HTTP connection to {parts.netloc}")
+        except requests.RequestException as e:
+            logger.warning(f"Extraction HTTP warm-up failed: {str(e)}")
+    
+    threading.Thread(target=_warm_up, name='extraction-warmup', daemon=True).start()
+
+def prepare_image_for_upload(image_bytes, image_sha256, image_path):
+    """Downscale and re-encode a receipt photo for the vision model.
+    
+    Returns the bytes to upload and their MIME type. Prepared images are cached
+    on disk by content hash and settings, so each file is only processed once;
+    the cache is bounded by PREPROCESSED_CACHE_MAX_BYTES, least recently used first.
+    """
+    # Stored images have no file extension, so look at the bytes
+    original_mime_type = blobstore.sniff_content_type(image_bytes, str(image_path))
+    if not settings.EXTRACTION_IMAGE_PREPROCESS:
+        return image_bytes, original_mime_type
+    
+    max_side = settings.EXTRACTION_IMAGE_MAX_SIDE
+    quality = settings.EXTRACTION_IMAGE_JPEG_QUALITY
+    cache_dir = Path(settings.PREPROCESSED_CACHE_DIR)
+    cache_path = cache_dir / f"{image_sha256}_{max_side}_q{quality}.jpg"
+    
+    try:
+        prepared_bytes = cache_path.read_bytes()
+        derivatives.touch(cache_path, cache_path.stat())
+        logger.debug(f"Using preprocessed image from cache: {cache_path.name}")
+    except FileNotFoundError:
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                # Apply the phone's rotation flag before dropping EXIF data
+                image = ImageOps.exif_transpose(image)
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+                
+                buffer = io.BytesIO()
+                image.save(buffer, format='JPEG', quality=quality, optimize=True)
+                prepared_bytes = buffer.getvalue()
+        except (UnidentifiedImageError, OSError) as e:
+            logger.warning(f"Could not preprocess {image_path}, uploading original: {str(e)}")
+            return image_bytes, original_mime_type
+        
+        # Keep the original when re-encoding does not help (already small JPEGs)
+        if len(prepared_bytes) >= len(image_bytes) and original_mime_type == 'image/jpeg':
+            prepared_bytes = image_bytes
+        
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = cache_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(prepared_bytes)
+        os.replace(temp_path, cache_path)
+        derivatives.add_to_cache(len(prepared_bytes), cache_dir, settings.PREPROCESSED_CACHE_MAX_BYTES)
+    
+    bytes_saved = len(image_bytes) - len(prepared_bytes)
+    metrics.increment('upload_bytes_original', len(image_bytes))
+    metrics.increment('upload_bytes_sent', len(prepared_bytes))
+    metrics.increment('upload_bytes_saved', bytes_saved)
+    logger.info(f"Prepared {image_path} for upload: {len(image_bytes)} -> {len(prepared_bytes)} bytes ({bytes_saved} saved)")
+    
+    return prepared_bytes, 'image/jpeg'
+
+def read_image_for_extraction(image_path, telemetry=None, bypass_cache=False):
+    """Read an image for extraction.
+    
+    Returns (image_sha256, cached_items, image_url). On a cache hit the cached
+    items are returned and image_url is None; otherwise image_url is the
+    prepared image as a data URL. With bypass_cache (a forced re-extract) the
+    cached answer for the image is dropped instead, so the new call replaces it.
+    """
+    # Read the image once; the bytes are both hashed for the cache and encoded for the API.
+    # image_path is a Path or an ArchiveMember read straight from the uploaded ZIP
+    image_bytes = image_path.read_bytes()
+    
+    # Identical images extracted with the same prompt/model cost nothing
+    image_sha256 = hashlib.sha256(image_bytes).hexdigest()
+    if bypass_cache:
+        forget_cached_extraction(image_sha256)
+    else:
+        cached_items = get_cached_extraction(image_sha256)
+        if cached_items is not None:
+            logger.info(f"Extraction cache hit for {image_path} ({image_sha256[:12]})")
+            if telemetry is not None:
+                telemetry['cache_hit'] = True
+            return image_sha256, cached_items, None
+    
+    # Downscale and encode the image
+    logger.debug("Preparing and encoding image...")
+    upload_bytes, mime_type = prepare_image_for_upload(image_bytes, image_sha256, image_path)
+    if telemetry is not None:
+        telemetry['upload_bytes'] += len(upload_bytes)
+    encoded_image = base64.b64encode(upload_bytes).decode('utf-8')
+    logger.debug(f"Image encoded successfully. Length: {len(encoded_image)}")
+    return image_sha256, None, f"data:{mime_type};base64,{encoded_image}"
+
+def build_extraction_request(image_path, telemetry=None, bypass_cache=False):
+    """Read an image and build the API payload for it.
+    
+    Returns (image_sha256, cached_items, payload). On a cache hit the cached
+    items are returned and payload is None.
+    """
+    image_sha256, cached_items, image_url = read_image_for_extraction(image_path, telemetry, bypass_cache)
+    if cached_items is not None:
+        return image_sha256, cached_items, None
+
+    # Prepare the API request
+    payload = {
+        "model": EXTRACTION_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": get_extraction_prompt()
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": 5000
+    }
+    if settings.EXTRACTION_STRUCTURED_OUTPUT:
+        payload["response_format"] = {"type": "json_schema", "json_schema": EXTRACTION_RESPONSE_SCHEMA}
+    return image_sha256, None, payload
+
+def get_extraction_prompt():
+    """Return the prompt for the configured output mode."""
+    return STRUCTURED_EXTRACTION_PROMPT if settings.EXTRACTION_STRUCTURED_OUTPUT else EXTRACTION_PROMPT
+
+def _load_literal(text):
+    """Parse JSON, falling back to a Python literal (the free-text prompt asks for a Python list)."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
+
+def _parse_price(price):
+    """Return a price as a finite float, or None. Accepts decimal commas ("2,50", "1.234,50")."""
+    if isinstance(price, bool):
+        return None
+    if isinstance(price, str):
+        price = price.strip().replace("'", '').replace(' ', '')
+        if ',' in price:
+            # Whichever separator comes last is the decimal one; the other groups thousands
+            if price.rfind(',') > price.rfind('.'):
+                price = price.replace('.', '').replace(',', '.')
+            else:
+                price = price.replace(',', '')
+    try:
+        price = float(price)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    # 1e400 and NaN parse as floats but can never be stored as a DecimalField
+    return price if math.isfinite(price) else None
+
+def _clean_item(candidate):
+    """Return a normalized {'item', 'price'} dict, or None if the candidate is not a usable item."""
+    if not isinstance(candidate, dict) or 'item' not in candidate or 'price' not in candidate:
+        return None
+    price = _parse_price(candidate['price'])
+    if price is None:
+        return None
+    return {'item': str(candidate['item']), 'price': str(price)}
+
+def parse_items(content):
+    """Parse model output into receipt items in a single pass.
+    
+    Accepts a structured-output object ({"items": [...]}), a bare JSON or Python
+    list, optionally wrapped in a markdown code fence. If the answer does not
+    parse as a whole (e.g. truncated output), the individual item objects that
+    do parse are recovered. Returns (items, complete); an answer with no items
+    or with any unusable item is never complete, so it is not cached.
+    """
+    text = CODE_FENCE_PATTERN.sub('', content.strip())
+    
+    try:
+        parsed = _load_literal(text)
+        if isinstance(parsed, dict):
+            parsed = parsed.get('items')
+        if isinstance(parsed, list):
+            items = [_clean_item(candidate) for candidate in parsed]
+            return [item for item in items if item is not None], bool(items) and None not in items
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+    
+    # Salvage whatever complete item objects are in the answer
+    items = []
+    for match in ITEM_OBJECT_PATTERN.finditer(text):
+        try:
+            item = _clean_item(_load_literal(match.group(0)))
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            item = None
+        if item is not None:
+            items.append(item)
+    return items, False
+
+def parse_batch_items(content):
+    """Parse a batch answer into {receipt number: items}.
+    
+    Only receipts whose item lists parse completely and are not empty are
+    returned; anything missing is extracted again on its own by the caller.
+    """
+    text = CODE_FENCE_PATTERN.sub('', content.strip())
+    try:
+        parsed = _load_literal(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        return {}
+    if not isinstance(parsed, dict) or not isinstance(parsed.get('receipts'), list):
+        return {}
+    
+    results = {}
+    for receipt in parsed['receipts']:
+        if not isinstance(receipt, dict) or not isinstance(receipt.get('items'), list):
+            continue
+        items = [_clean_item(candidate) for candidate in receipt['items']]
+        if items and None not in items and isinstance(receipt.get('receipt'), int):
+            results[receipt['receipt']] = items
+    return results
+
+class ItemStreamParser:
+    """Incrementally picks complete {item, price} objects out of a streamed answer.
+    
+    Item objects are the innermost {...} of the answer in both output modes, so
+    each one is parsed as soon as its closing brace arrives. Quoted strings are
+    tracked so braces inside item names don't confuse the scan.
+    """
+    def __init__(self):
+        self.buffer = ''
+        self.position = 0
+        self.object_start = None
+        self.quote = None
+        self.escaped = False
+    
+    def feed(self, text):
+        """Add streamed text and return the items completed by it."""
+        self.buffer += text
+        items = []
+        while self.position < len(self.buffer):
+            char = self.buffer[self.position]
+            if self.quote:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == self.quote:
+                    self.quote = None
+            elif char in '"\'':
+                self.quote = char
+            elif char == '{':
+                # An enclosing object (the structured-output wrapper) is restarted by its first item
+                self.object_start = self.position
+            elif char == '}' and self.object_start is not None:
+                try:
+                    item = _clean_item(_load_literal(self.buffer[self.object_start:self.position + 1]))
+                except (ValueError, SyntaxError, MemoryError, RecursionError):
+                    item = None
+                if item is not None:
+                    items.append(item)
+                self.object_start = None
+            self.position += 1
+        return items
+
+def get_model_pricing(model):
+    """Return (input, output) USD per million tokens for a model from settings.EXTRACTION_MODEL_PRICING.
+    
+    Dated snapshots (e.g. gpt-4o-2024-08-06) use the price of their longest matching
+    model name; unknown models are priced like EXTRACTION_MODEL.
+    """
+    pricing = settings.EXTRACTION_MODEL_PRICING
+    matches = [name for name in pricing if model == name or model.startswith(f"{name}-")]
+    if not matches:
+        logger.warning(f"No pricing configured for model {model}, using {EXTRACTION_MODEL} prices")
+        return pricing[EXTRACTION_MODEL]
+    return pricing[max(matches, key=len)]
+
+def get_request_cost(response_json):
+    """Return the cost in USD of one API response from its token usage and model."""
+    usage = response_json['usage']
+    input_price, output_price = get_model_pricing(response_json.get('model') or EXTRACTION_MODEL)
+    return (usage.get('prompt_tokens', 0) * input_price + usage.get('completion_tokens', 0) * output_price) / 1_000_000
+
+def parse_extraction_response(response_json, image_sha256, telemetry=None) -> tuple[list[dict], float]:
+    """Turn an API response into receipt items and the request cost."""
+    logger.debug(f"Response JSON keys: {response_json.keys()}")
+
+    request_cost = get_request_cost(response_json)
+    record_usage(telemetry, response_json)
+
+    # Extract and process the result
+    result = response_json['choices'][0]['message']['content'] or ''
+    logger.debug(f"Raw API result: {result}")
+
+    out, complete = parse_items(result)
+    if complete:
+        logger.info(f"Successfully extracted {len(out)} items from image")
+        cache_extraction(image_sha256, out)
+    elif out:
+        # Keep the recovered items for review instead of forcing another paid call; don't cache them
+        metrics.increment('extraction_parse_partial')
+        logger.warning(f"Recovered {len(out)} items from a partially malformed API result")
+    else:
+        metrics.increment('extraction_parse_failures')
+        logger.error(f"Error parsing API result: {result[:200]!r}")
+        out = [{'item': 'Error in extraction. Proceed manually.', 'price': '0'}]
+
+    logger.debug(f"Returning {len(out)} items with cost ${request_cost:.4f}")
+    return out, request_cost
+
+def image_to_dataframe_dict(image_path, openai_api_key, telemetry=None, bypass_cache=False) -> tuple[list[dict], float]:
+    """Extract receipt data from image using OpenAI API.
+    
+    Pass a new_telemetry() record to collect the call's wall time, upload size,
+    token usage, model and retries.
+    """
+    logger.debug(f"Starting image extraction for: {image_path}")
+    logger.debug(f"Image path exists: {image_path.exists()}")
+    started_at = time.monotonic()
+
+    try:
+        image_sha256, cached_items, payload = build_extraction_request(image_path, telemetry, bypass_cache)
+        if cached_items is not None:
+            return cached_items, 0.0
+
+        # Make the API request through the configured backend
+        response_json = get_extraction_backend().complete(payload, openai_api_key, telemetry)
+        return parse_extraction_response(response_json, image_sha256, telemetry)
+    except Exception as e:
+        logger.error(f"ERROR in image_to_dataframe_dict: {str(e)}")
+        logger.error(f"TRACEBACK: {traceback.format_exc()}")
+        raise
+    finally:
+        if telemetry is not None:
+            telemetry['seconds'] = time.monotonic() - started_at
+
+async def aimage_to_dataframe_dict(image_path, openai_api_key, telemetry=None, bypass_cache=False) -> tuple[list[dict], float]:
+    """Async variant of image_to_dataframe_dict; only file, image and DB work runs in threads."""
+    logger.debug(f"Starting async image extraction for: {image_path}")
+    started_at = time.monotonic()
+
+    try:
+        image_sha256, cached_items, payload = await sync_to_async(build_extraction_request)(image_path, telemetry, bypass_cache)
+        if cached_items is not None:
+            return cached_items, 0.0
+
+        # Make the API request through the configured backend without blocking the event loop
+        response_json = await get_extraction_backend().acomplete(payload, openai_api_key, telemetry)
+        return await sync_to_async(parse_extraction_response)(response_json, image_sha256, telemetry)
+    except Exception as e:
+        logger.error(f"ERROR in aimage_to_dataframe_dict: {str(e)}")
+        logger.error(f"TRACEBACK: {traceback.format_exc()}")
+        raise
+    finally:
+        if telemetry is not None:
+            telemetry['seconds'] = time.monotonic() - started_at
+
+def get_prompt_version():
+    """Return a short fingerprint of the model, prompt and output mode; changing any invalidates the cache."""
+    fingerprint = f"{EXTRACTION_MODEL}\n{get_extraction_prompt()}"
+    if settings.EXTRACTION_STRUCTURED_OUTPUT:
+        fingerprint += f"\n{json.dumps(EXTRACTION_RESPONSE_SCHEMA, sort_keys=True)}"
+    return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()[:16]
+
+def get_cached_extraction(image_sha256):
+    """Return cached items for an image hash, or None on a miss."""
+    if not settings.EXTRACTION_CACHE_ENABLED:
+        return None
+    
+    entries = ExtractionCacheEntry.objects.filter(image_sha256=image_sha256, prompt_version=get_prompt_version())
+    entry = entries.first()
+    if entry is None:
+        return None
+    
+    entries.update(hit_count=F('hit_count') + 1, last_used_at=timezone.now())
+    return entry.items
+
+def forget_cached_extraction(image_sha256):
+    """Drop the cached items for an image hash under the current prompt version."""
+    if not settings.EXTRACTION_CACHE_ENABLED:
+        return
+    ExtractionCacheEntry.objects.filter(image_sha256=image_sha256, prompt_version=get_prompt_version()).delete()
+
+def cache_extraction(image_sha256, items):
+    """Store successfully parsed items for an image hash and evict old entries."""
+    if not settings.EXTRACTION_CACHE_ENABLED:
+        return
+    
+    ExtractionCacheEntry.objects.update_or_create(
+        image_sha256=image_sha256,
+        prompt_version=get_prompt_version(),
+        defaults={
+            'items': items,
+            'size_bytes': len(json.dumps(items)),
+            'last_used_at': timezone.now(),
+        }
+    )
+    evict_extraction_cache()
+
+def evict_extraction_cache():
+    """Drop entries past the maximum age, then least recently used ones above the size budget."""
+    cutoff = timezone.now() - timedelta(days=settings.EXTRACTION_CACHE_MAX_AGE_DAYS)
+    expired, _ = ExtractionCacheEntry.objects.filter(last_used_at__lt=cutoff).delete()
+    
+    total_bytes = ExtractionCacheEntry.objects.aggregate(total=Sum('size_bytes'))['total'] or 0
+    evicted = 0
+    if total_bytes > settings.EXTRACTION_CACHE_MAX_BYTES:
+        kept_bytes = 0
+        stale_ids = []
+        for entry_id, size_bytes in ExtractionCacheEntry.objects.order_by('-last_used_at').values_list('id', 'size_bytes'):
+            kept_bytes += size_bytes
+            if kept_bytes > settings.EXTRACTION_CACHE_MAX_BYTES:
+                stale_ids.append(entry_id)
+        evicted, _ = ExtractionCacheEntry.objects.filter(id__in=stale_ids).delete()
+    
+    if expired or evicted:
+        logger.info(f"Evicted {expired} expired and {evicted} least recently used extraction cache entries")
+
+def add_api_cost(session_id, cost):
+    """Atomically add an extraction cost to a session's running API total."""
+    ReceiptSession.objects.filter(pk=session_id).update(
+        api_costs_total=F('api_costs_total') + Decimal(str(cost))
+    )
+
+def store_extraction_result(extracted_file, extracted_data, cost, telemetry=None):
+    """Persist extracted items, their cost and the call's telemetry against the file they came from.
+    
+    A cache hit on a file that already had a paid call keeps that call's cost and telemetry.
+    """
+    extracted_file.extracted_items = extracted_data
+    extracted_file.extracted_at = timezone.now()
+    update_fields = ['extracted_items', 'extracted_at']
+    if telemetry is not None and telemetry['cache_hit'] and extracted_file.extraction_model:
+        extracted_file.save(update_fields=update_fields)
+        return
+    extracted_file.extraction_cost = Decimal(str(cost))
+    update_fields.append('extraction_cost')
+    if telemetry is not None:
+        extracted_file.extraction_seconds = telemetry['seconds']
+        extracted_file.upload_bytes = telemetry['upload_bytes']
+        extracted_file.prompt_tokens = telemetry['prompt_tokens']
+        extracted_file.completion_tokens = telemetry['completion_tokens']
+        extracted_file.extraction_model = telemetry['model']
+        extracted_file.extraction_retries = telemetry['retries']
+        extracted_file.extraction_cache_hit = telemetry['cache_hit']
+        update_fields += ['extraction_seconds', 'upload_bytes', 'prompt_tokens', 'completion_tokens', 'extraction_model', 'extraction_retries', 'extraction_cache_hit']
+    extracted_file.save(update_fields=update_fields)
+
+def get_executor():
+    """Return the process-wide bounded pool used for background extractions."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.EXTRACTION_MAX_WORKERS,
+                thread_name_prefix='extraction'
+            )
+        return _executor
+
+def _join_inflight(extracted_file):
+    """Return (future, is_owner) for a file's in-process extraction, registering a new one if none is running."""
+    key = (extracted_file.session_id, extracted_file.id)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        _inflight[key] = future
+        return future, True
+
+def _leave_inflight(extracted_file):
+    with _inflight_lock:
+        _inflight.pop((extracted_file.session_id, extracted_file.id), None)
+
+def _acquire_lease(file_id):
+    """Claim a file's extraction across worker processes; expired leases from crashed workers are taken over."""
+    now = timezone.now()
+    return ExtractedFile.objects.filter(pk=file_id).filter(
+        Q(extraction_lease_until__isnull=True) | Q(extraction_lease_until__lt=now)
+    ).update(extraction_lease_until=now + timedelta(seconds=settings.EXTRACTION_LEASE_SECONDS)) == 1
+
+def _release_lease(file_id):
+    ExtractedFile.objects.filter(pk=file_id).update(extraction_lease_until=None)
+
+def _check_lease(file_id):
+    """Return None while another process holds the lease, else (stored_items, stored_cost)."""
+    extracted_file = ExtractedFile.objects.with_items().only('extraction_lease_until', 'extracted_items', 'extraction_cost').get(pk=file_id)
+    if extracted_file.extraction_lease_until is not None and extracted_file.extraction_lease_until >= timezone.now():
+        return None
+    return extracted_file.extracted_items, float(extracted_file.extraction_cost)
+
+def _store_and_charge(extracted_file, extracted_data, cost, prefetch, telemetry=None):
+    """Store a fresh result on its file and charge the call to the session, once per paid call."""
+    store_extraction_result(extracted_file, extracted_data, cost, telemetry)
+    add_api_cost(extracted_file.session_id, cost)
+    if prefetch:
+        ReceiptSession.objects.filter(pk=extracted_file.session_id).update(
+            prefetch_costs_total=F('prefetch_costs_total') + Decimal(str(cost))
+        )
+
+def _finish_inflight(extracted_file, future, extract):
+    """Run extract() as the owner of a file's in-flight Future and hand its result to joined callers."""
+    try:
+        result = extract()
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _leave_inflight(extracted_file)
+
+def run_extraction(extracted_file, image_path, openai_api_key, prefetch=False, bypass_cache=False) -> tuple[list[dict], float]:
+    """Extract a file, store the result and charge its cost, coalescing duplicate requests.
+    
+    Concurrent calls for the same (session, file) share one paid API call: callers in
+    this process wait on the first caller's Future, and callers in other worker
+    processes wait for its DB lease and read the stored result. bypass_cache forces a
+    new model call for a re-extract.
+    """
+    future, is_owner = _join_inflight(extracted_file)
+    if not is_owner:
+        metrics.increment('extractions_coalesced')
+        logger.info(f"Joining in-flight extraction of {extracted_file.filename}")
+        return future.result()
+    
+    return _finish_inflight(
+        extracted_file, future,
+        lambda: _extract_under_lease(extracted_file, image_path, openai_api_key, prefetch, bypass_cache)
+    )
+
+def _extract_under_lease(extracted_file, image_path, openai_api_key, prefetch, bypass_cache=False):
+    while not _acquire_lease(extracted_file.id):
+        logger.info(f"{extracted_file.filename} is being extracted by another worker, waiting for its result")
+        while (stored := _check_lease(extracted_file.id)) is None:
+            time.sleep(LEASE_POLL_INTERVAL)
+        if stored[0] is not None:
+            metrics.increment('extractions_coalesced')
+            return stored
+    
+    try:
+        telemetry = new_telemetry()
+        extracted_data, cost = image_to_dataframe_dict(image_path, openai_api_key, telemetry, bypass_cache)
+        _store_and_charge(extracted_file, extracted_data, cost, prefetch, telemetry)
+        return extracted_data, cost
+    finally:
+        _release_lease(extracted_file.id)
+
+def run_batch_extraction(files_with_paths, openai_api_key):
+    """Extract several files with one model call, storing and charging each result.
+    
+    Takes (extracted_file, image_path) pairs. Cache hits are served directly and
+    the rest are sent together; the call's cost is split evenly across them.
+    Files the batch answer doesn't cover cleanly fall back to single-image calls.
+    Files already being extracted in this process are left to that extraction;
+    files leased by another worker process are waited for after the batch request.
+    """
+    owned = []
+    leased = []
+    contended = []
+    try:
+        for extracted_file, image_path in files_with_paths:
+            future, is_owner = _join_inflight(extracted_file)
+            if not is_owner:
+                continue
+            owned.append((extracted_file, future))
+            if _acquire_lease(extracted_file.id):
+                leased.append((extracted_file, image_path, future))
+            else:
+                contended.append((extracted_file, image_path, future))
+        
+        unavailable = None
+        try:
+            results = _extract_batch([(extracted_file, image_path) for extracted_file, image_path, _ in leased], openai_api_key)
+        except resilience.ExtractionUnavailable as e:
+            # The provider is degraded; retrying every receipt on its own would only add load
+            logger.warning(f"Batch extraction unavailable: {str(e)}")
+            unavailable, results = e, {}
+        except Exception as e:
+            logger.error(f"Batch extraction failed, falling back to single images: {str(e)}")
+            results = {}
+        
+        for extracted_file, image_path, future in leased:
+            def extract(extracted_file=extracted_file, image_path=image_path):
+                if unavailable is not None:
+                    raise unavailable
+                if extracted_file.id in results:
+                    extracted_data, cost, telemetry = results[extracted_file.id]
+                else:
+                    telemetry = new_telemetry()
+                    extracted_data, cost = image_to_dataframe_dict(image_path, openai_api_key, telemetry)
+                _store_and_charge(extracted_file, extracted_data, cost, False, telemetry)
+                return extracted_data, cost
+            try:
+                _finish_inflight(extracted_file, future, extract)
+            except Exception as e:
+                logger.error(f"Extraction failed for {extracted_file.filename}: {str(e)}")
+        
+        # Another worker process has these; wait for its results like a single extraction would
+        for extracted_file, image_path, future in contended:
+            try:
+                _finish_inflight(
+                    extracted_file, future,
+                    lambda extracted_file=extracted_file, image_path=image_path: _extract_under_lease(extracted_file, image_path, openai_api_key, False)
+                )
+            except Exception as e:
+                logger.error(f"Extraction failed for {extracted_file.filename}: {str(e)}")
+    finally:
+        # Never leave joined callers waiting on a Future this call will not resolve
+        for extracted_file, future in owned:
+            if not future.done():
+                future.set_exception(RuntimeError(f"Batch extraction of {extracted_file.filename} was aborted"))
+                _leave_inflight(extracted_file)
+        for extracted_file, _, _ in leased:
+            _release_lease(extracted_file.id)
+
+def _extract_batch(files_with_paths, openai_api_key):
+    """Send the files' images in one request; returns {file_id: (items, cost, telemetry)} for the receipts it covered."""
+    started_at = time.monotonic()
+    results = {}
+    pending = []
+    for extracted_file, image_path in files_with_paths:
+        telemetry = new_telemetry()
+        image_sha256, cached_items, image_url = read_image_for_extraction(image_path, telemetry)
+        if cached_items is not None:
+            telemetry['seconds'] = time.monotonic() - started_at
+            results[extracted_file.id] = (cached_items, 0.0, telemetry)
+        else:
+            pending.append((extracted_file, image_sha256, image_url, telemetry))
+    
+    # A single image is cheaper as a normal request with the shorter prompt
+    if len(pending) < 2:
+        return results
+    
+    content = [{"type": "text", "text": BATCH_EXTRACTION_PROMPT.format(count=len(pending))}]
+    for number, (_, _, image_url, _) in enumerate(pending, start=1):
+        content.append({"type": "text", "text": f"Receipt {number}"})
+        content.append({"type": "image_url", "image_url": {"url": image_url}})
+    payload = {
+        "model": EXTRACTION_MODEL,
+        "messages": [{"role": "user", "content": content}],
+        "max_tokens": min(BATCH_MAX_TOKENS_PER_RECEIPT * len(pending), MAX_OUTPUT_TOKENS)
+    }
+    if settings.EXTRACTION_STRUCTURED_OUTPUT:
+        payload["response_format"] = {"type": "json_schema", "json_schema": BATCH_RESPONSE_SCHEMA}
+    
+    batch_telemetry = new_telemetry()
+    response_json = get_extraction_backend().complete(payload, openai_api_key, batch_telemetry)
+    record_usage(batch_telemetry, response_json)
+    cost_share = get_request_cost(response_json) / len(pending)
+    items_by_receipt = parse_batch_items(response_json['choices'][0]['message']['content'] or '')
+    
+    for number, (extracted_file, image_sha256, _, telemetry) in enumerate(pending, start=1):
+        # Each receipt records the batch's wall time and model and an even share of its tokens
+        telemetry.update(
+            seconds=time.monotonic() - started_at,
+            prompt_tokens=batch_telemetry['prompt_tokens'] // len(pending),
+            completion_tokens=batch_telemetry['completion_tokens'] // len(pending),
+            model=batch_telemetry['model'],
+            retries=batch_telemetry['retries']
+        )
+        items = items_by_receipt.get(number)
+        if items is None:
+            # Its share of the batch was still spent; the single-image retry is charged on top
+            metrics.increment('extraction_batch_fallbacks')
+            add_api_cost(extracted_file.session_id, cost_share)
+            continue
+        cache_extraction(image_sha256, items)
+        results[extracted_file.id] = (items, cost_share, telemetry)
+    
+    metrics.increment('extraction_batches')
+    metrics.increment('extraction_batch_images', len(pending))
+    logger.info(f"Batch extraction covered {len(items_by_receipt)} of {len(pending)} receipts")
+    return results
+
+def stream_extraction(extracted_file, image_path, openai_api_key, bypass_cache=False):
+    """Streaming variant of run_extraction for the review table.
+    
+    Yields ('item', item) as soon as each item is complete in the model's answer,
+    then ('done', (items, cost)) with the final parsed result, which is stored
+    and charged exactly like run_extraction. Duplicate requests, cache hits and
+    files leased by another worker yield their items all at once.
+    """
+    future, is_owner = _join_inflight(extracted_file)
+    if not is_owner:
+        metrics.increment('extractions_coalesced')
+        logger.info(f"Joining in-flight extraction of {extracted_file.filename}")
+        result = future.result()
+        for item in result[0]:
+            yield 'item', item
+        yield 'done', result
+        return
+    
+    try:
+        if _acquire_lease(extracted_file.id):
+            try:
+                result = yield from _stream_under_lease(extracted_file, image_path, openai_api_key, bypass_cache)
+            finally:
+                _release_lease(extracted_file.id)
+        else:
+            result = _extract_under_lease(extracted_file, image_path, openai_api_key, False, bypass_cache)
+            for item in result[0]:
+                yield 'item', item
+        future.set_result(result)
+    except BaseException as e:
+        # Also covers a client disconnecting mid-stream, so joined callers don't wait forever
+        future.set_exception(e if isinstance(e, Exception) else Exception("Extraction was cancelled"))
+        raise
+    finally:
+        _leave_inflight(extracted_file)
+    
+    yield 'done', result
+
+def _stream_under_lease(extracted_file, image_path, openai_api_key, bypass_cache=False):
+    started_at = time.monotonic()
+    telemetry = new_telemetry()
+    image_sha256, cached_items, payload = build_extraction_request(image_path, telemetry, bypass_cache)
+    if cached_items is not None:
+        for item in cached_items:
+            yield 'item', item
+        telemetry['seconds'] = time.monotonic() - started_at
+        _store_and_charge(extracted_file, cached_items, 0.0, False, telemetry)
+        return cached_items, 0.0
+    
+    parser = ItemStreamParser()
+    content_parts = []
+    usage = None
+    model = None
+    items_streamed = 0
+    for chunk in get_extraction_backend().stream(payload, openai_api_key, telemetry):
+        usage = chunk.get('usage') or usage
+        model = chunk.get('model') or model
+        for choice in chunk.get('choices', []):
+            delta = (choice.get('delta') or {}).get('content') or ''
+            content_parts.append(delta)
+            for item in parser.feed(delta):
+                if not items_streamed:
+                    metrics.observe('extraction_first_item_seconds', time.monotonic() - started_at)
+                items_streamed += 1
+                yield 'item', item
+    
+    # The complete answer is parsed once more so storage, caching and metrics match run_extraction
+    response_json = {
+        'model': model,
+        'usage': usage or {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        'choices': [{'message': {'content': ''.join(content_parts)}}],
+    }
+    extracted_data, cost = parse_extraction_response(response_json, image_sha256, telemetry)
+    telemetry['seconds'] = time.monotonic() - started_at
+    _store_and_charge(extracted_file, extracted_data, cost, False, telemetry)
+    return extracted_data, cost
+
+async def arun_extraction(extracted_file, image_path, openai_api_key, bypass_cache=False) -> tuple[list[dict], float]:
+    """Async variant of run_extraction; shares in-flight calls with sync callers in the same process."""
+    future, is_owner = _join_inflight(extracted_file)
+    if not is_owner:
+        metrics.increment('extractions_coalesced')
+        logger.info(f"Joining in-flight extraction of {extracted_file.filename}")
+        return await asyncio.wrap_future(future)
+    
+    try:
+        result = await _aextract_under_lease(extracted_file, image_path, openai_api_key, bypass_cache)
+        future.set_result(result)
+        return result
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        _leave_inflight(extracted_file)
+
+async def _aextract_under_lease(extracted_file, image_path, openai_api_key, bypass_cache=False):
+    while not await sync_to_async(_acquire_lease)(extracted_file.id):
+        logger.info(f"{extracted_file.filename} is being extracted by another worker, waiting for its result")
+        while (stored := await sync_to_async(_check_lease)(extracted_file.id)) is None:
+            await asyncio.sleep(LEASE_POLL_INTERVAL)
+        if stored[0] is not None:
+            metrics.increment('extractions_coalesced')
+            return stored
+    
+    try:
+        telemetry = new_telemetry()
+        extracted_data, cost = await aimage_to_dataframe_dict(image_path, openai_api_key, telemetry, bypass_cache)
+        await sync_to_async(_store_and_charge)(extracted_file, extracted_data, cost, False, telemetry)
+        return extracted_data, cost
+    finally:
+        await sync_to_async(_release_lease)(extracted_file.id)
+
+def _extract_and_store(file_id, image_path, openai_api_key, prefetch=False):
+    """Worker task: run one extraction and store the result on its file."""
+    try:
+        extracted_file = ExtractedFile.objects.get(pk=file_id)
+        extracted_data, _ = run_extraction(extracted_file, image_path, openai_api_key, prefetch)
+        logger.info(f"Background extraction stored {len(extracted_data)} items for {extracted_file.filename}")
+    except Exception as e:
+        logger.error(f"Background extraction failed for file {file_id}: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending_file_ids.discard(file_id)
+        # Worker threads own their DB connection, so release it after each task
+        connection.close()
+
+def _extract_batch_and_store(file_ids, image_paths, openai_api_key):
+    """Worker task: run one batched extraction and store the results on their files."""
+    try:
+        files_by_id = ExtractedFile.objects.in_bulk(file_ids)
+        run_batch_extraction(
+            [(files_by_id[file_id], image_path) for file_id, image_path in zip(file_ids, image_paths) if file_id in files_by_id],
+            openai_api_key
+        )
+        logger.info(f"Background batch extraction finished for {len(file_ids)} files")
+    except Exception as e:
+        logger.error(f"Background batch extraction failed for files {file_ids}: {str(e)}")
+    finally:
+        with _pending_lock:
+            _pending_file_ids.difference_update(file_ids)
+        # Worker threads own their DB connection, so release it after each task
+        connection.close()
+
+def submit_extraction(session, extracted_file, openai_api_key, prefetch=False):
+    """Queue a background extraction for a file unless one is already pending."""
+    image_path = get_image_path(session, extracted_file)
+    if not image_path.exists():
+        logger.warning(f"Skipping background extraction, image not found at: {image_path}")
+        return False
+
+    with _pending_lock:
+        if extracted_file.id in _pending_file_ids:
+            return False
+        _pending_file_ids.add(extracted_file.id)
+
+    get_executor().submit(_extract_and_store, extracted_file.id, image_path, openai_api_key, prefetch)
+    return True
+
+def extract_all(session, openai_api_key):
+    """Queue every unprocessed file without a stored result for background extraction.
+    
+    With EXTRACTION_BATCH_SIZE above 1 the files are sent in batches of that many
+    images per model call.
+    """
+    files = session.extracted_files.filter(
+        is_processed=False,
+        is_skipped=False,
+        extracted_items__isnull=True
+    ).order_by('filename')
+
+    batch_size = settings.EXTRACTION_BATCH_SIZE
+    if batch_size <= 1:
+        submitted = sum(1 for extracted_file in files if submit_extraction(session, extracted_file, openai_api_key))
+        logger.info(f"Queued {submitted} files for background extraction in session {session.id}")
+        return submitted
+
+    # Claim the files that aren't already queued, then hand them out in batches
+    batch = []
+    with _pending_lock:
+        for extracted_file in files:
+            image_path = get_image_path(session, extracted_file)
+            if extracted_file.id in _pending_file_ids or not image_path.exists():
+                continue
+            _pending_file_ids.add(extracted_file.id)
+            batch.append((extracted_file.id, image_path))
+
+    for start in range(0, len(batch), batch_size):
+        chunk = batch[start:start + batch_size]
+        get_executor().submit(_extract_batch_and_store, [file_id for file_id, _ in chunk], [image_path for _, image_path in chunk], openai_api_key)
+    logger.info(f"Queued {len(batch)} files in batches of {batch_size} for background extraction in session {session.id}")
+    return len(batch)
+
+def prefetch_next_files(session, current_filename, openai_api_key):
+    """Speculatively extract the next files in the review queue while the current one is reviewed.
+    
+    Looks at the next EXTRACTION_PREFETCH_DEPTH unprocessed files after the
+    current one, in the same filename order the queue uses, and queues those
+    without a stored result. Stops once the session's prefetch spend reaches
+    EXTRACTION_PREFETCH_COST_CAP.
+    """
+    depth = settings.EXTRACTION_PREFETCH_DEPTH
+    if depth <= 0 or not current_filename:
+        return 0
+    
+    session.refresh_from_db(fields=['prefetch_costs_total'])
+    if session.prefetch_costs_total >= Decimal(str(settings.EXTRACTION_PREFETCH_COST_CAP)):
+        logger.info(f"Prefetch cost cap reached for session {session.id} (${session.prefetch_costs_total:.4f})")
+        return 0
+    
+    upcoming_files = session.extracted_files.filter(
+        is_processed=False,
+        is_skipped=False,
+        filename__gt=current_filename
+    ).order_by('filename')[:depth]
+    upcoming_ids = [extracted_file.id for extracted_file in upcoming_files]
+    
+    # Only the files in the window that have no stored result yet
+    submitted = sum(
+        1 for extracted_file in session.extracted_files.filter(id__in=upcoming_ids, extracted_items__isnull=True)
+        if submit_extraction(session, extracted_file, openai_api_key, prefetch=True)
+    )
+    if submitted:
+        logger.info(f"Prefetching {submitted} files after {current_filename} in session {session.id}")
+    return submitted
@@ -0,0 +1,369 @@
+from pathlib import Path, PurePosixPath
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import zipfile
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from . import archive, blobstore
+from .models import ReceiptSession, ExtractedFile, ReceiptItem, ImageBlob, IngestionJob, ChunkedUpload
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Receipt images we extract from an uploaded ZIP; everything else stays in the archive
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# Archive members added by macOS and Windows that are never receipts
+JUNK_MEMBER_NAMES = ['__MACOSX', '.DS_Store', 'Thumbs.db']
+
+# Bytes read from the request at a time while writing a chunk of a resumable upload
+CHUNK_READ_SIZE = 64 * 1024
+
+# Seconds between progress writes while a job extracts members
+PROGRESS_UPDATE_INTERVAL = 0.5
+
+# Bounded pool for background ingestion jobs (created lazily per process)
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_upload_dir():
+    upload_dir = Path(settings.BASE_DIR) / 'data' / '0_uploaded'
+    upload_dir.mkdir(parents=True, exist_ok=True)
+    return upload_dir
+
+def get_stored_upload_path(upload_id):
+    """Path of a stored upload; named by a per-upload id so concurrent uploads of the same filename never collide."""
+    return get_upload_dir() / f"{upload_id}.zip"
+
+def store_upload(uploaded_file):
+    """Move an uploaded ZIP into data/0_uploaded under a unique name and check its central directory.
+
+    Uploads larger than FILE_UPLOAD_MAX_MEMORY_SIZE are already spooled to a temporary
+    file by Django, which is renamed into place without copying. Small in-memory uploads
+    are written out chunk by chunk. Returns the stored path. Raises zipfile.BadZipFile
+    (and removes the file) if the archive is not a readable ZIP.
+    """
+    upload_dir = get_upload_dir()
+    zip_path = get_stored_upload_path(uuid.uuid4().hex)
+
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        # FILE_UPLOAD_TEMP_DIR is on the same filesystem, so this is a rename
+        os.replace(uploaded_file.temporary_file_path(), zip_path)
+    else:
+        fd, temp_path = tempfile.mkstemp(dir=upload_dir, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as destination:
+                for chunk in uploaded_file.chunks():
+                    destination.write(chunk)
+            os.replace(temp_path, zip_path)
+        except BaseException:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+
+    return check_stored_zip(zip_path)
+
+def check_stored_zip(zip_path):
+    """Check a stored ZIP by reading its central directory; removes it and raises zipfile.BadZipFile if unreadable."""
+    try:
+        # Opening the archive only reads the central directory at its end
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            member_count = len(zip_ref.infolist())
+    except zipfile.BadZipFile:
+        zip_path.unlink(missing_ok=True)
+        raise
+
+    logger.info(f"Stored upload {zip_path.name} ({zip_path.stat().st_size} bytes, {member_count} members)")
+    return zip_path
+
+class ChunkRejected(Exception):
+    """Raised when a chunk of a resumable upload is not accepted; the client resends from `offset`."""
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+class ChunkOffsetMismatch(ChunkRejected):
+    """The chunk does not start where the upload currently ends (e.g. a duplicate or a lost response)."""
+
+class ChunkChecksumMismatch(ChunkRejected):
+    """The chunk's bytes do not match the SHA-256 the client sent, so it was discarded."""
+
+def get_chunked_upload_dir():
+    # Next to Django's own upload spool, so the finished file is renamed into data/0_uploaded
+    chunked_dir = Path(settings.FILE_UPLOAD_TEMP_DIR) / 'chunked'
+    chunked_dir.mkdir(parents=True, exist_ok=True)
+    return chunked_dir
+
+def get_part_path(upload):
+    return get_chunked_upload_dir() / f'{upload.id}.part'
+
+def start_chunked_upload(user, filename, size, payer):
+    """Start a resumable upload, dropping this user's unfinished uploads that have gone stale."""
+    stale_before = timezone.now() - timedelta(hours=settings.CHUNKED_UPLOAD_EXPIRY_HOURS)
+    for stale_upload in ChunkedUpload.objects.filter(user=user, is_complete=False, updated_at__lt=stale_before):
+        get_part_path(stale_upload).unlink(missing_ok=True)
+        stale_upload.delete()
+
+    upload = ChunkedUpload.objects.create(user=user, filename=filename, size=size, payer=payer)
+    get_part_path(upload).touch()
+    logger.info(f"Started chunked upload {upload.id} of {filename} ({size} bytes)")
+    return upload
+
+def write_chunk(upload, offset, expected_sha256, stream):
+    """Append one chunk read from `stream` at `offset` and advance the upload.
+
+    The part file is locked while writing, so concurrent retries of the same chunk
+    cannot interleave. A chunk that does not start at the upload's current offset,
+    grows past its size or fails its checksum is rolled back and raises ChunkRejected.
+    """
+    with open(get_part_path(upload), 'a+b') as part_file:
+        fcntl.flock(part_file, fcntl.LOCK_EX)
+        try:
+            upload.refresh_from_db(fields=['offset'])
+            if offset != upload.offset:
+                raise ChunkOffsetMismatch(f"Expected a chunk at offset {upload.offset}, got {offset}", upload.offset)
+
+            # Drop anything a previous, failed attempt left behind; appends then start at the offset
+            part_file.truncate(offset)
+            digest = hashlib.sha256()
+            written = 0
+            try:
+                while True:
+                    block = stream.read(CHUNK_READ_SIZE)
+                    if not block:
+                        break
+                    written += len(block)
+                    if written > settings.CHUNKED_UPLOAD_CHUNK_SIZE or offset + written > upload.size:
+                        raise ChunkRejected("Chunk is larger than allowed", offset)
+                    digest.update(block)
+                    part_file.write(block)
+                if digest.hexdigest() != expected_sha256.lower():
+                    raise ChunkChecksumMismatch("Chunk checksum does not match, please resend it", offset)
+                part_file.flush()
+            except BaseException:
+                part_file.truncate(offset)
+                raise
+
+            upload.offset = offset + written
+            ChunkedUpload.objects.filter(pk=upload.pk).update(offset=upload.offset, updated_at=timezone.now())
+            return upload.offset
+        finally:
+            fcntl.flock(part_file, fcntl.LOCK_UN)
+
+def finish_chunked_upload(upload):
+    """Move a fully received upload into data/0_uploaded, named by its id, and check it like a regular upload."""
+    # Only one of two racing final requests gets to move the file
+    if not ChunkedUpload.objects.filter(pk=upload.pk, is_complete=False).update(is_complete=True, updated_at=timezone.now()):
+        raise ChunkOffsetMismatch("Upload is already complete", upload.offset)
+    zip_path = get_stored_upload_path(upload.id.hex)
+    os.replace(get_part_path(upload), zip_path)
+    return check_stored_zip(zip_path)
+
+def is_receipt_member(member):
+    """Whether a ZIP member is a receipt image worth extracting."""
+    if member.is_dir():
+        return False
+    if any(junk_name in member.filename for junk_name in JUNK_MEMBER_NAMES):
+        return False
+    return Path(member.filename).suffix.lower() in IMAGE_EXTENSIONS
+
+# Fields that say where a file's image is stored; a re-upload points them at the new bytes
+IMAGE_LOCATION_FIELDS = (
+    'relative_path', 'blob_id', 'archive_path', 'archive_offset', 'archive_compressed_size',
+    'archive_size', 'archive_compression', 'archive_crc',
+)
+
+# Extraction state of a file, cleared when a re-upload changes its image
+EXTRACTION_STATE_DEFAULTS = {
+    'is_processed': False,
+    'is_skipped': False,
+    'extraction_cost': 0,
+    'extracted_at': None,
+    'extraction_seconds': None,
+    'upload_bytes': None,
+    'prompt_tokens': None,
+    'completion_tokens': None,
+    'extraction_model': '',
+    'extraction_retries': 0,
+    'extraction_cache_hit': False,
+    'extracted_items': None,
+}
+
+def get_image_location(fields):
+    """Everything that identifies a file's image content, from ExtractedFile field values."""
+    location = {name: fields.get(name) for name in IMAGE_LOCATION_FIELDS if name != 'relative_path'}
+    # Each upload's archive copy has a new name; the member itself is identified by its CRC and size
+    location.pop('archive_path')
+    location.pop('archive_offset')
+    return location
+
+def register_files(session, file_fields, blobs=()):
+    """Create the ImageBlob and ExtractedFile rows for ingested images in one transaction.
+
+    file_fields holds, in archive order, a dict of ExtractedFile field values per image
+    (relative_path plus either blob_id or the archive_* fields). Blobs already known from
+    earlier uploads are kept. Files already registered for the session (e.g. after a
+    re-upload) are reused and pointed at the new upload's image; if that image differs,
+    their extraction state and receipt items are reset. A filename seen twice in the
+    archive is registered once, for its first path. Returns the files in archive order.
+    """
+    filenames = [PurePosixPath(fields['relative_path']).name for fields in file_fields]
+    with transaction.atomic():
+        if blobs:
+            ImageBlob.objects.bulk_create(blobs, ignore_conflicts=True)
+        existing = {
+            extracted_file.filename: extracted_file
+            for extracted_file in session.extracted_files.filter(filename__in=set(filenames))
+        }
+        new_files = {}
+        updated_files = {}
+        changed_files = []
+        for filename, fields in zip(filenames, file_fields):
+            if filename in existing:
+                if filename in updated_files:
+                    continue
+                extracted_file = updated_files[filename] = existing[filename]
+                # Unset location fields take their defaults
+                uploaded_file = ExtractedFile(**fields)
+                if get_image_location(vars(extracted_file)) != get_image_location(vars(uploaded_file)):
+                    changed_files.append(extracted_file)
+                    for name, value in EXTRACTION_STATE_DEFAULTS.items():
+                        setattr(extracted_file, name, value)
+                for name in IMAGE_LOCATION_FIELDS:
+                    setattr(extracted_file, name, getattr(uploaded_file, name))
+            elif filename not in new_files:
+                new_files[filename] = ExtractedFile(session=session, filename=filename, **fields)
+        ExtractedFile.objects.bulk_create(new_files.values())
+        ExtractedFile.objects.bulk_update(updated_files.values(), IMAGE_LOCATION_FIELDS)
+        if changed_files:
+            ExtractedFile.objects.bulk_update(changed_files, list(EXTRACTION_STATE_DEFAULTS))
+            # Items read from the old image no longer match the receipt
+            ReceiptItem.objects.filter(source_file__in=changed_files).delete()
+
+    logger.debug(f"Registered {len(new_files)} new files for session {session.id} ({len(existing)} already known, {len(changed_files)} with a new image)")
+    registered = {**existing, **new_files}
+    return [registered[filename] for filename in dict.fromkeys(filenames)]
+
+def keep_archive(zip_path):
+    """Link an uploaded ZIP into the archive store under a unique name; returns that name.
+
+    Lazily ingested files keep reading from this copy, so a later upload with the same
+    filename cannot change the bytes behind them.
+    """
+    archive_name = f"{uuid.uuid4().hex}.zip"
+    archive_path = archive.get_archive_root() / archive_name
+    try:
+        os.link(zip_path, archive_path)
+    except OSError:
+        shutil.copyfile(zip_path, archive_path)
+    return archive_name
+
+def ingest_zip(session, stored_filename, job=None):
+    """Register the receipt images of a stored ZIP; returns the ExtractedFiles.
+
+    Members are filtered by name in the central directory. Each image is then streamed
+    into the content-addressed store, so only the needed bytes are read, identical
+    photos are kept once, and peak memory stays flat whatever the archive size. With
+    INGESTION_LAZY_IMAGES the images stay in the archive instead and only their offsets
+    are recorded, so nothing but the central directory is read. All files are registered
+    with a single bulk insert. With a job, its progress counters are updated along the way.
+    stored_filename is the upload's unique name in data/0_uploaded, not the client's filename.
+    """
+    zip_path = get_upload_dir() / stored_filename
+
+    file_fields = []
+    blobs = []
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        members = [member for member in zip_ref.infolist() if is_receipt_member(member)]
+        progress = {
+            'bytes_total': sum(member.compress_size for member in members),
+            'bytes_read': 0,
+            'members_total': len(members),
+            'members_extracted': 0,
+        }
+        update_job(job, force=True, status='running', **progress)
+        archive_name = keep_archive(zip_path) if settings.INGESTION_LAZY_IMAGES else None
+
+        for member in members:
+            if archive_name and member.compress_type in archive.READABLE_COMPRESSION:
+                file_fields.append({
+                    'relative_path': member.filename,
+                    'archive_path': archive_name,
+                    'archive_offset': member.header_offset,
+                    'archive_compressed_size': member.compress_size,
+                    'archive_size': member.file_size,
+                    'archive_compression': member.compress_type,
+                    'archive_crc': member.CRC,
+                })
+            else:
+                # Reading a member to the end checks its CRC
+                with zip_ref.open(member) as source:
+                    sha256, size_bytes = blobstore.store_stream(source)
+                blobs.append(ImageBlob(sha256=sha256, size_bytes=size_bytes, content_type=blobstore.get_content_type(member.filename)))
+                file_fields.append({'relative_path': member.filename, 'blob_id': sha256})
+            progress['bytes_read'] += member.compress_size
+            progress['members_extracted'] += 1
+            update_job(job, **progress)
+
+    extracted_files = register_files(session, file_fields, blobs)
+    update_job(job, force=True, files_registered=len(extracted_files), **progress)
+
+    logger.info(f"{'Registered' if archive_name else 'Extracted'} {len(extracted_files)} files for session {session.id}")
+    return extracted_files
+
+def update_job(job, force=False, **fields):
+    """Write progress fields to a job, at most every PROGRESS_UPDATE_INTERVAL seconds unless forced."""
+    if job is None:
+        return
+    now = time.monotonic()
+    if not force and now - getattr(job, '_progress_written_at', 0) < PROGRESS_UPDATE_INTERVAL:
+        return
+    job._progress_written_at = now
+    for name, value in fields.items():
+        setattr(job, name, value)
+    IngestionJob.objects.filter(pk=job.pk).update(**fields)
+
+def get_executor():
+    """Return the process-wide pool that runs ingestion jobs."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.INGESTION_MAX_WORKERS,
+                thread_name_prefix='ingestion'
+            )
+        return _executor
+
+def _run_ingestion_job(job_id):
+    """Worker task: ingest a job's ZIP and move its session on to the Extract step."""
+    try:
+        job = IngestionJob.objects.select_related('session').get(pk=job_id)
+        # Jobs queued before uploads got unique names point at the client's filename
+        ingest_zip(job.session, job.stored_filename or job.zip_filename, job)
+        ReceiptSession.objects.filter(pk=job.session_id).update(current_step=2, updated_at=timezone.now())
+        update_job(job, force=True, status='done', finished_at=timezone.now())
+        logger.info(f"Ingestion job {job_id} finished for {job.zip_filename}")
+    except Exception as e:
+        logger.error(f"Ingestion job {job_id} failed: {str(e)}")
+        logger.error(f"TRACEBACK: {traceback.format_exc()}")
+        IngestionJob.objects.filter(pk=job_id).update(status='failed', error=str(e), finished_at=timezone.now())
+    finally:
+        # Worker threads own their DB connection, so release it after each task
+        connection.close()
+
+def submit_ingestion(session, zip_filename, stored_filename):
+    """Create an ingestion job for a stored ZIP and run it in the background."""
+    job = IngestionJob.objects.create(session=session, zip_filename=zip_filename, stored_filename=stored_filename)
+    get_executor().submit(_run_ingestion_job, job.id)
+    logger.info(f"Queued ingestion job {job.id} for {zip_filename} in session {session.id}")
+    return job
@@ -0,0 +1,183 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Answers extraction requests with deterministic receipt items so the extraction
+workflow can be load tested and exercised in CI without spending money. Point
+the app at it with EXTRACTION_BACKEND=core.extraction.StandInBackend.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+
+PRODUCTS = [
+    'Milk 1L', 'Bread', 'Butter', 'Cheese Gruyere', 'Apples 1kg', 'Bananas', 'Tomatoes',
+    'Pasta', 'Rice 1kg', 'Coffee Beans', 'Yogurt', 'Eggs 6x', 'Chicken Breast', 'Salmon',
+    'Olive Oil', 'Chocolate', 'Orange Juice', 'Toilet Paper', 'Dish Soap', 'Cucumber',
+]
+
+# Streamed answers: share of the latency before the first token, and characters per chunk
+FIRST_TOKEN_SHARE = 0.2
+STREAM_CHUNK_CHARS = 16
+
+def build_receipt_items(seed):
+    """Return a deterministic list of receipt items for a request seed."""
+    rng = random.Random(seed)
+    return [
+        {'item': rng.choice(PRODUCTS), 'price': round(rng.uniform(0.5, 25.0), 2)}
+        for _ in range(rng.randint(3, 15))
+    ]
+
+def get_image_seeds(payload):
+    """Derive one seed per image in the request, so the same receipt always gives the same items."""
+    seeds = []
+    for message in payload.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, list):
+            for part in content:
+                if part.get('type') == 'image_url':
+                    seeds.append(hashlib.sha256(part['image_url']['url'].encode('utf-8')).hexdigest())
+    return seeds
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Handles POST /v1/chat/completions like the OpenAI API would."""
+    server_version = 'StandInExtractor/1.0'
+    
+    def do_POST(self):
+        options = self.server.options
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        
+        # The simulation generator is shared between handler threads
+        with options['rng_lock']:
+            latency = max(0.0, options['rng'].gauss(options['latency'], options['jitter']))
+            roll = options['rng'].random()
+        
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return self.send_json(400, {'error': {'message': 'Invalid JSON body'}})
+        
+        # Simulated model latency; streamed answers spend most of it generating tokens
+        streaming = bool(payload.get('stream'))
+        time.sleep(latency * FIRST_TOKEN_SHARE if streaming else latency)
+        
+        # Simulated provider failures
+        if roll < options['throttle_rate']:
+            return self.send_json(429, {'error': {'message': 'Rate limit reached (stand-in)'}}, {'Retry-After': '1'})
+        if roll < options['throttle_rate'] + options['error_rate']:
+            return self.send_json(500, {'error': {'message': 'Internal error (stand-in)'}})
+        
+        seeds = get_image_seeds(payload) or ['']
+        if len(seeds) > 1:
+            # Batched receipts are answered per receipt, as the batch prompt asks
+            content = json.dumps({'receipts': [
+                {'receipt': number, 'items': build_receipt_items(seed)}
+                for number, seed in enumerate(seeds, start=1)
+            ]})
+        elif payload.get('response_format', {}).get('type') == 'json_schema':
+            # Structured-output requests get schema-shaped JSON, free-text ones the Python list the prompt asks for
+            content = json.dumps({'items': build_receipt_items(seeds[0])})
+        else:
+            content = repr(build_receipt_items(seeds[0]))
+        prompt_tokens = 800 + len(body) // 1000
+        completion_tokens = len(content) // 4
+        
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+        }
+        if streaming:
+            return self.send_stream(payload, content, usage, latency * (1 - FIRST_TOKEN_SHARE))
+        
+        self.send_json(200, {
+            'id': 'chatcmpl-standin',
+            'object': 'chat.completion',
+            'model': payload.get('model', 'stand-in'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': usage,
+        })
+    
+    def send_stream(self, payload, content, usage, generation_time):
+        """Answer as server-sent events, spreading the content over the generation time."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        
+        pieces = [content[i:i + STREAM_CHUNK_CHARS] for i in range(0, len(content), STREAM_CHUNK_CHARS)]
+        for piece in pieces:
+            time.sleep(generation_time / len(pieces))
+            self.send_event({
+                'id': 'chatcmpl-standin',
+                'object': 'chat.completion.chunk',
+                'model': payload.get('model', 'stand-in'),
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}],
+            })
+        if payload.get('stream_options', {}).get('include_usage'):
+            self.send_event({'id': 'chatcmpl-standin', 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.wfile.flush()
+    
+    def send_event(self, data):
+        self.wfile.write(f"data: {json.dumps(data)}\n\n".encode('utf-8'))
+        self.wfile.flush()
+    
+    def do_HEAD(self):
+        # Connection warm-up requests
+        self.send_response(200)
+        self.end_headers()
+    
+    def send_json(self, status, data, extra_headers=None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header, value in (extra_headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        if self.server.options['verbosity'] > 1:
+            super().log_message(format, *args)
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the OpenAI extraction API with configurable latency and error rates.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=2.0, help='Mean response latency in seconds')
+        parser.add_argument('--jitter', type=float, default=0.5, help='Standard deviation of the latency in seconds')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 500')
+        parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 429')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for latency and error simulation')
+    
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer((options['host'], options['port']), StandInHandler)
+        server.daemon_threads = True
+        server.options = {
+            'latency': options['latency'],
+            'jitter': options['jitter'],
+            'error_rate': options['error_rate'],
+            'throttle_rate': options['throttle_rate'],
+            'verbosity': options['verbosity'],
+            'rng': random.Random(options['seed']),
+            'rng_lock': threading.Lock(),
+        }
+        
+        self.stdout.write(
+            f"Stand-in extractor listening on http://{options['host']}:{options['port']}/v1/chat/completions "
+            f"(latency {options['latency']}s ± {options['jitter']}s, "
+            f"errors {options['error_rate']:.0%}, throttling {options['throttle_rate']:.0%})"
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
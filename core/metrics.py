@@ -0,0 +1,31 @@
+import threading
+
+# Process-local counters and timings for the extraction pipeline.
+# Each gunicorn worker keeps its own numbers; they reset when the worker restarts.
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+def increment(name, value=1):
+    """Add a value to a named counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def observe(name, value):
+    """Record one observation (e.g. a duration in seconds) for a named timing."""
+    with _lock:
+        timing = _timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        timing['count'] += 1
+        timing['total'] += value
+        timing['max'] = max(timing['max'], value)
+
+def snapshot():
+    """Return a copy of all counters and timings for reporting."""
+    with _lock:
+        return {
+            'counters': dict(_counters),
+            'timings': {
+                name: dict(timing, avg=timing['total'] / timing['count'] if timing['count'] else 0.0)
+                for name, timing in _timings.items()
+            },
+        }
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedfile',
+            name='extracted_items',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
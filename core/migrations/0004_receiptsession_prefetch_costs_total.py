@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_extractioncacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='receiptsession',
+            name='prefetch_costs_total',
+            field=models.DecimalField(decimal_places=4, default=0, max_digits=10),
+        ),
+    ]
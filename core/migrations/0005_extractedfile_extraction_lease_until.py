@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_receiptsession_prefetch_costs_total'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedfile',
+            name='extraction_lease_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
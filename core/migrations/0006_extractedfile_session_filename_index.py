@@ -0,0 +1,17 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_extractedfile_extraction_lease_until'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='extractedfile',
+            index=models.Index(fields=['session', 'filename'], name='core_extrac_session_a3f7c9_idx'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_extractedfile_session_filename_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedfile',
+            name='completion_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='extraction_model',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='extraction_retries',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='extraction_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='prompt_tokens',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='upload_bytes',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.3 on 2026-10-17 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_imageblob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedfile',
+            name='archive_compressed_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='archive_compression',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='archive_crc',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='archive_offset',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='archive_path',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='extractedfile',
+            name='archive_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
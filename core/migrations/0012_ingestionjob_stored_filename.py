@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 08:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_extractedfile_archive_member'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='stored_filename',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
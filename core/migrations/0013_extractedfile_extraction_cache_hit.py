@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-17 09:10
+
+from django.db import migrations, models
+
+
+def mark_cache_hits(apps, schema_editor):
+    # Before the flag, cache hits were the extraction runs without a model
+    ExtractedFile = apps.get_model('core', 'ExtractedFile')
+    ExtractedFile.objects.filter(extraction_seconds__isnull=False, extraction_model='').update(extraction_cache_hit=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_ingestionjob_stored_filename'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='extractedfile',
+            name='extraction_cache_hit',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_cache_hits, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
+import hashlib
 import json
+import uuid
 
 class ReceiptSession(models.Model):
     """Main session object for receipt processing workflow"""
@@ -37,6 +39,7 @@ class ReceiptSession(models.Model):
     
     # API costs tracking
     api_costs_total = models.DecimalField(max_digits=10, decimal_places=4, default=0)
+    prefetch_costs_total = models.DecimalField(max_digits=10, decimal_places=4, default=0)  # Share spent on speculative prefetch
     
     # Completion status
     is_complete = models.BooleanField(default=False)
@@ -51,11 +54,40 @@ class ReceiptSession(models.Model):
     def current_step_name(self):
         return dict(self.STEP_CHOICES).get(self.current_step, 'Unknown')
 
+class ImageBlob(models.Model):
+    """Receipt image bytes, stored once by content hash and shared by every file with that content"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    size_bytes = models.BigIntegerField()
+    content_type = models.CharField(max_length=50)
+    created_at = models.DateTimeField(default=timezone.now)
+    
+    def __str__(self):
+        return f"{self.sha256[:12]} ({self.content_type}, {self.size_bytes} bytes)"
+
+class ExtractedFileQuerySet(models.QuerySet):
+    def with_items(self):
+        """Also load the stored extraction output, which is deferred by default."""
+        return self.defer(None)
+
+class ExtractedFileManager(models.Manager.from_queryset(ExtractedFileQuerySet)):
+    """Defers extracted_items so listing and navigating files never loads item lists."""
+    def get_queryset(self):
+        return super().get_queryset().defer('extracted_items')
+
 class ExtractedFile(models.Model):
     """Files extracted from uploaded ZIP"""
     session = models.ForeignKey(ReceiptSession, on_delete=models.CASCADE, related_name='extracted_files')
     filename = models.CharField(max_length=255)  # Original filename for display
-    relative_path = models.CharField(max_length=500)  # Path relative to extraction directory
+    relative_path = models.CharField(max_length=500)  # Path inside the uploaded ZIP
+    # Stored image; keyed by hash so resolving a file's path needs no join. Null for files from before the image store
+    blob = models.ForeignKey(ImageBlob, to_field='sha256', on_delete=models.PROTECT, null=True, blank=True, related_name='files')
+    # Lazy ingestion: where the image sits inside its stored ZIP (relative_path is the member name)
+    archive_path = models.CharField(max_length=255, blank=True)  # Relative to ARCHIVE_STORE_DIR
+    archive_offset = models.BigIntegerField(null=True, blank=True)  # Offset of the member's local file header
+    archive_compressed_size = models.BigIntegerField(null=True, blank=True)
+    archive_size = models.BigIntegerField(null=True, blank=True)
+    archive_compression = models.IntegerField(null=True, blank=True)  # zipfile.ZIP_STORED or ZIP_DEFLATED
+    archive_crc = models.BigIntegerField(null=True, blank=True)
     
     # Processing status
     is_processed = models.BooleanField(default=False)
@@ -65,11 +97,40 @@ class ExtractedFile(models.Model):
     extraction_cost = models.DecimalField(max_digits=8, decimal_places=4, default=0)
     extracted_at = models.DateTimeField(null=True, blank=True)
     
+    # Extraction telemetry of the call that produced the stored result
+    extraction_seconds = models.FloatField(null=True, blank=True)  # Wall time
+    upload_bytes = models.IntegerField(null=True, blank=True)  # Image bytes sent to the model
+    prompt_tokens = models.IntegerField(null=True, blank=True)
+    completion_tokens = models.IntegerField(null=True, blank=True)
+    extraction_model = models.CharField(max_length=100, blank=True)  # Empty for cache hits
+    extraction_cache_hit = models.BooleanField(default=False)  # Served from the extraction cache, no model call
+    extraction_retries = models.IntegerField(default=0)  # Retried attempts before the answer (429s, 5xx answers, timeouts, connection errors)
+    
+    # Raw model output for this file; the one place extraction results are kept (never the Django session)
+    extracted_items = models.JSONField(null=True, blank=True)
+    # Set while a worker process is extracting this file, so duplicate requests wait instead of paying twice
+    extraction_lease_until = models.DateTimeField(null=True, blank=True)
+    
+    objects = ExtractedFileManager()
+    
     class Meta:
         ordering = ['filename']
+        indexes = [
+            models.Index(fields=['session', 'filename']),
+        ]
     
     def __str__(self):
         return f"{self.session.id}/{self.filename}"
+    
+    @property
+    def image_version(self):
+        """Token that changes whenever the stored image does; empty for files from before the image store."""
+        if self.blob_id:
+            return self.blob_id[:16]
+        if self.archive_path:
+            # Kept archives get unique names and are never rewritten, so the member's location identifies its bytes
+            return hashlib.sha256(f"{self.archive_path}:{self.archive_offset}:{self.archive_crc}".encode()).hexdigest()[:16]
+        return ''
 
 class ReceiptItem(models.Model):
     """Individual items extracted from receipt images"""
@@ -130,3 +191,87 @@ class SessionAggregation(models.Model):
     
     def __str__(self):
         return f"Aggregation for Session {self.session.id} - Total: CHF {self.grand_total}"
+
+class ExtractionCacheEntry(models.Model):
+    """Extraction results cached by image content hash and prompt/model version"""
+    image_sha256 = models.CharField(max_length=64)
+    prompt_version = models.CharField(max_length=64)
+    
+    # Cached result
+    items = models.JSONField()
+    size_bytes = models.IntegerField(default=0)
+    
+    # Usage tracking for eviction
+    hit_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(default=timezone.now)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+    
+    class Meta:
+        unique_together = ['image_sha256', 'prompt_version']
+    
+    def __str__(self):
+        return f"{self.image_sha256[:12]} ({self.prompt_version}) - {self.hit_count} hits"
+
+class IngestionJob(models.Model):
+    """Background extraction and registration of an uploaded receipt ZIP"""
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
+    session = models.ForeignKey(ReceiptSession, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    zip_filename = models.CharField(max_length=255)  # The client's filename, for display
+    stored_filename = models.CharField(max_length=255, blank=True)  # Unique name of the upload in data/0_uploaded
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    
+    # Progress, counted over the receipt images in the archive
+    bytes_total = models.BigIntegerField(default=0)  # Compressed bytes of the images
+    bytes_read = models.BigIntegerField(default=0)
+    members_total = models.IntegerField(default=0)
+    members_extracted = models.IntegerField(default=0)
+    files_registered = models.IntegerField(default=0)
+    
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Ingestion {self.id} of {self.zip_filename} - {self.status}"
+    
+    @property
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+    
+    @property
+    def progress_percentage(self):
+        if self.status == 'done':
+            return 100
+        if not self.bytes_total:
+            return 0
+        return int(100 * self.bytes_read / self.bytes_total)
+
+class ChunkedUpload(models.Model):
+    """A receipt ZIP uploaded in resumable, checksummed chunks"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='chunked_uploads')
+    filename = models.CharField(max_length=255)
+    payer = models.CharField(max_length=20, blank=True)
+    
+    # Bytes expected and bytes received and verified so far; the next chunk starts at offset
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    is_complete = models.BooleanField(default=False)
+    
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    def __str__(self):
+        return f"Chunked upload {self.id} of {self.filename} - {self.offset}/{self.size}"
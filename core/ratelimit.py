@@ -0,0 +1,223 @@
+from contextlib import contextmanager, asynccontextmanager
+from pathlib import Path
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from django.conf import settings
+from . import metrics
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Cross-worker limiter for outbound extraction calls.
+# State lives in small lock files under EXTRACTION_RATE_LIMIT_DIR, so every gunicorn
+# worker (and thread) on the host shares the same budget without an external service.
+# Requests-per-minute and tokens-per-minute are token buckets in one JSON state file,
+# updated under an exclusive flock; the in-flight cap is a set of slot files, each
+# held with a non-blocking flock for the duration of one call.
+
+# Seconds between retries while queued for the bucket or a slot
+POLL_INTERVAL = 0.1
+
+class RateLimitTimeout(Exception):
+    """Raised when a call could not get through the limiter within EXTRACTION_RATE_LIMIT_MAX_WAIT."""
+
+def get_state_dir():
+    state_dir = Path(settings.EXTRACTION_RATE_LIMIT_DIR)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir
+
+def _take_from_buckets(estimated_tokens):
+    """Try to take one request and the estimated tokens from the shared buckets.
+
+    Returns 0 when the budget was taken, otherwise the number of seconds
+    until enough budget will have refilled.
+    """
+    rpm = settings.EXTRACTION_RATE_LIMIT_RPM
+    tpm = settings.EXTRACTION_RATE_LIMIT_TPM
+
+    with open(get_state_dir() / 'buckets.json', 'a+') as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        try:
+            state_file.seek(0)
+            raw_state = state_file.read()
+            now = time.time()
+            try:
+                state = json.loads(raw_state) if raw_state else {}
+            except ValueError:
+                state = {}
+
+            # Refill both buckets for the time since the last update
+            elapsed = max(0.0, now - state.get('updated_at', now))
+            requests_left = min(rpm, state.get('requests', rpm) + elapsed * rpm / 60)
+            tokens_left = min(tpm, state.get('tokens', tpm) + elapsed * tpm / 60)
+            paused_until = state.get('paused_until', 0)
+            # A single oversized request may drain the whole bucket but never waits forever
+            tokens_needed = min(estimated_tokens, tpm)
+
+            wait = 0.0
+            if paused_until > now:
+                wait = paused_until - now
+            else:
+                if rpm and requests_left < 1:
+                    wait = max(wait, (1 - requests_left) * 60 / rpm)
+                if tpm and tokens_left < tokens_needed:
+                    wait = max(wait, (tokens_needed - tokens_left) * 60 / tpm)
+
+            if wait == 0.0:
+                requests_left -= 1
+                tokens_left -= tokens_needed
+
+            state = {
+                'requests': requests_left,
+                'tokens': tokens_left,
+                'paused_until': paused_until,
+                'updated_at': now,
+            }
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            state_file.flush()
+            return wait
+        finally:
+            fcntl.flock(state_file, fcntl.LOCK_UN)
+
+def _try_take_slot():
+    """Try to claim one of the EXTRACTION_MAX_IN_FLIGHT slots; returns its open fd or None."""
+    state_dir = get_state_dir()
+    for slot in range(settings.EXTRACTION_MAX_IN_FLIGHT):
+        fd = os.open(state_dir / f'slot-{slot}.lock', os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except BlockingIOError:
+            os.close(fd)
+    return None
+
+def _release_slot(fd):
+    if fd is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+def _try_acquire(estimated_tokens, bucket_taken):
+    """One attempt at the buckets and a slot.
+
+    Returns (bucket_taken, slot_fd, wait_seconds). The bucket is charged once
+    per call, so a caller queued on a slot does not consume budget twice.
+    """
+    if not bucket_taken:
+        wait = _take_from_buckets(estimated_tokens)
+        if wait:
+            return False, None, wait
+
+    if settings.EXTRACTION_MAX_IN_FLIGHT <= 0:
+        return True, None, 0.0
+
+    slot_fd = _try_take_slot()
+    if slot_fd is None:
+        return True, None, POLL_INTERVAL
+    return True, slot_fd, 0.0
+
+async def _atry_acquire(estimated_tokens, bucket_taken):
+    """_try_acquire() in a thread; a slot taken after the caller was cancelled is released again."""
+    attempt = asyncio.ensure_future(asyncio.to_thread(_try_acquire, estimated_tokens, bucket_taken))
+    try:
+        return await asyncio.shield(attempt)
+    except asyncio.CancelledError:
+        attempt.add_done_callback(lambda done: done.cancelled() or done.exception() or _release_slot(done.result()[1]))
+        raise
+
+def _record_wait(started_at, acquired):
+    waited = time.monotonic() - started_at
+    metrics.observe('rate_limit_wait_seconds', waited)
+    if not acquired:
+        metrics.increment('rate_limit_timeouts')
+        logger.warning(f"Gave up on extraction call after {waited:.1f}s in the rate limit queue")
+        raise RateLimitTimeout(f"Extraction API is busy, gave up after waiting {waited:.0f}s. Please try again.")
+    if waited >= 1:
+        logger.info(f"Extraction call waited {waited:.1f}s in the rate limit queue")
+
+def get_max_wait(max_wait=None):
+    if max_wait is None:
+        return settings.EXTRACTION_RATE_LIMIT_MAX_WAIT
+    return min(settings.EXTRACTION_RATE_LIMIT_MAX_WAIT, max_wait)
+
+def is_enabled():
+    return settings.EXTRACTION_RATE_LIMIT_ENABLED
+
+@contextmanager
+def limited(estimated_tokens, max_wait=None):
+    """Hold rate limit budget and an in-flight slot for one outbound call, queueing briefly if needed.
+
+    Queues for at most EXTRACTION_RATE_LIMIT_MAX_WAIT seconds, or max_wait if that is shorter.
+    """
+    if not is_enabled():
+        yield
+        return
+
+    started_at = time.monotonic()
+    deadline = started_at + get_max_wait(max_wait)
+    bucket_taken, slot_fd = False, None
+    while True:
+        bucket_taken, slot_fd, wait = _try_acquire(estimated_tokens, bucket_taken)
+        if not wait or time.monotonic() + min(wait, POLL_INTERVAL) > deadline:
+            break
+        time.sleep(min(wait, POLL_INTERVAL))
+
+    _record_wait(started_at, not wait)
+    try:
+        yield
+    finally:
+        _release_slot(slot_fd)
+
+@asynccontextmanager
+async def alimited(estimated_tokens, max_wait=None):
+    """Async variant of limited(); waits with asyncio.sleep so the event loop keeps serving.
+
+    The flock on the bucket file blocks while another worker holds it, so each attempt runs in a thread.
+    """
+    if not is_enabled():
+        yield
+        return
+
+    started_at = time.monotonic()
+    deadline = started_at + get_max_wait(max_wait)
+    bucket_taken, slot_fd = False, None
+    while True:
+        bucket_taken, slot_fd, wait = await _atry_acquire(estimated_tokens, bucket_taken)
+        if not wait or time.monotonic() + min(wait, POLL_INTERVAL) > deadline:
+            break
+        await asyncio.sleep(min(wait, POLL_INTERVAL))
+
+    _record_wait(started_at, not wait)
+    try:
+        yield
+    finally:
+        _release_slot(slot_fd)
+
+def pause(seconds):
+    """Hold back all workers for a while, e.g. after the provider answered 429 with Retry-After."""
+    if not is_enabled() or seconds <= 0:
+        return
+
+    with open(get_state_dir() / 'buckets.json', 'a+') as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        try:
+            state_file.seek(0)
+            raw_state = state_file.read()
+            try:
+                state = json.loads(raw_state) if raw_state else {}
+            except ValueError:
+                state = {}
+            state['paused_until'] = max(state.get('paused_until', 0), time.time() + seconds)
+            state_file.seek(0)
+            state_file.truncate()
+            state_file.write(json.dumps(state))
+            state_file.flush()
+        finally:
+            fcntl.flock(state_file, fcntl.LOCK_UN)
+    metrics.increment('rate_limit_pauses')
+    logger.warning(f"Pausing extraction calls for {seconds:.1f}s after the provider rate limited us")
@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import random
+import time
+import uuid
+from django.conf import settings
+from . import metrics
+from .ratelimit import get_state_dir
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Deadlines, retry backoff and a circuit breaker for outbound extraction calls.
+# Every call gets one overall deadline (EXTRACTION_DEADLINE_SECONDS) that covers queueing,
+# retries and backoff, so a slow provider can never hold a request past gunicorn's timeout.
+# The breaker state is a small JSON file next to the rate limiter's, shared by all workers
+# on the host: after EXTRACTION_CIRCUIT_FAILURE_THRESHOLD consecutive failed attempts calls
+# fail fast for EXTRACTION_CIRCUIT_RESET_SECONDS, then a single probe call decides whether
+# the circuit closes again. The probe is owned by its call's Deadline: the owner's own retries
+# go through, and the owner gives the probe up when it finishes without a verdict.
+
+# Seconds an attempt needs at least; retries are skipped when less of the deadline is left
+MIN_ATTEMPT_SECONDS = 2.0
+
+class ExtractionUnavailable(Exception):
+    """Raised when the extraction provider is degraded and a call was not attempted or gave up."""
+
+class Deadline:
+    """Tracks the time left for one extraction call, including its retries."""
+
+    def __init__(self, seconds=None):
+        self.seconds = settings.EXTRACTION_DEADLINE_SECONDS if seconds is None else seconds
+        self.expires_at = time.monotonic() + self.seconds
+        # Token of the half-open probe this call holds, if any
+        self.probe_token = None
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def allows(self, delay):
+        """Whether waiting `delay` seconds still leaves time for a useful attempt."""
+        return self.remaining() - delay >= MIN_ATTEMPT_SECONDS
+
+    def check(self):
+        if self.expired():
+            metrics.increment('extraction_deadline_exceeded')
+            raise ExtractionUnavailable(f"The extraction service did not answer within {self.seconds:.0f}s. Please try again.")
+
+def get_backoff_delay(attempt):
+    """Return a "full jitter" exponential backoff delay for a retry after the given attempt."""
+    ceiling = min(settings.EXTRACTION_RETRY_MAX_DELAY, settings.EXTRACTION_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+def is_retryable_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+@contextmanager
+def _circuit_state():
+    """Yield the shared breaker state under an exclusive lock and write it back afterwards."""
+    with open(get_state_dir() / 'circuit.json', 'a+') as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        try:
+            state_file.seek(0)
+            raw_state = state_file.read()
+            try:
+                state = json.loads(raw_state) if raw_state else {}
+            except ValueError:
+                state = {}
+            original = dict(state)
+            yield state
+            if state != original:
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps(state))
+                state_file.flush()
+        finally:
+            fcntl.flock(state_file, fcntl.LOCK_UN)
+
+def is_circuit_enabled():
+    return settings.EXTRACTION_CIRCUIT_ENABLED
+
+def before_attempt(deadline):
+    """Fail fast while the circuit is open; once it cools down, let a single probe through."""
+    deadline.check()
+    if not is_circuit_enabled():
+        return
+
+    with _circuit_state() as state:
+        now = time.time()
+        opened_until = state.get('opened_until', 0)
+        if not opened_until:
+            return
+        probing = state.get('probe_until', 0) > now
+        if probing and deadline.probe_token and state.get('probe_owner') == deadline.probe_token:
+            # A retry of the probe call itself
+            state['probe_until'] = now + deadline.remaining()
+            return
+        if opened_until > now or probing:
+            metrics.increment('circuit_rejections')
+            raise ExtractionUnavailable("The extraction service is having trouble right now. Please try again in a minute.")
+        # Half-open: this call is the probe, other callers keep failing fast until it finishes
+        deadline.probe_token = uuid.uuid4().hex
+        state['probe_until'] = now + deadline.remaining()
+        state['probe_owner'] = deadline.probe_token
+    logger.info("Extraction circuit half-open, sending a probe call")
+
+def release_probe(deadline):
+    """Give up the half-open probe held by a finished call so the next caller can probe."""
+    if not deadline.probe_token or not is_circuit_enabled():
+        return
+    with _circuit_state() as state:
+        if state.get('probe_owner') == deadline.probe_token:
+            # Still half-open: the call ended without a verdict (429s, deadline or an error)
+            state['probe_until'] = 0
+            state.pop('probe_owner', None)
+    deadline.probe_token = None
+
+def record_success():
+    if not is_circuit_enabled():
+        return
+    with _circuit_state() as state:
+        if state.get('opened_until'):
+            logger.info("Extraction circuit closed, the provider answered again")
+        state.clear()
+
+def record_failure(reason):
+    """Count a failed attempt (5xx, timeout or connection error) toward opening the circuit."""
+    metrics.increment('extraction_attempt_failures')
+    if not is_circuit_enabled():
+        return
+    with _circuit_state() as state:
+        now = time.time()
+        failures = state.get('failures', 0) + 1
+        probe_failed = bool(state.get('opened_until'))
+        state['failures'] = failures
+        if probe_failed or failures >= settings.EXTRACTION_CIRCUIT_FAILURE_THRESHOLD:
+            state['opened_until'] = now + settings.EXTRACTION_CIRCUIT_RESET_SECONDS
+            state['probe_until'] = 0
+            state.pop('probe_owner', None)
+            metrics.increment('circuit_opened')
+            logger.warning(f"Extraction circuit open for {settings.EXTRACTION_CIRCUIT_RESET_SECONDS:.0f}s after {failures} failed attempts (last: {reason})")
+
+def get_circuit_retry_after():
+    """Seconds until the open circuit lets a probe through, for the Retry-After header."""
+    if not is_circuit_enabled():
+        return 0
+    with _circuit_state() as state:
+        return max(0, int(state.get('opened_until', 0) - time.time()) + 1) if state.get('opened_until') else 0
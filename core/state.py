@@ -0,0 +1,108 @@
+import logging
+from .models import SessionAggregation
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# The `state` the step templates read, built from the database in one pass.
+# The file list (with the current file's image version) comes from a single query over the
+# session's files; consumption, sort items and the aggregation are loaded only for the steps
+# that show them, so a snapshot never costs more than three queries whatever the session size.
+# It is memoized on the request: build it after the view has made its changes.
+
+def get_consumption_data(session):
+    """Get consumption data organized by assignee for templates."""
+    consumption = {'sebastian': [], 'iva': [], 'both': []}
+
+    sorted_items = session.sorted_items.select_related('receipt_item', 'receipt_item__source_file').defer(
+        'receipt_item__source_file__extracted_items'
+    )
+    for sorted_item in sorted_items:
+        item_data = {
+            'item': sorted_item.receipt_item.item_name,
+            'price': str(sorted_item.receipt_item.price),
+            'source_file': sorted_item.receipt_item.source_file.filename
+        }
+        consumption[sorted_item.assignee].append(item_data)
+
+    return consumption
+
+def get_sort_items(session):
+    """Get items that need to be sorted."""
+    # Get all confirmed receipt items that haven't been sorted yet
+    unsorted_items = session.receipt_items.filter(
+        is_confirmed=True,
+        sorted_assignment__isnull=True
+    ).select_related('source_file').defer('source_file__extracted_items')
+
+    sort_items = []
+    for item in unsorted_items:
+        sort_items.append({
+            'item': item.item_name,
+            'price': float(item.price),
+            'source_file': item.source_file.filename,
+            'id': item.id
+        })
+
+    return sort_items
+
+def get_aggregation_data(session):
+    """Get aggregation data for the session."""
+    try:
+        aggregation = session.aggregation
+        return {
+            'sebastian_total': float(aggregation.sebastian_total),
+            'iva_total': float(aggregation.iva_total),
+            'both_total': float(aggregation.both_total),
+            'grand_total': float(aggregation.grand_total),
+            'transfer_amount': float(aggregation.transfer_amount),
+            'transfer_direction': aggregation.transfer_direction,
+            'payer': session.payer
+        }
+    except SessionAggregation.DoesNotExist:
+        return {}
+
+def build_session_state(session, current_file=None, step=None):
+    """Load everything the templates of a step need about a session.
+
+    step is the 0-based step being rendered and defaults to the session's current step.
+    """
+    if step is None:
+        step = session.current_step
+
+    # One query for the whole file list; only the columns the templates and image URLs use
+    # (session is kept so the related manager can attach it without a query per row)
+    files = list(session.extracted_files.only(
+        'session', 'filename', 'is_processed', 'is_skipped', 'blob', 'archive_path', 'archive_offset', 'archive_crc'
+    ))
+    unprocessed_files = [f.filename for f in files if not f.is_processed and not f.is_skipped]
+    current = next((f for f in files if f.filename == current_file), None) if current_file else None
+
+    return {
+        'current_step': session.current_step,
+        'receipt_zip': session.receipt_zip_filename,
+        'payer': session.payer,
+        'api_costs_total': float(session.api_costs_total),
+        'current_extraction_index': session.current_extraction_index,
+        'files_processed': session.files_processed,
+        'progress_percentage': session.progress_percentage,
+        'current_sort_index': session.current_sort_index,
+        'extracted_files': unprocessed_files,
+        'current_file': current.filename if current else None,
+        'current_file_normalized': current.filename if current else None,
+        'image_version': current.image_version if current else '',
+        # Consumption data for sorting/aggregation steps
+        'consumption': get_consumption_data(session) if step >= 3 else {},
+        'sort_items': get_sort_items(session) if step == 3 else [],
+        'aggregation': get_aggregation_data(session) if step >= 4 else {},
+    }
+
+def get_session_state(request, session, step=None):
+    """Return the session state for a step, building it at most once per request."""
+    key = (session.id, session.current_step if step is None else step)
+    cached = getattr(request, '_session_state', None)
+    if cached is None or cached[0] != key:
+        state = build_session_state(session, request.session.get('current_file'), step)
+        request._session_state = cached = (key, state)
+        logger.debug(f"Built state of session {session.id} for step {key[1]}")
+    return cached[1]
@@ -1,3 +1,777 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+import hashlib
+import io
+from unittest import mock
+import json
+import os
+import struct
+import tempfile
+import threading
+import zipfile
+import zlib
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from . import extraction, ratelimit, resilience
+from .archive import ArchiveMember, LOCAL_HEADER_FORMAT, LOCAL_HEADER_SIGNATURE
+from .extraction import parse_items, parse_batch_items, parse_extraction_response, get_cached_extraction, run_extraction, run_batch_extraction
+from .ingestion import get_part_path, register_files, write_chunk
+from .models import ReceiptSession, ExtractedFile, ImageBlob, ReceiptItem, SortedItem, SessionAggregation, ChunkedUpload
+from .state import get_session_state
 
-# Create your tests here.
+
+class SessionStateQueryTests(TestCase):
+    """The start page and step fragments load a session's state in a fixed number of queries."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('alice', password='secret')
+        self.session = ReceiptSession.objects.create(user=self.user, payer='Iva', receipt_zip_filename='receipts.zip')
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+
+    def add_files(self, count, confirmed_items=True, sorted_items=True):
+        files = ExtractedFile.objects.bulk_create(
+            ExtractedFile(session=self.session, filename=f'r{i:03d}.jpg', relative_path=f'r{i:03d}.jpg', is_processed=i % 2 == 0)
+            for i in range(count)
+        )
+        items = ReceiptItem.objects.bulk_create(
+            ReceiptItem(session=self.session, source_file=f, item_name=f'Item {f.filename}', price=Decimal('1.50'), is_confirmed=confirmed_items)
+            for f in files
+        )
+        if sorted_items:
+            SortedItem.objects.bulk_create(
+                SortedItem(session=self.session, receipt_item=item, assignee='both') for item in items[::2]
+            )
+
+    def set_step(self, step):
+        self.session.current_step = step
+        self.session.save()
+
+    def assert_start_page_queries(self, count):
+        # Django session, user, receipt session, then the state: files (+ sort or aggregation data)
+        with self.assertNumQueries(count):
+            response = self.client.get('/app/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_extract_step_does_not_scale_with_files(self):
+        self.set_step(2)
+        self.add_files(3)
+        self.assert_start_page_queries(4)
+        self.add_files(40)
+        response = self.assert_start_page_queries(4)
+        self.assertEqual(len(response.context['state']['extracted_files']), 21)
+
+    def test_sort_step(self):
+        self.set_step(3)
+        self.add_files(10)
+        response = self.assert_start_page_queries(6)
+        state = response.context['state']
+        self.assertEqual(len(state['consumption']['both']), 5)
+        self.assertEqual(len(state['sort_items']), 5)
+
+    def test_aggregate_step(self):
+        self.set_step(4)
+        self.add_files(10)
+        SessionAggregation.objects.create(session=self.session, both_total=Decimal('7.50'), grand_total=Decimal('7.50'))
+        response = self.assert_start_page_queries(6)
+        self.assertEqual(response.context['state']['aggregation']['grand_total'], 7.5)
+
+    def test_state_is_memoized_per_request(self):
+        self.add_files(5)
+        request = RequestFactory().get('/app/')
+        request.session = {}
+        with self.assertNumQueries(1):
+            first = get_session_state(request, self.session)
+        with self.assertNumQueries(0):
+            self.assertIs(get_session_state(request, self.session), first)
+
+
+@override_settings(EXTRACTION_CACHE_ENABLED=True)
+class ParseItemsTests(TestCase):
+    """Model answers that can't be trusted as a whole are never complete, so they are not cached."""
+
+    def parse_response(self, content, image_sha256='0' * 64):
+        response_json = {'choices': [{'message': {'content': content}}], 'usage': {}}
+        items, _ = parse_extraction_response(response_json, image_sha256)
+        return items
+
+    def test_non_finite_prices_are_incomplete(self):
+        for content in ('[{"item": "Milk", "price": 1e400}, {"item": "Bread", "price": 2}]',
+                        '[{"item": "Milk", "price": NaN}, {"item": "Bread", "price": 2}]',
+                        '[{"item": "Milk", "price": "inf"}, {"item": "Bread", "price": 2}]'):
+            with self.subTest(content=content):
+                self.assertEqual(parse_items(content), ([{'item': 'Bread', 'price': '2.0'}], False))
+                self.assertEqual(self.parse_response(content), [{'item': 'Bread', 'price': '2.0'}])
+                self.assertIsNone(get_cached_extraction('0' * 64))
+
+    def test_empty_item_lists_are_not_cached(self):
+        for content in ('[]', '{"items": []}'):
+            with self.subTest(content=content):
+                self.assertEqual(parse_items(content), ([], False))
+                self.assertEqual(self.parse_response(content)[0]['price'], '0')
+                self.assertIsNone(get_cached_extraction('0' * 64))
+        self.assertEqual(parse_batch_items('{"receipts": [{"receipt": 1, "items": []}]}'), {})
+
+    def test_decimal_comma_prices(self):
+        content = '{"items": [{"item": "Milk", "price": "2,50"}, {"item": "Cheese", "price": "1.234,50"}, {"item": "Wine", "price": "1,234.50"}]}'
+        items = [{'item': 'Milk', 'price': '2.5'}, {'item': 'Cheese', 'price': '1234.5'}, {'item': 'Wine', 'price': '1234.5'}]
+        self.assertEqual(parse_items(content), (items, True))
+        self.assertEqual(self.parse_response(content), items)
+        self.assertEqual(get_cached_extraction('0' * 64), items)
+
+
+class RegisterFilesTests(TestCase):
+    """A re-uploaded ZIP points existing files at its images and resets the ones whose image changed."""
+
+    def setUp(self):
+        user = User.objects.create_user('alice', password='secret')
+        self.session = ReceiptSession.objects.create(user=user, payer='Iva', receipt_zip_filename='receipts.zip')
+
+    def blob_fields(self, name, sha256):
+        return {'relative_path': f'photos/{name}', 'blob_id': sha256}, ImageBlob(sha256=sha256, size_bytes=10, content_type='image/jpeg')
+
+    def archive_fields(self, name, archive_path, crc):
+        return {
+            'relative_path': name, 'archive_path': archive_path, 'archive_offset': 0,
+            'archive_compressed_size': 10, 'archive_size': 10, 'archive_compression': 0, 'archive_crc': crc,
+        }
+
+    def extract(self, extracted_file):
+        ExtractedFile.objects.filter(pk=extracted_file.pk).update(is_processed=True, extracted_items=[{'item': 'Milk', 'price': '1.5'}])
+        ReceiptItem.objects.create(session=self.session, source_file=extracted_file, item_name='Milk', price=Decimal('1.50'), is_confirmed=True)
+
+    def test_changed_blob_resets_extraction(self):
+        fields_a, blob_a = self.blob_fields('a.jpg', 'a' * 64)
+        fields_b, blob_b = self.blob_fields('b.jpg', 'b' * 64)
+        file_a, file_b = register_files(self.session, [fields_a, fields_b], [blob_a, blob_b])
+        self.extract(file_a)
+        self.extract(file_b)
+
+        new_fields_b, new_blob_b = self.blob_fields('b.jpg', 'c' * 64)
+        register_files(self.session, [fields_a, new_fields_b], [blob_a, new_blob_b])
+
+        file_a = ExtractedFile.objects.with_items().get(pk=file_a.pk)
+        file_b = ExtractedFile.objects.with_items().get(pk=file_b.pk)
+        self.assertTrue(file_a.is_processed)
+        self.assertEqual(file_a.items.count(), 1)
+        self.assertEqual(file_b.blob_id, 'c' * 64)
+        self.assertFalse(file_b.is_processed)
+        self.assertIsNone(file_b.extracted_items)
+        self.assertEqual(file_b.items.count(), 0)
+
+    def test_archive_members_compare_by_content(self):
+        (file_a,) = register_files(self.session, [self.archive_fields('a.jpg', 'first.zip', 1)])
+        self.extract(file_a)
+
+        register_files(self.session, [self.archive_fields('a.jpg', 'second.zip', 1)])
+        file_a.refresh_from_db()
+        self.assertEqual(file_a.archive_path, 'second.zip')
+        self.assertTrue(file_a.is_processed)
+
+        register_files(self.session, [self.archive_fields('a.jpg', 'third.zip', 2)])
+        file_a.refresh_from_db()
+        self.assertEqual((file_a.archive_path, file_a.archive_crc), ('third.zip', 2))
+        self.assertFalse(file_a.is_processed)
+        self.assertEqual(file_a.items.count(), 0)
+
+    def test_switching_to_the_image_store_clears_archive_fields(self):
+        (file_a,) = register_files(self.session, [self.archive_fields('a.jpg', 'first.zip', 1)])
+        fields, blob = self.blob_fields('a.jpg', 'a' * 64)
+        register_files(self.session, [fields], [blob])
+        file_a.refresh_from_db()
+        self.assertEqual((file_a.blob_id, file_a.archive_path, file_a.archive_offset), ('a' * 64, '', None))
+
+
+def make_completion(items, model='gpt-4o-mini', prompt_tokens=1000, completion_tokens=100):
+    """An OpenAI-style chat completion answering with the given items."""
+    return {
+        'model': model,
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens},
+        'choices': [{'message': {'content': json.dumps(items)}}],
+    }
+
+
+@override_settings(EXTRACTION_CACHE_ENABLED=True, EXTRACTION_IMAGE_PREPROCESS=False)
+class ReExtractTests(TestCase):
+    """A forced re-extract asks the model again; a plain cache hit keeps the file's paid call on record."""
+
+    def setUp(self):
+        user = User.objects.create_user('alice', password='secret')
+        self.session = ReceiptSession.objects.create(user=user, payer='Iva', receipt_zip_filename='receipts.zip')
+        self.extracted_file = ExtractedFile.objects.create(session=self.session, filename='r.jpg', relative_path='r.jpg')
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.image_path = Path(temp_dir.name) / 'r.jpg'
+        self.image_path.write_bytes(b'\xff\xd8\xff receipt')
+        backend_patcher = mock.patch('core.extraction.get_extraction_backend')
+        self.backend = backend_patcher.start().return_value
+        self.addCleanup(backend_patcher.stop)
+
+    def extract(self, **kwargs):
+        return run_extraction(self.extracted_file, self.image_path, 'sk-test', **kwargs)
+
+    def test_cache_hit_keeps_cost_and_model(self):
+        self.backend.complete.return_value = make_completion([{'item': 'Milk', 'price': 1.5}])
+        _, cost = self.extract()
+        self.assertGreater(cost, 0)
+
+        self.assertEqual(self.extract(), ([{'item': 'Milk', 'price': '1.5'}], 0.0))
+        self.assertEqual(self.backend.complete.call_count, 1)
+        self.extracted_file.refresh_from_db()
+        self.assertEqual(self.extracted_file.extraction_model, 'gpt-4o-mini')
+        self.assertEqual(self.extracted_file.extraction_cost, Decimal(str(round(cost, 4))))
+
+    def test_forced_extraction_skips_and_replaces_the_cache(self):
+        self.backend.complete.return_value = make_completion([{'item': 'Milk', 'price': 1.5}])
+        self.extract()
+        self.backend.complete.return_value = make_completion([{'item': 'Oat milk', 'price': 2.5}])
+
+        items, cost = self.extract(bypass_cache=True)
+        self.assertEqual(items, [{'item': 'Oat milk', 'price': '2.5'}])
+        self.assertGreater(cost, 0)
+        self.assertEqual(self.backend.complete.call_count, 2)
+        self.assertEqual(self.extract()[0], items)
+        self.assertEqual(self.backend.complete.call_count, 2)
+
+
+class ExtractionReportTests(TestCase):
+    """The admin extraction report only counts extraction runs and groups cache hits by their flag."""
+
+    def setUp(self):
+        admin_user = User.objects.create_superuser('admin', password='secret')
+        self.client.force_login(admin_user, backend='django.contrib.auth.backends.ModelBackend')
+        self.session = ReceiptSession.objects.create(user=admin_user, payer='Iva', receipt_zip_filename='receipts.zip')
+
+    def add_file(self, name, **fields):
+        return ExtractedFile.objects.create(session=self.session, filename=name, relative_path=name, extracted_at=timezone.now(), **fields)
+
+    def test_report_groups(self):
+        self.add_file('paid.jpg', extraction_seconds=2.0, extraction_cost=Decimal('0.0100'), extraction_model='gpt-4o-mini')
+        self.add_file('cached.jpg', extraction_seconds=0.1, extraction_cache_hit=True)
+        self.add_file('manual.jpg', is_processed=True)
+        old = self.add_file('old.jpg', extraction_seconds=3.0, extraction_model='gpt-4o-mini')
+        ExtractedFile.objects.filter(pk=old.pk).update(extracted_at=timezone.now() - timedelta(days=90))
+
+        response = self.client.get('/admin/core/extractedfile/report/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['overall']['count'], 2)
+        models = dict(response.context['models'])
+        self.assertEqual(set(models), {'gpt-4o-mini', 'cache hit'})
+        self.assertEqual(models['cache hit']['total_cost'], 0)
+        self.assertEqual(models['gpt-4o-mini']['p50_seconds'], 2.0)
+
+
+@override_settings(EXTRACTION_CACHE_ENABLED=False, EXTRACTION_IMAGE_PREPROCESS=False)
+class SingleFlightTests(TransactionTestCase):
+    """Duplicate extractions of a file share one model call, in this process and across workers."""
+
+    def setUp(self):
+        user = User.objects.create_user('alice', password='secret')
+        self.session = ReceiptSession.objects.create(user=user, payer='Iva', receipt_zip_filename='receipts.zip')
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        backend_patcher = mock.patch('core.extraction.get_extraction_backend')
+        self.backend = backend_patcher.start().return_value
+        self.addCleanup(backend_patcher.stop)
+        self.backend.complete.return_value = make_completion([{'item': 'Milk', 'price': 1.5}])
+
+    def add_file(self, name='r.jpg', **fields):
+        image_path = self.temp_dir / name
+        image_path.write_bytes(f'\xff\xd8\xff {name}'.encode())
+        extracted_file = ExtractedFile.objects.create(session=self.session, filename=name, relative_path=name, **fields)
+        return extracted_file, image_path
+
+    def test_concurrent_requests_share_one_call(self):
+        extracted_file, image_path = self.add_file()
+        callers = 3
+        joined = threading.Semaphore(0)
+        answer = threading.Event()
+        join_inflight = extraction._join_inflight
+
+        def counting_join(*args):
+            result = join_inflight(*args)
+            joined.release()
+            return result
+
+        def slow_complete(*args):
+            answer.wait(5)
+            return make_completion([{'item': 'Milk', 'price': 1.5}])
+        self.backend.complete.side_effect = slow_complete
+
+        results = []
+        def extract():
+            try:
+                results.append(run_extraction(ExtractedFile.objects.get(pk=extracted_file.pk), image_path, 'sk-test'))
+            finally:
+                connection.close()
+
+        with mock.patch('core.extraction._join_inflight', counting_join):
+            threads = [threading.Thread(target=extract) for _ in range(callers)]
+            for thread in threads:
+                thread.start()
+            for _ in range(callers):
+                self.assertTrue(joined.acquire(timeout=5))
+            answer.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(self.backend.complete.call_count, 1)
+        self.assertEqual(len(results), callers)
+        self.assertEqual(len({json.dumps(result) for result in results}), 1)
+        self.assertEqual(extraction._inflight, {})
+        extracted_file.refresh_from_db()
+        self.assertIsNone(extracted_file.extraction_lease_until)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.api_costs_total, Decimal(str(round(results[0][1], 4))))
+
+    def test_expired_lease_is_taken_over(self):
+        extracted_file, image_path = self.add_file(extraction_lease_until=timezone.now() - timedelta(seconds=1))
+        items, _ = run_extraction(extracted_file, image_path, 'sk-test')
+        self.assertEqual(items, [{'item': 'Milk', 'price': '1.5'}])
+        self.assertEqual(self.backend.complete.call_count, 1)
+        extracted_file.refresh_from_db()
+        self.assertIsNone(extracted_file.extraction_lease_until)
+
+    def test_live_lease_waits_for_the_other_worker(self):
+        extracted_file, image_path = self.add_file(extraction_lease_until=timezone.now() + timedelta(minutes=1))
+
+        def other_worker_finishes(seconds):
+            ExtractedFile.objects.filter(pk=extracted_file.pk).update(
+                extraction_lease_until=None, extracted_items=[{'item': 'Bread', 'price': '2.0'}], extraction_cost=Decimal('0.0010')
+            )
+
+        with mock.patch('core.extraction.time.sleep', side_effect=other_worker_finishes):
+            result = run_extraction(extracted_file, image_path, 'sk-test')
+        self.assertEqual(result, ([{'item': 'Bread', 'price': '2.0'}], 0.001))
+        self.backend.complete.assert_not_called()
+
+    def test_aborted_batch_frees_leases_and_resolves_futures(self):
+        files = [self.add_file(f'r{i}.jpg') for i in range(2)]
+        futures = []
+        join_inflight = extraction._join_inflight
+
+        def recording_join(*args):
+            future, is_owner = join_inflight(*args)
+            futures.append(future)
+            return future, is_owner
+
+        with mock.patch('core.extraction._join_inflight', recording_join), \
+                mock.patch('core.extraction._extract_batch', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                run_batch_extraction(files, 'sk-test')
+
+        self.assertEqual(len(futures), 2)
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=0), RuntimeError)
+        self.assertEqual(extraction._inflight, {})
+        self.assertFalse(ExtractedFile.objects.filter(extraction_lease_until__isnull=False).exists())
+
+    def test_batch_aborted_while_leasing_releases_taken_leases(self):
+        files = [self.add_file(f'r{i}.jpg') for i in range(2)]
+        acquire_lease = extraction._acquire_lease
+
+        def failing_second_lease(file_id):
+            if file_id == files[1][0].id:
+                raise RuntimeError("database is locked")
+            return acquire_lease(file_id)
+
+        with mock.patch('core.extraction._acquire_lease', side_effect=failing_second_lease):
+            with self.assertRaises(RuntimeError):
+                run_batch_extraction(files, 'sk-test')
+
+        self.assertEqual(extraction._inflight, {})
+        self.assertFalse(ExtractedFile.objects.filter(extraction_lease_until__isnull=False).exists())
+        self.backend.complete.assert_not_called()
+
+
+class FakeClock:
+    """Stands in for the time module: sleeping moves the clock instead of waiting."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class SharedStateTestCase(SimpleTestCase):
+    """Runs against a fresh limiter/breaker state directory and a fake clock."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(EXTRACTION_RATE_LIMIT_DIR=temp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.clock = FakeClock()
+        for module in (ratelimit, resilience):
+            clock_patcher = mock.patch.object(module, 'time', self.clock)
+            clock_patcher.start()
+            self.addCleanup(clock_patcher.stop)
+
+
+@override_settings(EXTRACTION_RATE_LIMIT_ENABLED=True, EXTRACTION_RATE_LIMIT_RPM=2, EXTRACTION_RATE_LIMIT_TPM=3000,
+                   EXTRACTION_MAX_IN_FLIGHT=1, EXTRACTION_RATE_LIMIT_MAX_WAIT=20)
+class RateLimitTests(SharedStateTestCase):
+    """Token buckets refill over time, pauses hold everyone back and in-flight slots cap concurrency."""
+
+    def test_request_bucket_refills(self):
+        self.assertEqual(ratelimit._take_from_buckets(100), 0)
+        self.assertEqual(ratelimit._take_from_buckets(100), 0)
+        self.assertAlmostEqual(ratelimit._take_from_buckets(100), 30)
+        self.clock.sleep(30)
+        self.assertEqual(ratelimit._take_from_buckets(100), 0)
+
+    def test_token_bucket_refills(self):
+        self.assertEqual(ratelimit._take_from_buckets(2000), 0)
+        # 1000 tokens left, 2000 needed at 3000 per minute
+        self.assertAlmostEqual(ratelimit._take_from_buckets(2000), 20)
+        self.clock.sleep(20)
+        self.assertEqual(ratelimit._take_from_buckets(2000), 0)
+
+    def test_oversized_request_drains_the_bucket_without_waiting_forever(self):
+        self.assertEqual(ratelimit._take_from_buckets(10_000), 0)
+        self.assertAlmostEqual(ratelimit._take_from_buckets(10_000), 60)
+
+    def test_pause_holds_back_calls(self):
+        ratelimit.pause(5)
+        self.assertAlmostEqual(ratelimit._take_from_buckets(100), 5)
+        self.clock.sleep(5)
+        self.assertEqual(ratelimit._take_from_buckets(100), 0)
+
+    def test_in_flight_slots(self):
+        slot = ratelimit._try_take_slot()
+        self.assertIsNotNone(slot)
+        self.assertIsNone(ratelimit._try_take_slot())
+        ratelimit._release_slot(slot)
+        slot = ratelimit._try_take_slot()
+        self.assertIsNotNone(slot)
+        ratelimit._release_slot(slot)
+
+    def test_limited_queues_then_gives_up(self):
+        with ratelimit.limited(100):
+            pass
+        with ratelimit.limited(100):
+            pass
+        # The third call needs 30s of refill, more than it may wait
+        with self.assertRaises(ratelimit.RateLimitTimeout):
+            with ratelimit.limited(100, max_wait=10):
+                pass
+        # 10s of queueing and 10s more refill the request it needs
+        self.clock.sleep(10)
+        started_at = self.clock.now
+        with ratelimit.limited(100):
+            pass
+        self.assertAlmostEqual(self.clock.now - started_at, 10, delta=ratelimit.POLL_INTERVAL)
+
+    def test_limited_waits_for_a_slot(self):
+        slot = ratelimit._try_take_slot()
+        with self.assertRaises(ratelimit.RateLimitTimeout):
+            with ratelimit.limited(100, max_wait=1):
+                pass
+        ratelimit._release_slot(slot)
+        with ratelimit.limited(100):
+            self.assertIsNone(ratelimit._try_take_slot())
+
+
+@override_settings(EXTRACTION_CIRCUIT_ENABLED=True, EXTRACTION_CIRCUIT_FAILURE_THRESHOLD=2, EXTRACTION_CIRCUIT_RESET_SECONDS=30)
+class CircuitBreakerTests(SharedStateTestCase):
+    """closed -> open after consecutive failures -> half-open with a single probe -> closed or open again."""
+
+    def deadline(self):
+        return resilience.Deadline(45)
+
+    def open_circuit(self):
+        resilience.before_attempt(self.deadline())
+        resilience.record_failure("HTTP 500")
+        resilience.record_failure("HTTP 502")
+
+    def assert_rejected(self, deadline=None):
+        with self.assertRaises(resilience.ExtractionUnavailable):
+            resilience.before_attempt(deadline or self.deadline())
+
+    def test_opens_after_consecutive_failures(self):
+        resilience.record_failure("timeout")
+        resilience.before_attempt(self.deadline())
+        resilience.record_failure("timeout")
+        self.assert_rejected()
+        self.assertEqual(resilience.get_circuit_retry_after(), 31)
+
+    def test_success_resets_the_failure_count(self):
+        resilience.record_failure("timeout")
+        resilience.record_success()
+        resilience.record_failure("timeout")
+        resilience.before_attempt(self.deadline())
+
+    def test_probe_closes_the_circuit(self):
+        self.open_circuit()
+        self.clock.sleep(30)
+        probe = self.deadline()
+        resilience.before_attempt(probe)
+        # Everyone else keeps failing fast while the probe is out, but the probe may retry
+        self.assert_rejected()
+        resilience.before_attempt(probe)
+        resilience.record_success()
+        resilience.release_probe(probe)
+        resilience.before_attempt(self.deadline())
+        self.assertEqual(resilience.get_circuit_retry_after(), 0)
+
+    def test_failed_probe_reopens_the_circuit(self):
+        self.open_circuit()
+        self.clock.sleep(30)
+        probe = self.deadline()
+        resilience.before_attempt(probe)
+        resilience.record_failure("HTTP 503")
+        resilience.release_probe(probe)
+        self.assert_rejected(probe)
+        self.clock.sleep(30)
+        resilience.before_attempt(self.deadline())
+
+    def test_abandoned_probe_lets_the_next_caller_probe(self):
+        self.open_circuit()
+        self.clock.sleep(30)
+        probe = self.deadline()
+        resilience.before_attempt(probe)
+        self.assert_rejected()
+        # e.g. the probe only saw 429s, or its caller gave up
+        resilience.release_probe(probe)
+        resilience.before_attempt(self.deadline())
+
+    def test_expired_deadline_fails_before_calling(self):
+        deadline = self.deadline()
+        self.clock.sleep(45)
+        self.assert_rejected(deadline)
+
+
+class FailingStream(io.BytesIO):
+    """A request body that breaks off after `limit` bytes, like a dropped connection."""
+
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise OSError("Connection reset by peer")
+        return super().read(min(size, self.limit - self.tell()))
+
+
+@override_settings(CHUNKED_UPLOAD_CHUNK_SIZE=64)
+class ChunkedUploadTests(TestCase):
+    """Resumable uploads accept checksummed chunks in order and hand the finished ZIP to ingestion."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(BASE_DIR=Path(temp_dir.name), FILE_UPLOAD_TEMP_DIR=temp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        ingestion_patcher = mock.patch('core.views.submit_ingestion', return_value=mock.Mock(id=1))
+        self.submit_ingestion = ingestion_patcher.start()
+        self.addCleanup(ingestion_patcher.stop)
+
+        self.user = User.objects.create_user('alice', password='secret')
+        self.client.force_login(self.user, backend='django.contrib.auth.backends.ModelBackend')
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            zip_file.writestr('r01.jpg', b'\xff\xd8\xff receipt')
+        self.data = buffer.getvalue()
+
+    def start(self, size=None):
+        response = self.client.post('/app/core/upload/chunked/', {'filename': 'receipts.zip', 'size': size or len(self.data), 'payer': 'Iva'})
+        self.assertEqual(response.status_code, 201)
+        return f"/app/core/upload/chunked/{response.json()['upload_id']}/"
+
+    def put(self, url, offset, chunk, checksum=None):
+        return self.client.put(url, chunk, content_type='application/octet-stream', headers={
+            'Upload-Offset': str(offset),
+            'X-Chunk-SHA256': checksum or hashlib.sha256(chunk).hexdigest(),
+        })
+
+    def upload_all(self, url, start=0):
+        for offset in range(start, len(self.data), 64):
+            response = self.put(url, offset, self.data[offset:offset + 64])
+            self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_upload_in_chunks(self):
+        url = self.start()
+        response = self.upload_all(url)
+        self.assertIn('progress_url', response.json())
+        stored_filename = self.submit_ingestion.call_args.args[2]
+        self.assertEqual((Path(settings.BASE_DIR) / 'data' / '0_uploaded' / stored_filename).read_bytes(), self.data)
+
+    def test_bad_checksum_is_rejected(self):
+        url = self.start()
+        response = self.put(url, 0, self.data[:64], checksum='0' * 64)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['offset'], 0)
+        self.assertEqual(self.client.get(url).json()['offset'], 0)
+        self.upload_all(url)
+
+    def test_stale_offset_is_rejected(self):
+        url = self.start()
+        self.assertEqual(self.put(url, 0, self.data[:64]).status_code, 200)
+        # A retried chunk whose first response was lost
+        response = self.put(url, 0, self.data[:64])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['offset'], 64)
+        self.upload_all(url, start=64)
+
+    def test_resume_after_partial_chunk(self):
+        url = self.start()
+        self.assertEqual(self.put(url, 0, self.data[:64]).status_code, 200)
+        upload = ChunkedUpload.objects.get()
+        with mock.patch('core.ingestion.CHUNK_READ_SIZE', 16), self.assertRaises(OSError):
+            write_chunk(upload, 64, hashlib.sha256(self.data[64:128]).hexdigest(), FailingStream(self.data[64:128], 40))
+        # The broken chunk's bytes were dropped, so the client resumes where the server says
+        self.assertEqual(get_part_path(upload).stat().st_size, 64)
+        self.assertEqual(self.client.get(url).json()['offset'], 64)
+        self.upload_all(url, start=64)
+        self.assertTrue(ChunkedUpload.objects.get().is_complete)
+
+    def test_chunk_past_the_declared_size_is_rejected(self):
+        url = self.start(size=len(self.data) - 10)
+        for offset in range(0, len(self.data) - 64, 64):
+            self.assertEqual(self.put(url, offset, self.data[offset:offset + 64]).status_code, 200)
+        last_offset = offset + 64
+        response = self.put(url, last_offset, self.data[last_offset:])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['offset'], last_offset)
+        self.assertFalse(ChunkedUpload.objects.get().is_complete)
+        self.submit_ingestion.assert_not_called()
+
+    def test_finished_upload_that_is_not_a_zip(self):
+        self.data = b'not a zip file at all' * 5
+        url = self.start()
+        for offset in range(0, len(self.data), 64):
+            response = self.put(url, offset, self.data[offset:offset + 64])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list((Path(settings.BASE_DIR) / 'data' / '0_uploaded').iterdir()), [])
+        self.submit_ingestion.assert_not_called()
+
+
+class UnseekableWriter(io.RawIOBase):
+    """Write-only stream without tell/seek, so zipfile writes data descriptors after each member."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+class ArchiveMemberTests(SimpleTestCase):
+    """Members are read straight out of a stored ZIP, located via their local header and checked against the CRC."""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = Path(temp_dir.name)
+        # Several read blocks worth of data, compressible and not
+        self.text = b''.join(f'{i:05d} Milk 1.50\n'.encode() for i in range(20000))
+        self.noise = os.urandom(150 * 1024)
+
+    def write_zip(self, data, name='receipts.zip'):
+        zip_path = self.temp_dir / name
+        zip_path.write_bytes(data)
+        return zip_path
+
+    def make_zip(self, **members):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zip_file:
+            for member_name, (data, compression) in members.items():
+                zip_file.writestr(member_name, data, compress_type=compression)
+        return self.write_zip(buffer.getvalue())
+
+    def members(self, zip_path, **overrides):
+        with zipfile.ZipFile(zip_path) as zip_file:
+            return {
+                info.filename: ArchiveMember(**{
+                    'archive_path': zip_path, 'member_name': info.filename, 'offset': info.header_offset,
+                    'compressed_size': info.compress_size, 'size': info.file_size,
+                    'compression': info.compress_type, 'crc': info.CRC, **overrides,
+                })
+                for info in zip_file.infolist()
+            }
+
+    def test_stored_and_deflated_members(self):
+        zip_path = self.make_zip(**{
+            'stored.jpg': (self.noise, zipfile.ZIP_STORED),
+            'deflated.txt': (self.text, zipfile.ZIP_DEFLATED),
+            'empty.jpg': (b'', zipfile.ZIP_DEFLATED),
+        })
+        members = self.members(zip_path)
+        self.assertEqual(members['stored.jpg'].read_bytes(), self.noise)
+        self.assertEqual(members['deflated.txt'].read_bytes(), self.text)
+        self.assertEqual(members['empty.jpg'].read_bytes(), b'')
+        with members['deflated.txt'].open() as member_file:
+            self.assertEqual(member_file.read(10), self.text[:10])
+            self.assertEqual(member_file.read(), self.text[10:])
+        self.assertEqual(members['stored.jpg'].stat().st_size, len(self.noise))
+
+    def test_crc_mismatch(self):
+        zip_path = self.make_zip(**{'stored.jpg': (self.noise, zipfile.ZIP_STORED), 'deflated.txt': (self.text, zipfile.ZIP_DEFLATED)})
+        for member in self.members(zip_path, crc=0).values():
+            with self.subTest(member=member.member_name), self.assertRaisesRegex(zipfile.BadZipFile, 'Bad CRC-32'):
+                member.read_bytes()
+
+    def test_damaged_member_data(self):
+        zip_path = self.make_zip(**{'stored.jpg': (self.noise, zipfile.ZIP_STORED)})
+        member = self.members(zip_path)['stored.jpg']
+        data = bytearray(zip_path.read_bytes())
+        data[member.offset + 100] ^= 0xff
+        zip_path.write_bytes(bytes(data))
+        with self.assertRaises(zipfile.BadZipFile):
+            member.read_bytes()
+
+    def test_members_with_data_descriptors(self):
+        # Local headers of streamed ZIPs carry no sizes or CRC; those come from the central directory
+        writer = UnseekableWriter()
+        with zipfile.ZipFile(writer, 'w') as zip_file:
+            for member_name, data, compression in (('stored.jpg', self.noise, zipfile.ZIP_STORED), ('deflated.txt', self.text, zipfile.ZIP_DEFLATED)):
+                info = zipfile.ZipInfo(member_name)
+                info.compress_type = compression
+                with zip_file.open(info, 'w') as member_file:
+                    member_file.write(data)
+        zip_path = self.write_zip(writer.buffer.getvalue())
+        members = self.members(zip_path)
+        local_header = struct.unpack(LOCAL_HEADER_FORMAT, zip_path.read_bytes()[members['deflated.txt'].offset:][:30])
+        self.assertTrue(local_header[2] & 0x08)
+        self.assertEqual(members['stored.jpg'].read_bytes(), self.noise)
+        self.assertEqual(members['deflated.txt'].read_bytes(), self.text)
+
+    def test_local_extra_field_differs_from_central_directory(self):
+        # e.g. alignment padding added to the local header only; the data starts after the local extra field
+        member_name = b'padded.jpg'
+        extra = struct.pack('<HH', 0xd935, 9) + bytes(9)
+        local_header = struct.pack(
+            LOCAL_HEADER_FORMAT, LOCAL_HEADER_SIGNATURE, 20, 0, zipfile.ZIP_STORED, 0, 0,
+            zlib.crc32(self.noise), len(self.noise), len(self.noise), len(member_name), len(extra)
+        )
+        zip_path = self.write_zip(b'junk before' + local_header + member_name + extra + self.noise)
+        member = ArchiveMember(zip_path, 'padded.jpg', len(b'junk before'), len(self.noise), len(self.noise), zipfile.ZIP_STORED, zlib.crc32(self.noise))
+        self.assertEqual(member.read_bytes(), self.noise)
+
+    def test_bad_offset_or_truncated_archive(self):
+        zip_path = self.make_zip(**{'stored.jpg': (self.noise, zipfile.ZIP_STORED)})
+        member = self.members(zip_path)['stored.jpg']
+        with self.assertRaisesRegex(zipfile.BadZipFile, 'No local file header'):
+            self.members(zip_path, offset=member.offset + 1)['stored.jpg'].read_bytes()
+        zip_path.write_bytes(zip_path.read_bytes()[:member.offset + 1000])
+        with self.assertRaisesRegex(zipfile.BadZipFile, 'Archive ends inside'):
+            member.read_bytes()
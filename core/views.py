@@ -2,24 +2,37 @@ from pathlib import Path
 from datetime import datetime
 import zipfile
 import os
-import base64
-import requests
-import re
-import ast
 import json
 import logging
+import threading
 import traceback
 import urllib.parse
+import asyncio
 from decimal import Decimal
 from django.shortcuts import render, get_object_or_404, redirect
-from django.http import HttpResponse, FileResponse, JsonResponse
+from django.template.loader import render_to_string
+from django.http import HttpResponse, FileResponse, JsonResponse, StreamingHttpResponse
 from django.conf import settings
-from django.views.decorators.http import require_GET, require_POST
+from django.db import connection
+from django.views.decorators.http import require_GET, require_POST, require_http_methods
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.utils.text import get_valid_filename
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from dotenv import load_dotenv
-from .models import ReceiptSession, ExtractedFile, ReceiptItem, SortedItem, SessionAggregation
+from asgiref.sync import sync_to_async
+from .models import ReceiptSession, ExtractedFile, ReceiptItem, SortedItem, SessionAggregation, IngestionJob, ChunkedUpload
+from . import metrics
+from .ratelimit import RateLimitTimeout
+from .resilience import ExtractionUnavailable, get_circuit_retry_after
+from .blobstore import sniff_content_type
+from .derivatives import get_derivative, get_variant_tag, get_variants
+from .state import get_session_state
+from .ingestion import store_upload, submit_ingestion, start_chunked_upload, write_chunk, finish_chunked_upload, ChunkRejected, ChunkOffsetMismatch
+from .extraction import get_extraction_backend, get_image_path, run_extraction, arun_extraction, stream_extraction, extract_all, prefetch_next_files
 import unicodedata
 from urllib.parse import quote
 
@@ -46,167 +59,50 @@ def get_or_create_session(user):
     
     return session
 
-def unzip_receipts(session, zip_filename):
-    """Extract the uploaded ZIP file and create ExtractedFile objects."""
-    if not zip_filename:
-        return []
+def get_openai_api_key():
+    """Return the API key for the extraction backend, or None if a required key is missing."""
+    # Ensure .env is loaded
+    load_dotenv(Path(settings.BASE_DIR) / 'config' / '.env')
+    openai_api_key = os.environ.get('OPENAI_API_KEY')
     
-    # Get the base directory for uploads (updated to 0_uploaded)
-    upload_dir = Path(settings.BASE_DIR) / 'data' / '0_uploaded'
-    zip_path = upload_dir / zip_filename
-    
-    # Create extraction directory in 1_unzipped (same name as zip without extension)
-    extract_dir_name = Path(zip_filename).stem
-    extract_dir = Path(settings.BASE_DIR) / 'data' / '1_unzipped' / extract_dir_name
-    
-    # Create extraction directory if it doesn't exist
-    extract_dir.mkdir(parents=True, exist_ok=True)
-    
-    extracted_files = []
+    # Offline backends (e.g. the stand-in server) work without a key
+    if openai_api_key is None and not get_extraction_backend().requires_api_key:
+        return ''
     
+    logger.debug(f"OpenAI API key loaded: {bool(openai_api_key)}")
+    return openai_api_key
+
+def start_prefetch(session, current_filename):
+    """Prefetch the files queued after the current one; never lets a failure reach the user."""
+    if settings.EXTRACTION_PREFETCH_DEPTH <= 0:
+        return
     try:
-        with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-            # Extract all files
-            zip_ref.extractall(extract_dir)
-            
-            # Get list of extracted files, filtering out macOS-specific files
-            for file_path in extract_dir.rglob('*'):
-                if file_path.is_file():
-                    # Skip macOS-specific files and folders
-                    if any(macos_file in str(file_path) for macos_file in ['__MACOSX', '.DS_Store', 'Thumbs.db']):
-                        continue
-                    
-                    # Only include image files
-                    file_extension = file_path.suffix.lower()
-                    if file_extension not in ['.jpg', '.jpeg', '.png']:
-                        continue
-                    
-                    # Get relative path from extraction directory
-                    relative_path = file_path.relative_to(extract_dir)
-                    
-                    # Create ExtractedFile object
-                    extracted_file, created = ExtractedFile.objects.get_or_create(
-                        session=session,
-                        filename=file_path.name,
-                        defaults={
-                            'relative_path': str(relative_path)
-                        }
-                    )
-                    
-                    if created:
-                        logger.debug(f"Created ExtractedFile: {extracted_file.filename}")
-                    
-                    extracted_files.append(extracted_file)
-    
+        openai_api_key = get_openai_api_key()
+        if openai_api_key is not None:
+            prefetch_next_files(session, current_filename, openai_api_key)
     except Exception as e:
-        logger.error(f"Error extracting ZIP file: {e}")
-        return []
-    
-    logger.info(f"Extracted {len(extracted_files)} files for session {session.id}")
-    return extracted_files
-
-def get_current_file_info(session, request):
-    """Get current file information."""
-    current_file = request.session.get('current_file')
-    if current_file:
-        # Look up the ExtractedFile object 
-        extracted_file = session.extracted_files.filter(filename=current_file).first()
-        if extracted_file:
-            return {
-                'current_file': current_file
-            }
-    return {
-        'current_file': None
-    }
+        logger.error(f"Failed to start prefetch after {current_filename}: {str(e)}")
 
 @login_required
 @require_GET
 def start_page(request):
     """Render the start page for the HTMX Receipt Processor."""
     session = get_or_create_session(request.user)
-    
-    # Get extracted files that haven't been processed yet
-    unprocessed_files = session.extracted_files.filter(is_processed=False, is_skipped=False)
-    
-    # Get current file information
-    current_file_info = get_current_file_info(session, request)
-    
-    # Create context with session information
-    context = {
+    return render(request, 'start_page.html', get_start_page_context(session, request))
+
+def get_start_page_context(session, request):
+    """Build the start page context from the database state of a session."""
+    state = get_session_state(request, session)
+    return {
         'current_step': session.current_step,
-        'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
+        'extracted_files': state['extracted_files'],
         'session': session,
-        'current_file': current_file_info['current_file'],
+        'current_file': state['current_file'],
+        'current_file_normalized': state['current_file'],
+        'image_version': state['image_version'],
         'authelia_app_url': settings.AUTHELIA_APP_URL,
-        'state': {
-            'current_step': session.current_step,
-            'receipt_zip': session.receipt_zip_filename,
-            'payer': session.payer,
-            'api_costs_total': float(session.api_costs_total),
-            'current_extraction_index': session.current_extraction_index,
-            'files_processed': session.files_processed,
-            'progress_percentage': session.progress_percentage,
-            'current_sort_index': session.current_sort_index,
-            'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-            'current_file': current_file_info['current_file'],
-            'current_file_normalized': current_file_info['current_file'],
-            # Get consumption data for sorting/aggregation steps
-            'consumption': get_consumption_data(session) if session.current_step >= 3 else {},
-            'sort_items': get_sort_items(session) if session.current_step == 3 else [],
-            'aggregation': get_aggregation_data(session) if session.current_step == 4 else {},
-        }
+        'state': state,
     }
-    
-    return render(request, 'start_page.html', context)
-
-def get_consumption_data(session):
-    """Get consumption data organized by assignee for templates."""
-    consumption = {'sebastian': [], 'iva': [], 'both': []}
-    
-    for sorted_item in session.sorted_items.select_related('receipt_item', 'receipt_item__source_file'):
-        item_data = {
-            'item': sorted_item.receipt_item.item_name,
-            'price': str(sorted_item.receipt_item.price),
-            'source_file': sorted_item.receipt_item.source_file.filename
-        }
-        consumption[sorted_item.assignee].append(item_data)
-    
-    return consumption
-
-def get_sort_items(session):
-    """Get items that need to be sorted."""
-    # Get all confirmed receipt items that haven't been sorted yet
-    unsorted_items = session.receipt_items.filter(
-        is_confirmed=True,
-        sorted_assignment__isnull=True
-    ).select_related('source_file')
-    
-    sort_items = []
-    for item in unsorted_items:
-        sort_items.append({
-            'item': item.item_name,
-            'price': float(item.price),
-            'source_file': item.source_file.filename,
-            'id': item.id
-        })
-    
-    return sort_items
-
-def get_aggregation_data(session):
-    """Get aggregation data for the session."""
-    try:
-        aggregation = session.aggregation
-        return {
-            'sebastian_total': float(aggregation.sebastian_total),
-            'iva_total': float(aggregation.iva_total),
-            'both_total': float(aggregation.both_total),
-            'grand_total': float(aggregation.grand_total),
-            'transfer_amount': float(aggregation.transfer_amount),
-            'transfer_direction': aggregation.transfer_direction,
-            'payer': session.payer
-        }
-    except SessionAggregation.DoesNotExist:
-        return {}
 
 @login_required
 @require_POST
@@ -218,60 +114,40 @@ def step_view(request, step_number):
     
     # Update current step (convert to 0-based index for internal use)
     session.current_step = step_number - 1
-    session.save()
+    session.save(update_fields=['current_step', 'updated_at'])
     
     # If moving to aggregation step (step 5 = index 4), calculate aggregation
     if step_number == 5:
         calculate_aggregation(session)
     
     # Calculate progress information for extraction step
-    if step_number == 3 and session.extracted_files.exists():  # Step 3 is extraction (0-based index 2)
-        unprocessed_files = session.extracted_files.filter(is_processed=False, is_skipped=False)
-        total_files = session.extracted_files.count()
+    total_files = session.extracted_files.count() if step_number == 3 else 0
+    if total_files:  # Step 3 is extraction (0-based index 2)
         files_processed = session.current_extraction_index
         progress_percentage = int((files_processed / total_files) * 100) if total_files > 0 else 0
         
         session.files_processed = files_processed
         session.progress_percentage = progress_percentage
-        session.save()
+        session.save(update_fields=['files_processed', 'progress_percentage', 'updated_at'])
         
         logger.debug(f"Extraction progress: {files_processed}/{total_files} ({progress_percentage}%)")
     
-    # Get extracted files that haven't been processed yet
-    unprocessed_files = session.extracted_files.filter(is_processed=False, is_skipped=False)
-    
-    # Get current file information
-    current_file_info = get_current_file_info(session, request)
-    
-    # Create context with state information
-    context = {
-        'current_step': session.current_step,
-        'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-        'session': session,
-        'current_file': current_file_info['current_file'],
-        'current_file_normalized': current_file_info['current_file'],
-        'state': {
-            'current_step': session.current_step,
-            'receipt_zip': session.receipt_zip_filename,
-            'payer': session.payer,
-            'api_costs_total': float(session.api_costs_total),
-            'current_extraction_index': session.current_extraction_index,
-            'files_processed': session.files_processed,
-            'progress_percentage': session.progress_percentage,
-            'current_sort_index': session.current_sort_index,
-            'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-            'current_file': current_file_info['current_file'],
-            'current_file_normalized': current_file_info['current_file'],
-            # Get consumption data for sorting/aggregation steps
-            'consumption': get_consumption_data(session) if session.current_step >= 3 else {},
-            'sort_items': get_sort_items(session) if session.current_step == 3 else [],
-            'aggregation': get_aggregation_data(session) if session.current_step == 4 else {},
-        }
-    }
+    context = get_start_page_context(session, request)
     
     logger.debug(f"Rendering step {step_number} with context keys: {list(context.keys())}")
     return render(request, 'start_page.html', context)
 
+def start_ingestion(user, filename, payer, zip_path):
+    """Record a stored upload on the user's session and queue its ingestion job."""
+    # Get or create session and store filename and payer
+    session = get_or_create_session(user)
+    session.receipt_zip_filename = filename
+    session.payer = payer
+    session.save()
+    
+    # Extract and register the images in the background; the job moves the session to the Extract step
+    return submit_ingestion(session, filename, zip_path.name)
+
 @login_required
 @require_POST
 def upload_files(request):
@@ -298,9 +174,12 @@ def upload_files(request):
                 </script>
             """, status=400)
         
-        # Validate ZIP file by trying to read it
+        # Sanitize the filename to prevent security issues
+        filename = get_valid_filename(uploaded_file.name)
+        
+        # Move the spooled upload into place and validate it by reading its central directory
         try:
-            zipfile.ZipFile(uploaded_file)
+            zip_path = store_upload(uploaded_file)
         except zipfile.BadZipFile:
             return HttpResponse(f"""
                 <div class="toast toast-end" id="error-toast">
@@ -316,52 +195,8 @@ def upload_files(request):
                 </script>
             """, status=400)
         
-        # Create upload directory if it doesn't exist
-        upload_dir = Path(settings.BASE_DIR) / 'data' / '0_uploaded'
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Sanitize the filename to prevent security issues
-        filename = get_valid_filename(uploaded_file.name)
-        file_path = upload_dir / filename
-        
-        # Save the file using Django's proper upload handling
-        with open(file_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
-        
-        # Get or create session and store filename and payer
-        session = get_or_create_session(request.user)
-        session.receipt_zip_filename = filename
-        session.payer = payer
-        session.current_step = 2  # Move to Extract step
-        session.save()
-        
-        # Extract the ZIP file and get list of files
-        extracted_files = unzip_receipts(session, filename)
-        
-        # Get unprocessed files for context
-        unprocessed_files = session.extracted_files.filter(is_processed=False, is_skipped=False)
-        
-        # Return the full page with updated state and success toast
-        return render(request, 'start_page.html', {
-            'current_step': session.current_step,
-            'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-            'session': session,
-            'state': {
-                'current_step': session.current_step,
-                'receipt_zip': session.receipt_zip_filename,
-                'payer': session.payer,
-                'api_costs_total': float(session.api_costs_total),
-                'current_extraction_index': session.current_extraction_index,
-                'files_processed': session.files_processed,
-                'progress_percentage': session.progress_percentage,
-                'current_sort_index': session.current_sort_index,
-                'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-                'consumption': get_consumption_data(session) if session.current_step >= 3 else {},
-                'sort_items': get_sort_items(session) if session.current_step == 3 else [],
-                'aggregation': get_aggregation_data(session) if session.current_step == 4 else {},
-            }
-        })
+        job = start_ingestion(request.user, filename, payer, zip_path)
+        return render(request, 'ingestion_progress.html', {'job': job})
     
     # If no file uploaded, return error toast
     return HttpResponse("""
@@ -378,6 +213,94 @@ def upload_files(request):
         </script>
     """, status=400)
 
+def get_chunked_upload_state(upload):
+    return {
+        'upload_id': str(upload.id),
+        'offset': upload.offset,
+        'size': upload.size,
+        'chunk_size': settings.CHUNKED_UPLOAD_CHUNK_SIZE,
+    }
+
+@login_required
+@require_POST
+def create_chunked_upload(request):
+    """Start a resumable upload; the client then PUTs chunks to the returned upload id."""
+    filename = get_valid_filename(request.POST.get('filename', ''))
+    payer = request.POST.get('payer', '')
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'error': 'Missing upload size'}, status=400)
+    
+    if not filename.lower().endswith('.zip'):
+        return JsonResponse({'error': 'Please select a ZIP file. Try a different file.'}, status=400)
+    if not 0 < size <= settings.CHUNKED_UPLOAD_MAX_SIZE:
+        return JsonResponse({'error': 'The file is empty or too large.'}, status=400)
+    
+    upload = start_chunked_upload(request.user, filename, size, payer)
+    return JsonResponse(get_chunked_upload_state(upload), status=201)
+
+@login_required
+@require_http_methods(['GET', 'PUT'])
+def chunked_upload(request, upload_id):
+    """Report (GET) or extend (PUT) a resumable upload.
+    
+    A PUT carries one chunk as the raw request body, with its start in the Upload-Offset
+    header and its hex SHA-256 in X-Chunk-SHA256. Rejected chunks answer with the offset
+    to resume from: 409 when the offset is stale, 400 when the bytes were damaged. The
+    last chunk hands the assembled ZIP to a background ingestion job.
+    """
+    upload = ChunkedUpload.objects.filter(pk=upload_id, user=request.user, is_complete=False).first()
+    if upload is None:
+        return JsonResponse({'error': 'Upload not found'}, status=404)
+    
+    if request.method == 'GET':
+        return JsonResponse(get_chunked_upload_state(upload))
+    
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+    except ValueError:
+        return JsonResponse({'error': 'Missing Upload-Offset header'}, status=400)
+    checksum = request.headers.get('X-Chunk-SHA256', '')
+    
+    try:
+        write_chunk(upload, offset, checksum, request)
+    except ChunkOffsetMismatch as e:
+        return JsonResponse({**get_chunked_upload_state(upload), 'offset': e.offset, 'error': str(e)}, status=409)
+    except ChunkRejected as e:
+        logger.warning(f"Rejected chunk at {offset} of upload {upload.id}: {str(e)}")
+        return JsonResponse({**get_chunked_upload_state(upload), 'offset': e.offset, 'error': str(e)}, status=400)
+    
+    state = get_chunked_upload_state(upload)
+    if upload.offset < upload.size:
+        return JsonResponse(state)
+    
+    try:
+        zip_path = finish_chunked_upload(upload)
+    except zipfile.BadZipFile:
+        return JsonResponse({**state, 'error': 'Invalid ZIP file. Please try a different file.'}, status=400)
+    except ChunkOffsetMismatch as e:
+        return JsonResponse({**state, 'error': str(e)}, status=409)
+    
+    job = start_ingestion(request.user, upload.filename, upload.payer, zip_path)
+    return JsonResponse({**state, 'progress_url': reverse('core:ingestion_progress', kwargs={'job_id': job.id})})
+
+@login_required
+@require_GET
+def ingestion_progress(request, job_id):
+    """Report the progress of an ingestion job; reloads the page once the files are ready."""
+    job = IngestionJob.objects.filter(pk=job_id, session__user=request.user).first()
+    if job is None:
+        return HttpResponse('<div class="alert alert-error">Upload not found</div>', status=404)
+    
+    if job.status == 'done':
+        # The session is on the Extract step now, let the page render it
+        response = HttpResponse('')
+        response['HX-Refresh'] = 'true'
+        return response
+    
+    return render(request, 'ingestion_progress.html', {'job': job})
+
 @login_required
 @require_POST
 def restart(request):
@@ -398,25 +321,7 @@ def restart(request):
     logger.info(f"Created new session {session.id} for restart")
     
     # Render the full page with reset state
-    return render(request, 'start_page.html', {
-        'current_step': session.current_step,
-        'extracted_files': [],
-        'session': session,
-        'state': {
-            'current_step': session.current_step,
-            'receipt_zip': session.receipt_zip_filename,
-            'payer': session.payer,
-            'api_costs_total': float(session.api_costs_total),
-            'current_extraction_index': session.current_extraction_index,
-            'files_processed': session.files_processed,
-            'progress_percentage': session.progress_percentage,
-            'current_sort_index': session.current_sort_index,
-            'extracted_files': [],
-            'consumption': {},
-            'sort_items': [],
-            'aggregation': {},
-        }
-    })
+    return render(request, 'start_page.html', get_start_page_context(session, request))
 
 @login_required
 @require_GET
@@ -431,37 +336,9 @@ def get_step_template(request, step_number):
     elif step_number == 3:
         return render(request, '3_extract_receipts.html')
     elif step_number == 4:
-        return render(request, '4_sort.html', {
-            'state': {
-                'current_step': session.current_step,
-                'receipt_zip': session.receipt_zip_filename,
-                'payer': session.payer,
-                'api_costs_total': float(session.api_costs_total),
-                'current_extraction_index': session.current_extraction_index,
-                'files_processed': session.files_processed,
-                'progress_percentage': session.progress_percentage,
-                'current_sort_index': session.current_sort_index,
-                'consumption': get_consumption_data(session),
-                'sort_items': get_sort_items(session),
-                'aggregation': get_aggregation_data(session),
-            }
-        })
+        return render(request, '4_sort.html', {'state': get_session_state(request, session, step=3)})
     elif step_number == 5:
-        return render(request, '5_aggregate.html', {
-            'state': {
-                'current_step': session.current_step,
-                'receipt_zip': session.receipt_zip_filename,
-                'payer': session.payer,
-                'api_costs_total': float(session.api_costs_total),
-                'current_extraction_index': session.current_extraction_index,
-                'files_processed': session.files_processed,
-                'progress_percentage': session.progress_percentage,
-                'current_sort_index': session.current_sort_index,
-                'consumption': get_consumption_data(session),
-                'sort_items': get_sort_items(session),
-                'aggregation': get_aggregation_data(session),
-            }
-        })
+        return render(request, '5_aggregate.html', {'state': get_session_state(request, session, step=4)})
     else:
         # Default to step 1 if invalid step number
         return render(request, '1_read_the_docs.html')
@@ -486,128 +363,124 @@ def select_file(request):
         'selected_file': request.session.get('selected_file')
     })
 
+def set_image_cache_headers(response, etag, immutable):
+    """Add validators and caching rules to an image response (including 304s)."""
+    response['ETag'] = etag
+    if immutable:
+        # The URL carries the image version, so the browser may keep it without revalidating
+        patch_cache_control(response, private=True, max_age=settings.IMAGE_CACHE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def get_sendfile_locations():
+    """Internal proxy locations (under IMAGE_ACCEL_REDIRECT_PREFIX) and the directories they serve."""
+    return {
+        'images': Path(settings.IMAGE_STORE_DIR),
+        'derivatives': Path(settings.IMAGE_DERIVATIVE_DIR),
+        'unzipped': Path(settings.BASE_DIR) / 'data' / '1_unzipped',
+    }
+
+def get_sendfile_response(image_path, content_type):
+    """Return an empty response that has the reverse proxy send the file, or None to send it from Django."""
+    backend = settings.IMAGE_SENDFILE_BACKEND
+    # Members of lazily ingested ZIPs have to be decompressed here
+    if not backend or not isinstance(image_path, Path):
+        return None
+    
+    if backend == 'x-sendfile':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = str(image_path.resolve())
+        return response
+    
+    for location, root in get_sendfile_locations().items():
+        try:
+            relative_path = image_path.resolve().relative_to(root.resolve())
+        except ValueError:
+            continue
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = f"{settings.IMAGE_ACCEL_REDIRECT_PREFIX}{location}/{quote(relative_path.as_posix())}"
+        return response
+    
+    logger.warning(f"{image_path} is outside the proxy's image locations; sending it from Django")
+    return None
+
+def send_image(image_path, content_type=None):
+    """Return a response with an image's bytes, or one that hands them off to the reverse proxy."""
+    if content_type is None:
+        with image_path.open('rb') as image_file:
+            content_type = sniff_content_type(image_file.read(16), str(image_path))
+    
+    response = get_sendfile_response(image_path, content_type)
+    if response is None:
+        # Images of lazily ingested ZIPs are streamed out of the archive
+        response = FileResponse(image_path.open('rb'), content_type=content_type)
+        response['Last-Modified'] = http_date(image_path.stat().st_mtime)
+    return response
+
 @login_required
 @require_GET
 def serve_image(request, filename):
-    """Serve the selected image file."""
+    """Serve the selected image file, or a downscaled variant of it with ?size=thumb or ?size=screen.
+    
+    Responses carry an ETag built from the image's content version and answer If-None-Match
+    with 304. URLs that include the current version as ?v= are cached as immutable. With
+    IMAGE_SENDFILE_BACKEND set, the bytes are sent by the reverse proxy after these checks.
+    """
     # The filename parameter is URL-encoded, so decode it
     decoded_filename = urllib.parse.unquote(filename)
     logger.debug(f"serve_image called with filename: '{filename}' (decoded: '{decoded_filename}')")
     
-    session = get_or_create_session(request.user)
-    
-    if not session.receipt_zip_filename:
-        logger.error("No file uploaded")
-        return HttpResponse("No file uploaded", status=404)
+    size = request.GET.get('size')
+    if size and size not in get_variants():
+        return HttpResponse("Unknown image size", status=400)
     
-    # Find the file using the decoded filename
-    extracted_file = session.extracted_files.filter(filename=decoded_filename).first()
+    # Find the file in the user's active session with one query; images never start a new session
+    extracted_file = ExtractedFile.objects.filter(
+        session__user=request.user, session__is_complete=False, filename=decoded_filename
+    ).select_related('session').order_by('-session__created_at').first()
     if not extracted_file:
         logger.error(f"File not found in database. Looking for filename: {decoded_filename}")
-        logger.error(f"Available files: {list(session.extracted_files.values_list('filename', flat=True))}")
         return HttpResponse("File not found or access denied", status=404)
     
-    # Get the extraction directory and use the relative_path for the actual file path
-    zip_filename = session.receipt_zip_filename
-    extract_dir_name = Path(zip_filename).stem
-    image_path = Path(settings.BASE_DIR) / 'data' / '1_unzipped' / extract_dir_name / extracted_file.relative_path
+    # Resolve the stored image (or the ZIP member it still lives in)
+    image_path = get_image_path(extracted_file.session, extracted_file)
     
-    logger.debug(f"Looking for image at: {image_path}")
-    logger.debug(f"Image path exists: {image_path.exists()}")
-    
-    if not image_path.exists() or not image_path.is_file():
-        logger.error(f"File not found on disk at: {image_path}")
-        return HttpResponse("File not found", status=404)
+    version = extracted_file.image_version
+    immutable = bool(version) and request.GET.get('v') == version
+    if not version:
+        # Files from before the image store are versioned by their size and modification time
+        try:
+            stat = image_path.stat()
+        except FileNotFoundError:
+            logger.error(f"File not found on disk at: {image_path}")
+            return HttpResponse("File not found", status=404)
+        version = f"{int(stat.st_mtime):x}-{stat.st_size:x}"
+    original_etag = f'"{version}-original"'
+    # Derivatives also depend on the rendering settings of their variant
+    etag = f'"{version}-{get_variant_tag(size)}"' if size else original_etag
     
-    # Serve the file
-    return FileResponse(open(image_path, 'rb'), content_type='image/jpeg')
-
-def image_to_dataframe_dict(image_path, openai_api_key) -> tuple[list[dict], float]:
-    """Extract receipt data from image using OpenAI API."""
-    logger.debug(f"Starting image extraction for: {image_path}")
-    logger.debug(f"Image path exists: {image_path.exists()}")
+    # Answer revalidations before touching the image
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        return set_image_cache_headers(not_modified, etag, immutable)
     
     try:
-        # Encode the image
-        logger.debug("Reading and encoding image...")
-        with open(image_path, "rb") as image_file:
-            encoded_image = base64.b64encode(image_file.read()).decode('utf-8')
-        logger.debug(f"Image encoded successfully. Length: {len(encoded_image)}")
-
-        # Prepare the API request
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {openai_api_key}"
-        }
-
-        payload = {
-            "model": "gpt-4o",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": (
-                                "Analyze this image of a receipt. Extract the items and their prices. "
-                                "Ensure to account for discounts, which are often indicated by a minus sign "
-                                "in front of the price or as a separate line item. Subtract any discounts from "
-                                "the corresponding item's price. Return the result as a Python list of dictionaries, "
-                                "where each dictionary has 'item' and 'price' keys. The 'price' should be a float. "
-                                "Do not include any explanatory text, just the Python code for the list of dictionaries, "
-                                "without the markdown formatting of the code."
-                            )
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{encoded_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            "max_tokens": 5000
-        }
-
-        logger.info("Making API request to OpenAI for image extraction")
-        # Make the API request
-        response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-        logger.debug(f"API response status: {response.status_code}")
-        
-        if response.status_code != 200:
-            logger.error(f"API error response: {response.text}")
-            raise Exception(f"OpenAI API error: {response.status_code} - {response.text}")
-
-        response_json = response.json()
-        logger.debug(f"Response JSON keys: {response_json.keys()}")
-        
-        tokens_used = response_json['usage']['total_tokens']
-        request_cost = ((0.03/1000) * tokens_used)/4 # /4 empirically determined from https://platform.openai.com/usage
-
-        # Extract and process the result
-        result = response_json['choices'][0]['message']['content']
-        logger.debug(f"Raw API result: {result}")
-
-        # Extract the Python code from the markdown
-        try:
-            result_as_string = re.sub(r'\n', '', result)
-            result = ast.literal_eval(result_as_string)
-
-            out = ast.literal_eval(result_as_string)
-            for item in out:
-                item['price'] = str(item['price'])
-            logger.info(f"Successfully extracted {len(out)} items from image")
-        except Exception as parse_error:
-            logger.error(f"Error parsing API result: {parse_error}")
-            out = [{'item': 'Error in extraction. Proceed manually.', 'price': '0'}]
-        finally:
-            logger.debug(f"Returning {len(out)} items with cost ${request_cost:.4f}")
-            return out, request_cost
-    except Exception as e:
-        logger.error(f"ERROR in image_to_dataframe_dict: {str(e)}")
-        logger.error(f"TRACEBACK: {traceback.format_exc()}")
-        raise
+        if size:
+            derivative_path = get_derivative(image_path, size)
+            if derivative_path is not None:
+                return set_image_cache_headers(send_image(derivative_path, 'image/jpeg'), etag, immutable)
+            # Not rendered (e.g. not decodable as an image); let the browser try the original, but
+            # validate it as the original and keep revalidating in case a later render succeeds
+            not_modified = get_conditional_response(request, etag=original_etag)
+            if not_modified is not None:
+                return set_image_cache_headers(not_modified, original_etag, False)
+            return set_image_cache_headers(send_image(image_path), original_etag, False)
+        
+        return set_image_cache_headers(send_image(image_path), etag, immutable)
+    except FileNotFoundError:
+        logger.error(f"File not found on disk at: {image_path}")
+        return HttpResponse("File not found", status=404)
 
 @login_required
 @require_POST
@@ -636,12 +509,9 @@ def extract_image_data(request):
         return HttpResponse('<div class="alert alert-error">No receipt ZIP file found in session</div>', status=400)
     
     # Get the image path
-    zip_filename = session.receipt_zip_filename
-    extract_dir_name = Path(zip_filename).stem
-    image_path = Path(settings.BASE_DIR) / 'data' / '1_unzipped' / extract_dir_name / extracted_file.relative_path
+    image_path = get_image_path(session, extracted_file)
     
-    logger.debug(f"Zip filename: {zip_filename}")
-    logger.debug(f"Extract dir name: {extract_dir_name}")
+    logger.debug(f"Zip filename: {session.receipt_zip_filename}")
     logger.debug(f"Image path: {image_path}")
     logger.debug(f"Image path exists: {image_path.exists()}")
     
@@ -650,29 +520,21 @@ def extract_image_data(request):
         return HttpResponse(f'<div class="alert alert-error">Image file not found at: {image_path}</div>', status=404)
     
     # Get OpenAI API key from environment
-    try:
-        # Ensure .env is loaded
-        load_dotenv(Path(settings.BASE_DIR) / 'config' / '.env')
-        openai_api_key = os.environ['OPENAI_API_KEY']
-        logger.debug(f"OpenAI API key loaded: {bool(openai_api_key)}")
-    except KeyError:
+    openai_api_key = get_openai_api_key()
+    if openai_api_key is None:
         logger.error("OpenAI API key not configured")
         return HttpResponse('<div class="alert alert-error">OpenAI API key not configured</div>', status=500)
     
     try:
         logger.info(f"Starting AI extraction for {selected_file}")
-        # Extract data from image
-        extracted_data, cost = image_to_dataframe_dict(image_path, openai_api_key)
+        # Extract data from image; a duplicate request for this file shares the same call
+        extracted_data, cost = run_extraction(extracted_file, image_path, openai_api_key)
         logger.info(f"Extraction completed. Found {len(extracted_data)} items, cost: ${cost:.4f}")
         
-        # Add cost to total API costs
-        session.api_costs_total += Decimal(str(cost))
-        session.save()
+        # The result is stored on the file and its cost already added to the session total
+        session.refresh_from_db(fields=['api_costs_total'])
         logger.info(f"Total API costs now: ${session.api_costs_total:.4f}")
         
-        # Store extracted data in Django session for later use
-        request.session['extracted_data'] = extracted_data
-        
         # Return the table template with next file button
         return render(request, 'extracted_data_table.html', {
             'extracted_data': extracted_data,
@@ -681,6 +543,8 @@ def extract_image_data(request):
             'current_file': selected_file,
             'show_next_button': True
         })
+    except (ExtractionUnavailable, RateLimitTimeout) as e:
+        return extraction_unavailable_response(e)
     except Exception as e:
         error_details = traceback.format_exc()
         logger.error(f"Extraction failed for {selected_file}: {str(e)}")
@@ -786,7 +650,8 @@ def confirm_extraction(request):
         # Mark the extracted file as processed
         extracted_file.is_processed = True
         extracted_file.extracted_at = timezone.now()
-        extracted_file.save()
+        # Only the confirmation fields: a full save would write back the deferred extraction output
+        extracted_file.save(update_fields=['is_processed', 'extracted_at'])
         
         logger.info(f"Confirmed extraction: {len(extracted_data)} items for {selected_file}")
         logger.debug(f"Data structure - Type: {type(extracted_data)}, Length: {len(extracted_data)}")
@@ -829,32 +694,11 @@ def clear_selection(request):
         if not unprocessed_files.exists() and confirmed_items.exists():
             # All files have been processed, move to sorting step
             session.current_step = 3  # Move to Sort step
-            session.save()
+            session.save(update_fields=['current_step', 'updated_at'])
             logger.info("All files processed, advancing to Sort step")
         
-        # Get updated file lists
-        unprocessed_files = session.extracted_files.filter(is_processed=False, is_skipped=False)
-        
         # Return the full page template with updated state
-        return render(request, 'start_page.html', {
-            'current_step': session.current_step,
-            'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-            'session': session,
-            'state': {
-                'current_step': session.current_step,
-                'receipt_zip': session.receipt_zip_filename,
-                'payer': session.payer,
-                'api_costs_total': float(session.api_costs_total),
-                'current_extraction_index': session.current_extraction_index,
-                'files_processed': session.files_processed,
-                'progress_percentage': session.progress_percentage,
-                'current_sort_index': session.current_sort_index,
-                'extracted_files': list(unprocessed_files.values_list('filename', flat=True)),
-                'consumption': get_consumption_data(session) if session.current_step >= 3 else {},
-                'sort_items': get_sort_items(session) if session.current_step == 3 else [],
-                'aggregation': get_aggregation_data(session) if session.current_step == 4 else {},
-            }
-        })
+        return render(request, 'start_page.html', get_start_page_context(session, request))
         
     except Exception as e:
         error_details = traceback.format_exc()
@@ -908,45 +752,17 @@ def assign_item(request):
         if remaining_unassigned == 0:
             # All items sorted - move directly to aggregation
             session.current_step = 4
-            session.save()
+            session.save(update_fields=['current_step', 'updated_at'])
             calculate_aggregation(session)
             logger.info("All items sorted, advancing to Aggregation step")
             
             # Return just the aggregate template content with trigger to update sidebar
-            response = render(request, '5_aggregate.html', {
-                'state': {
-                    'current_step': session.current_step,
-                    'receipt_zip': session.receipt_zip_filename,
-                    'payer': session.payer,
-                    'api_costs_total': float(session.api_costs_total),
-                    'current_extraction_index': session.current_extraction_index,
-                    'files_processed': session.files_processed,
-                    'progress_percentage': session.progress_percentage,
-                    'current_sort_index': session.current_sort_index,
-                    'consumption': get_consumption_data(session),
-                    'sort_items': get_sort_items(session),
-                    'aggregation': get_aggregation_data(session),
-                }
-            })
+            response = render(request, '5_aggregate.html', {'state': get_session_state(request, session)})
             response['HX-Trigger'] = 'sortingComplete'
             return response
         
         # Return the updated sort template with next item
-        return render(request, '4_sort.html', {
-            'state': {
-                'current_step': session.current_step,
-                'receipt_zip': session.receipt_zip_filename,
-                'payer': session.payer,
-                'api_costs_total': float(session.api_costs_total),
-                'current_extraction_index': session.current_extraction_index,
-                'files_processed': session.files_processed,
-                'progress_percentage': session.progress_percentage,
-                'current_sort_index': session.current_sort_index,
-                'consumption': get_consumption_data(session),
-                'sort_items': get_sort_items(session),
-                'aggregation': get_aggregation_data(session),
-            }
-        })
+        return render(request, '4_sort.html', {'state': get_session_state(request, session)})
         
     except Exception as e:
         error_details = traceback.format_exc()
@@ -1022,26 +838,12 @@ def get_current_sort_item(request):
             else:
                 # All items were sorted - move to aggregation
                 session.current_step = 4
-                session.save()
+                session.save(update_fields=['current_step', 'updated_at'])
                 calculate_aggregation(session)
                 logger.info("All items sorted, showing aggregation results")
                 
                 # Return just the aggregate template content with trigger to update sidebar
-                response = render(request, '5_aggregate.html', {
-                    'state': {
-                        'current_step': session.current_step,
-                        'receipt_zip': session.receipt_zip_filename,
-                        'payer': session.payer,
-                        'api_costs_total': float(session.api_costs_total),
-                        'current_extraction_index': session.current_extraction_index,
-                        'files_processed': session.files_processed,
-                        'progress_percentage': session.progress_percentage,
-                        'current_sort_index': session.current_sort_index,
-                        'consumption': get_consumption_data(session),
-                        'sort_items': get_sort_items(session),
-                        'aggregation': get_aggregation_data(session),
-                    }
-                })
+                response = render(request, '5_aggregate.html', {'state': get_session_state(request, session)})
                 response['HX-Trigger'] = 'sortingComplete'
                 return response
         
@@ -1187,7 +989,7 @@ def start_extraction(request):
         session.current_extraction_index = 0
         session.files_processed = 0
         session.progress_percentage = 0
-        session.save()
+        session.save(update_fields=['current_extraction_index', 'files_processed', 'progress_percentage', 'updated_at'])
         
         total_files = unprocessed_files.count()
         first_file_obj = unprocessed_files.first()
@@ -1198,36 +1000,12 @@ def start_extraction(request):
         
         # Store current file in Django session
         request.session['current_file'] = first_file
-        
-        # Get updated unprocessed files for context
-        unprocessed_files_list = list(unprocessed_files.values_list('filename', flat=True))
-        
-        # Create context that matches what start_page.html expects
-        context = {
-            'current_step': session.current_step,
-            'extracted_files': unprocessed_files_list,
-            'session': session,
-            'current_file': first_file,  # Original filename for display
-            'state': {
-                'current_step': session.current_step,
-                'receipt_zip': session.receipt_zip_filename,
-                'payer': session.payer,
-                'api_costs_total': float(session.api_costs_total),
-                'current_extraction_index': session.current_extraction_index,
-                'files_processed': session.files_processed,
-                'progress_percentage': session.progress_percentage,
-                'current_sort_index': session.current_sort_index,
-                'extracted_files': unprocessed_files_list,
-                'current_file': first_file,  # This is what the template needs
-                'consumption': get_consumption_data(session) if session.current_step >= 3 else {},
-                'sort_items': get_sort_items(session) if session.current_step == 3 else [],
-                'aggregation': get_aggregation_data(session) if session.current_step == 4 else {},
-            }
-        }
+        start_prefetch(session, first_file)
         
         # Return just the extraction template instead of full page
         return render(request, '3_extract_receipts.html', {
             'current_file': first_file,
+            'image_version': first_file_obj.image_version,
             'total_files': total_files,
             'files_processed': 0,
             'progress_percentage': 0
@@ -1252,7 +1030,7 @@ def extract_current_image(request):
         logger.info(f"Extracting data from current file: {current_file}")
         
         # Validate that the current file belongs to this user's session
-        extracted_file = session.extracted_files.filter(filename=current_file).first()
+        extracted_file = session.extracted_files.with_items().filter(filename=current_file).first()
         if not extracted_file:
             logger.error(f"File {current_file} not found in user's session")
             return HttpResponse('<div class="alert alert-error">File not found or access denied</div>', status=404)
@@ -1262,37 +1040,39 @@ def extract_current_image(request):
             logger.error("No receipt ZIP file found in session")
             return HttpResponse('<div class="alert alert-error">No receipt ZIP file found in session</div>', status=400)
         
+        # Return the stored result if this file was already extracted ahead of review
+        if extracted_file.extracted_items is not None and not request.POST.get('force'):
+            logger.info(f"Using stored extraction for {current_file}")
+            return render(request, 'extracted_data_table.html', {
+                'extracted_data': extracted_file.extracted_items,
+                'cost': float(extracted_file.extraction_cost),
+                'selected_file': current_file,
+                'current_file': current_file,
+                'show_next_button': True
+            })
+        
         # Get the image path
-        zip_filename = session.receipt_zip_filename
-        extract_dir_name = Path(zip_filename).stem
-        image_path = Path(settings.BASE_DIR) / 'data' / '1_unzipped' / extract_dir_name / extracted_file.relative_path
+        image_path = get_image_path(session, extracted_file)
         
         if not image_path.exists():
             logger.error(f"Image file not found at: {image_path}")
             return HttpResponse(f'<div class="alert alert-error">Image file not found at: {image_path}</div>', status=404)
         
         # Get OpenAI API key from environment
-        try:
-            # Ensure .env is loaded
-            load_dotenv(Path(settings.BASE_DIR) / 'config' / '.env')
-            openai_api_key = os.environ['OPENAI_API_KEY']
-            logger.debug(f"OpenAI API key loaded: {bool(openai_api_key)}")
-        except KeyError:
+        openai_api_key = get_openai_api_key()
+        if openai_api_key is None:
             logger.error("OpenAI API key not configured")
             return HttpResponse('<div class="alert alert-error">OpenAI API key not configured</div>', status=500)
         
-        # Extract data from image
-        extracted_data, cost = image_to_dataframe_dict(image_path, openai_api_key)
+        # Extract data from image; a duplicate request for this file shares the same call.
+        # Re-extract skips the result cache, otherwise it would get the same answer back
+        extracted_data, cost = run_extraction(extracted_file, image_path, openai_api_key, bypass_cache=bool(request.POST.get('force')))
         logger.info(f"Extraction completed. Found {len(extracted_data)} items, cost: ${cost:.4f}")
         
-        # Add cost to total API costs
-        session.api_costs_total += Decimal(str(cost))
-        session.save()
+        # The result is stored on the file and its cost already added to the session total
+        session.refresh_from_db(fields=['api_costs_total'])
         logger.info(f"Total API costs now: ${session.api_costs_total:.4f}")
         
-        # Store extracted data in Django session for later use
-        request.session['extracted_data'] = extracted_data
-        
         # Return the table template with next file button
         return render(request, 'extracted_data_table.html', {
             'extracted_data': extracted_data,
@@ -1302,12 +1082,243 @@ def extract_current_image(request):
             'show_next_button': True
         })
         
+    except (ExtractionUnavailable, RateLimitTimeout) as e:
+        return extraction_unavailable_response(e)
     except Exception as e:
         error_details = traceback.format_exc()
         logger.error(f"Extraction failed for {current_file}: {str(e)}")
         logger.error(f"TRACEBACK: {error_details}")
         return HttpResponse(f'<div class="alert alert-error">Extraction failed: {str(e)}</div>', status=500)
 
+def extraction_unavailable_response(error):
+    """Return a friendly 503 fragment when the extraction provider is degraded or too busy."""
+    logger.warning(f"Extraction unavailable: {str(error)}")
+    response = HttpResponse(f'<div class="alert alert-warning">{str(error)}</div>', status=503)
+    response['Retry-After'] = str(get_circuit_retry_after() or 30)
+    return response
+
+def get_extraction_target(request, session_key):
+    """Resolve the file named by a Django session key for extraction.
+    
+    Returns (session, extracted_file, image_path, error_response); error_response
+    is None when the file belongs to the user and exists on disk.
+    """
+    session = get_or_create_session(request.user)
+    filename = request.session.get(session_key)
+    
+    if not filename:
+        logger.error(f"No file set for extraction ({session_key})")
+        return session, None, None, HttpResponse('<div class="alert alert-error">No file selected</div>', status=400)
+    
+    # Validate that the file belongs to this user's session
+    extracted_file = session.extracted_files.with_items().filter(filename=filename).first()
+    if not extracted_file:
+        logger.error(f"File {filename} not found in user's session")
+        return session, None, None, HttpResponse('<div class="alert alert-error">File not found or access denied</div>', status=404)
+    
+    # Check if we have the receipt_zip in session
+    if not session.receipt_zip_filename:
+        logger.error("No receipt ZIP file found in session")
+        return session, extracted_file, None, HttpResponse('<div class="alert alert-error">No receipt ZIP file found in session</div>', status=400)
+    
+    image_path = get_image_path(session, extracted_file)
+    if not image_path.exists():
+        logger.error(f"Image file not found at: {image_path}")
+        return session, extracted_file, None, HttpResponse(f'<div class="alert alert-error">Image file not found at: {image_path}</div>', status=404)
+    
+    return session, extracted_file, image_path, None
+
+async def aextract_file(request, session_key, use_stored, bypass_cache=False):
+    """Shared body of the async extraction views."""
+    session, extracted_file, image_path, error_response = await sync_to_async(get_extraction_target)(request, session_key)
+    if error_response is not None:
+        return error_response
+    
+    filename = extracted_file.filename
+    context = {
+        'selected_file': filename,
+        'current_file': filename,
+        'show_next_button': True
+    }
+    
+    # Return the stored result if this file was already extracted ahead of review
+    if use_stored and extracted_file.extracted_items is not None:
+        logger.info(f"Using stored extraction for {filename}")
+        context.update(extracted_data=extracted_file.extracted_items, cost=float(extracted_file.extraction_cost))
+        return await sync_to_async(render)(request, 'extracted_data_table.html', context)
+    
+    openai_api_key = await sync_to_async(get_openai_api_key)()
+    if openai_api_key is None:
+        logger.error("OpenAI API key not configured")
+        return HttpResponse('<div class="alert alert-error">OpenAI API key not configured</div>', status=500)
+    
+    logger.info(f"Starting async AI extraction for {filename}")
+    extracted_data, cost = await arun_extraction(extracted_file, image_path, openai_api_key, bypass_cache)
+    logger.info(f"Extraction completed. Found {len(extracted_data)} items, cost: ${cost:.4f}")
+    
+    context.update(extracted_data=extracted_data, cost=cost)
+    return await sync_to_async(render)(request, 'extracted_data_table.html', context)
+
+@login_required
+@require_POST
+async def extract_current_image_async(request):
+    """Async variant of extract_current_image for ASGI deployments."""
+    try:
+        force = bool(request.POST.get('force'))
+        return await aextract_file(request, 'current_file', use_stored=not force, bypass_cache=force)
+    except (ExtractionUnavailable, RateLimitTimeout) as e:
+        return await sync_to_async(extraction_unavailable_response)(e)
+    except Exception as e:
+        logger.error(f"Async extraction failed: {str(e)}")
+        logger.error(f"TRACEBACK: {traceback.format_exc()}")
+        return HttpResponse(f'<div class="alert alert-error">Extraction failed: {str(e)}</div>', status=500)
+
+@login_required
+@require_POST
+async def extract_image_data_async(request):
+    """Async variant of extract_image_data for ASGI deployments."""
+    try:
+        return await aextract_file(request, 'selected_file', use_stored=False)
+    except (ExtractionUnavailable, RateLimitTimeout) as e:
+        return await sync_to_async(extraction_unavailable_response)(e)
+    except Exception as e:
+        logger.error(f"Async extraction failed: {str(e)}")
+        logger.error(f"TRACEBACK: {traceback.format_exc()}")
+        return HttpResponse(f'<div class="alert alert-error">Extraction failed: {str(e)}</div>', status=500)
+
+def format_sse(event, data=''):
+    """Format one server-sent event; multi-line data is sent as several data lines."""
+    data_lines = ''.join(f"data: {line}\n" for line in (data.splitlines() or ['']))
+    return f"event: {event}\n{data_lines}\n"
+
+async def iterate_in_thread(make_iterator):
+    """Run a blocking generator in its own thread and yield its values to the event loop as they arrive.
+    
+    Under ASGI, Django collects a sync iterator of a StreamingHttpResponse completely
+    before sending it, which would hold back every event until the extraction is done.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    stopped = threading.Event()
+    finished = object()
+    
+    def put(value):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, value)
+        except RuntimeError:
+            # The event loop is gone (server shutting down); nobody is reading anymore
+            stopped.set()
+    
+    def produce():
+        iterator = make_iterator()
+        try:
+            for value in iterator:
+                if stopped.is_set():
+                    break
+                put((value, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            # Closing the generator runs its cleanup (e.g. resolving in-flight extractions)
+            iterator.close()
+            connection.close()
+            put(finished)
+    
+    threading.Thread(target=produce, name='event-stream', daemon=True).start()
+    try:
+        while (item := await queue.get()) is not finished:
+            value, error = item
+            if error is not None:
+                raise error
+            yield value
+    finally:
+        # The client went away or the stream ended; let the thread stop at its next event
+        stopped.set()
+
+@login_required
+@require_POST
+def extract_current_image_stream(request):
+    """Stream item rows for the current image as server-sent events while the model answers.
+    
+    Sends an "item" event with a rendered table row per completed item and a final
+    "done" event, after which the page loads the full review table for the stored
+    result. Errors arrive as an "error" event with an alert fragment.
+    """
+    session, extracted_file, image_path, error_response = get_extraction_target(request, 'current_file')
+    if error_response is not None:
+        return error_response
+    
+    # Get OpenAI API key from environment
+    openai_api_key = get_openai_api_key()
+    if openai_api_key is None:
+        logger.error("OpenAI API key not configured")
+        return HttpResponse('<div class="alert alert-error">OpenAI API key not configured</div>', status=500)
+    
+    force = bool(request.POST.get('force'))
+    use_stored = extracted_file.extracted_items is not None and not force
+    
+    def event_stream():
+        # A stored result (e.g. prefetched) needs no streaming, the page loads it directly
+        if use_stored:
+            yield format_sse('done')
+            return
+        
+        try:
+            logger.info(f"Starting streaming AI extraction for {extracted_file.filename}")
+            index = 0
+            for event, payload in stream_extraction(extracted_file, image_path, openai_api_key, bypass_cache=force):
+                if event == 'item':
+                    row = render_to_string('extracted_item_row.html', {'item': payload, 'index': index, 'number': index + 1})
+                    index += 1
+                    yield format_sse('item', row)
+                else:
+                    extracted_data, cost = payload
+                    logger.info(f"Streaming extraction completed. Found {len(extracted_data)} items, cost: ${cost:.4f}")
+            yield format_sse('done')
+        except (ExtractionUnavailable, RateLimitTimeout) as e:
+            logger.warning(f"Streaming extraction unavailable for {extracted_file.filename}: {str(e)}")
+            yield format_sse('error', f'<div class="alert alert-warning">{str(e)}</div>')
+        except Exception as e:
+            logger.error(f"Streaming extraction failed for {extracted_file.filename}: {str(e)}")
+            logger.error(f"TRACEBACK: {traceback.format_exc()}")
+            yield format_sse('error', f'<div class="alert alert-error">Extraction failed: {str(e)}</div>')
+    
+    # ASGI servers only stream async iterators
+    events = iterate_in_thread(event_stream) if settings.SERVER_MODE == 'asgi' else event_stream()
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@login_required
+@require_POST
+def extract_all_files(request):
+    """Queue every unprocessed file in the session for background extraction."""
+    try:
+        session = get_or_create_session(request.user)
+        
+        if not session.receipt_zip_filename:
+            logger.error("No receipt ZIP file found in session")
+            return HttpResponse('<div class="alert alert-error">No receipt ZIP file found in session</div>', status=400)
+        
+        # Get OpenAI API key from environment
+        openai_api_key = get_openai_api_key()
+        if openai_api_key is None:
+            logger.error("OpenAI API key not configured")
+            return HttpResponse('<div class="alert alert-error">OpenAI API key not configured</div>', status=500)
+        
+        submitted = extract_all(session, openai_api_key)
+        
+        if not submitted:
+            return HttpResponse('<p class="text-sm text-base-content/60">All receipts are already extracted or in progress.</p>')
+        
+        return HttpResponse(f'<p class="text-sm text-base-content/60">Extracting {submitted} receipts in the background. Results appear instantly when you reach each file.</p>')
+        
+    except Exception as e:
+        logger.error(f"Failed to start extract all: {str(e)}")
+        return HttpResponse(f'<div class="alert alert-error">Failed to extract all files: {str(e)}</div>', status=500)
+
 @login_required
 @require_POST
 def skip_current_file(request):
@@ -1323,7 +1334,7 @@ def skip_current_file(request):
             extracted_file = session.extracted_files.filter(filename=current_file).first()
             if extracted_file:
                 extracted_file.is_skipped = True
-                extracted_file.save()
+                extracted_file.save(update_fields=['is_skipped'])
                 logger.info(f"Marked {current_file} as skipped")
         
         # Use the new targeted content system to move to next file
@@ -1338,56 +1349,33 @@ def skip_current_file(request):
 def next_file(request):
     """Move to the next file in the extraction sequence."""
     try:
-        # Get current progress
-        current_index = request.session.get('current_extraction_index', 0)
-        extracted_files = request.session.get('extracted_files', [])
+        session = get_or_create_session(request.user)
+        filenames = list(session.extracted_files.values_list('filename', flat=True))
         
         # Move to next file
-        current_index += 1
-        request.session['current_extraction_index'] = current_index
+        current_index = session.current_extraction_index + 1
+        session.current_extraction_index = current_index
         
         # Calculate progress
-        total_files = len(extracted_files)
-        files_processed = current_index
-        progress_percentage = int((files_processed / total_files) * 100) if total_files > 0 else 0
-        
-        request.session['files_processed'] = files_processed
-        request.session['progress_percentage'] = progress_percentage
+        total_files = len(filenames)
+        session.files_processed = current_index
+        session.progress_percentage = int((current_index / total_files) * 100) if total_files > 0 else 0
         
-        if current_index < len(extracted_files):
+        if current_index < total_files:
             # Set next file as current
-            request.session['current_file'] = extracted_files[current_index]
-            logger.info(f"Moving to next file: {request.session['current_file']} ({current_index + 1}/{len(extracted_files)})")
+            request.session['current_file'] = filenames[current_index]
+            logger.info(f"Moving to next file: {filenames[current_index]} ({current_index + 1}/{total_files})")
         else:
-            # All files processed
+            # All files processed; sort items are read from the confirmed receipt items
             request.session['current_file'] = None
-            session = get_or_create_session(request.user)
             session.current_step = 3  # Move to Sort step
-            session.save()
+            session.current_sort_index = 0
             logger.info("All files processed, advancing to Sort step")
-            
-            # Prepare sort items from all extracted data
-            if request.session.get('extracted', {}):
-                sort_items = []
-                for filename, data in request.session['extracted'].items():
-                    for item in data:
-                        sort_items.append({
-                            'item': item['item'],
-                            'price': float(item['price']),
-                            'filename': filename
-                        })
-                request.session['sort_items'] = sort_items
-                session.sort_items = sort_items
-                session.current_sort_index = 0
-                session.save()
-                logger.info(f"Prepared {len(sort_items)} items for sorting")
+        
+        session.save(update_fields=['current_extraction_index', 'files_processed', 'progress_percentage', 'current_step', 'current_sort_index', 'updated_at'])
         
         # Return the full page with updated state
-        return render(request, 'start_page.html', {
-            'current_step': session.current_step,
-            'extracted_files': request.session.get('extracted_files', []),
-            'state': request.session
-        })
+        return render(request, 'start_page.html', get_start_page_context(session, request))
         
     except Exception as e:
         logger.error(f"Failed to advance to next file: {str(e)}")
@@ -1413,7 +1401,7 @@ def next_file_in_queue(request):
         session.current_extraction_index = files_processed
         session.files_processed = files_processed
         session.progress_percentage = progress_percentage
-        session.save()
+        session.save(update_fields=['current_extraction_index', 'files_processed', 'progress_percentage', 'updated_at'])
         
         logger.info(f"Progress update: {files_processed}/{total_files} files completed ({progress_percentage}%)")
         
@@ -1432,7 +1420,7 @@ def next_file_in_queue(request):
             if confirmed_items.exists():
                 # Move to sorting step
                 session.current_step = 3
-                session.save()
+                session.save(update_fields=['current_step', 'updated_at'])
                 logger.info("All files processed, advancing to Sort step")
                 
                 # Clear current file
@@ -1440,21 +1428,7 @@ def next_file_in_queue(request):
                     del request.session['current_file']
                 
                 # Return sorting template with trigger to update progress steps
-                response = render(request, '4_sort.html', {
-                    'state': {
-                        'current_step': session.current_step,
-                        'receipt_zip': session.receipt_zip_filename,
-                        'payer': session.payer,
-                        'api_costs_total': float(session.api_costs_total),
-                        'current_extraction_index': session.current_extraction_index,
-                        'files_processed': session.files_processed,
-                        'progress_percentage': session.progress_percentage,
-                        'current_sort_index': session.current_sort_index,
-                        'consumption': get_consumption_data(session),
-                        'sort_items': get_sort_items(session),
-                        'aggregation': get_aggregation_data(session),
-                    }
-                })
+                response = render(request, '4_sort.html', {'state': get_session_state(request, session)})
                 
                 # Add success toast for completion
                 completion_toast = '''
@@ -1482,7 +1456,7 @@ def next_file_in_queue(request):
                 # No confirmed items - advance to final step with zeros and warning
                 logger.warning("All files processed but no confirmed items found")
                 session.current_step = 4  # Move to aggregation step
-                session.save()
+                session.save(update_fields=['current_step', 'updated_at'])
                 
                 # Calculate aggregation even with no items to create proper zero-valued record
                 calculate_aggregation(session)
@@ -1492,21 +1466,7 @@ def next_file_in_queue(request):
                     del request.session['current_file']
                 
                 # Return aggregation template with warning and zero amounts
-                response = render(request, '5_aggregate.html', {
-                    'state': {
-                        'current_step': session.current_step,
-                        'receipt_zip': session.receipt_zip_filename,
-                        'payer': session.payer,
-                        'api_costs_total': float(session.api_costs_total),
-                        'current_extraction_index': session.current_extraction_index,
-                        'files_processed': session.files_processed,
-                        'progress_percentage': session.progress_percentage,
-                        'current_sort_index': session.current_sort_index,
-                        'consumption': get_consumption_data(session),
-                        'sort_items': get_sort_items(session),
-                        'aggregation': get_aggregation_data(session),
-                    }
-                })
+                response = render(request, '5_aggregate.html', {'state': get_session_state(request, session)})
                 
                 # Add warning toast
                 warning_toast = '''
@@ -1592,7 +1552,7 @@ def next_extraction_content(request):
         session.current_extraction_index = files_processed
         session.files_processed = files_processed
         session.progress_percentage = progress_percentage
-        session.save()
+        session.save(update_fields=['current_extraction_index', 'files_processed', 'progress_percentage', 'updated_at'])
         
         logger.info(f"Progress update: {files_processed}/{total_files} files completed ({progress_percentage}%)")
         
@@ -1601,10 +1561,12 @@ def next_extraction_content(request):
             next_file = unprocessed_files.first()
             request.session['current_file'] = next_file.filename
             logger.info(f"Moving to next file: {next_file.filename}")
+            start_prefetch(session, next_file.filename)
             
             # Return just the extraction template with the next file and OOB progress update
             extraction_content = render(request, '3_extract_receipts.html', {
                 'current_file': next_file.filename,
+                'image_version': next_file.image_version,
                 'total_files': total_files,
                 'files_processed': files_processed,
                 'progress_percentage': progress_percentage
@@ -1650,7 +1612,7 @@ def next_extraction_content(request):
             if confirmed_items.exists():
                 # Move to sorting step
                 session.current_step = 3
-                session.save()
+                session.save(update_fields=['current_step', 'updated_at'])
                 logger.info("All files processed, advancing to Sort step")
                 
                 # Clear current file
@@ -1658,21 +1620,7 @@ def next_extraction_content(request):
                     del request.session['current_file']
                 
                 # Return sorting template with trigger to update progress steps
-                response = render(request, '4_sort.html', {
-                    'state': {
-                        'current_step': session.current_step,
-                        'receipt_zip': session.receipt_zip_filename,
-                        'payer': session.payer,
-                        'api_costs_total': float(session.api_costs_total),
-                        'current_extraction_index': session.current_extraction_index,
-                        'files_processed': session.files_processed,
-                        'progress_percentage': session.progress_percentage,
-                        'current_sort_index': session.current_sort_index,
-                        'consumption': get_consumption_data(session),
-                        'sort_items': get_sort_items(session),
-                        'aggregation': get_aggregation_data(session),
-                    }
-                })
+                response = render(request, '4_sort.html', {'state': get_session_state(request, session)})
                 
                 # Add success toast for completion
                 completion_toast = '''
@@ -1700,7 +1648,7 @@ def next_extraction_content(request):
                 # No confirmed items - this shouldn't happen
                 logger.warning("All files processed but no confirmed items found")
                 session.current_step = 4  # Move to aggregation step
-                session.save()
+                session.save(update_fields=['current_step', 'updated_at'])
                 
                 # Calculate aggregation even with no items to create proper zero-valued record
                 calculate_aggregation(session)
@@ -1710,21 +1658,7 @@ def next_extraction_content(request):
                     del request.session['current_file']
                 
                 # Return aggregation template with warning and zero amounts
-                response = render(request, '5_aggregate.html', {
-                    'state': {
-                        'current_step': session.current_step,
-                        'receipt_zip': session.receipt_zip_filename,
-                        'payer': session.payer,
-                        'api_costs_total': float(session.api_costs_total),
-                        'current_extraction_index': session.current_extraction_index,
-                        'files_processed': session.files_processed,
-                        'progress_percentage': session.progress_percentage,
-                        'current_sort_index': session.current_sort_index,
-                        'consumption': get_consumption_data(session),
-                        'sort_items': get_sort_items(session),
-                        'aggregation': get_aggregation_data(session),
-                    }
-                })
+                response = render(request, '5_aggregate.html', {'state': get_session_state(request, session)})
                 
                 # Add warning toast
                 warning_toast = '''
@@ -1773,3 +1707,9 @@ def simple_logout(request):
 def health_check(request):
     """Simple health check endpoint."""
     return JsonResponse({'status': 'ok'})
+
+@staff_member_required
+@require_GET
+def extraction_metrics(request):
+    """Return this worker's extraction pipeline counters and timings."""
+    return JsonResponse(metrics.snapshot())
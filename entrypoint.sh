@@ -27,12 +27,29 @@ EOF
 echo "Collecting static files..."
 python manage.py collectstatic --noinput
 
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+    echo "Starting Gunicorn ASGI server (uvicorn workers)..."
+    exec gunicorn config.asgi:application \
+        --config config/gunicorn.conf.py \
+        --bind 0.0.0.0:8000 \
+        --workers ${GUNICORN_WORKERS:-4} \
+        --worker-class uvicorn_worker.UvicornWorker \
+        --timeout 60 \
+        --keep-alive 2 \
+        --max-requests 1000 \
+        --max-requests-jitter 100 \
+        --access-logfile - \
+        --error-logfile - \
+        --log-level info
+fi
+
 echo "Starting Gunicorn WSGI server..."
 exec gunicorn config.wsgi:application \
+    --config config/gunicorn.conf.py \
     --bind 0.0.0.0:8000 \
-    --workers 4 \
+    --workers ${GUNICORN_WORKERS:-4} \
     --worker-class gthread \
-    --threads 2 \
+    --threads ${GUNICORN_THREADS:-2} \
     --timeout 60 \
     --keep-alive 2 \
     --max-requests 1000 \